@@ -3,12 +3,19 @@
 
 import argparse
 import collections
+import os
+import sqlite3
 import sys
+import tempfile
 import tabulate
 
+import numpy
 import pandas
 
 import cache_water_points 
+import diagnostics
+import metrics
+import water_features
 
 
 # The radius to use in different types of locations. In our data,
@@ -22,67 +29,313 @@ REGIONAL_RADIUS = 500
 MAX_FEATURES = 50
 
 
-def find_cache_water_points(in_data, radius, regional_radius):
-    features = {}
-    for i in range(len(in_data)):
-        if i % 1000 == 0:
-            print(f"Checked {i} points")
-        row = in_data.iloc[i]
-        point_id = row["patient_id"]
-        remoteness = row["incident_remoteness_code"]
-        if pandas.isna(row["Pickup_Latitude"]) or pandas.isna(row["Pickup_Longitude"]):
-            features[point_id] = None
-            continue
-        latlng = (row["Pickup_Latitude"], row["Pickup_Longitude"])
-        if remoteness >= 2:  # Corresponds to outer regional, remote, very remote
-            features[point_id] = cache_water_points.get_cached_features_near_point(
-                point_id, regional_radius, max_features=MAX_FEATURES
-            )
-        else:
-            features[point_id] = cache_water_points.get_cached_features_near_point(
-                point_id, radius, max_features=MAX_FEATURES
-            )
-    return features
+def point_radii(remoteness, radius, regional_radius):
+    # Outer regional, remote and very remote points use the regional radius.
+    return numpy.where(numpy.asarray(remoteness) >= 2, regional_radius, radius)
+
+
+def find_cache_water_points(in_data, radius, regional_radius, cache=None):
+    has_latlng = in_data["Pickup_Latitude"].notna() & in_data["Pickup_Longitude"].notna()
+    points = in_data[has_latlng]
+    radii = point_radii(points["incident_remoteness_code"], radius, regional_radius)
+    return cache_water_points.get_cached_features_near_points(
+        points["patient_id"], radii, max_features=MAX_FEATURES, cache=cache
+    )
+
+
+def check_unique_patient_ids(in_data):
+    # Each point's water is joined on by patient_id, so it must be unique.
+    if not in_data["patient_id"].is_unique:
+        raise ValueError("The same patient_id is in the input more than once")
+
+
+# Joins the cached water features near each point onto in_data, in the long
+# format.
+@metrics.timed("add_water_to_data.join_water")
+def join_water(
+    in_data, cache=None, radius=METRO_RADIUS, regional_radius=REGIONAL_RADIUS
+):
+    check_unique_patient_ids(in_data)
+    features_df = find_cache_water_points(
+        in_data, radius, regional_radius, cache=cache
+    )
+    in_data = in_data.set_index("patient_id")
+    return in_data.join(features_df.set_index("patient_id")).reset_index()
+
+
+# Joins the cached water features within the largest of radii (a sorted list)
+# onto in_data, with a water_count_{radius} column for each radius and the
+# smallest radius each feature is within, so the data for every radius comes
+# from one pass over the cache.
+@metrics.timed("add_water_to_data.join_water_radii")
+def join_water_radii(in_data, radii, cache=None):
+    check_unique_patient_ids(in_data)
+    has_latlng = in_data["Pickup_Latitude"].notna() & in_data["Pickup_Longitude"].notna()
+    features_df = cache_water_points.get_cached_features_near_points(
+        in_data.loc[has_latlng, "patient_id"],
+        radii[-1],
+        max_features=MAX_FEATURES,
+        cache=cache,
+    )
+    points, patient_ids = pandas.factorize(features_df["patient_id"])
 
+    has_water = features_df["rank"].notna().to_numpy()
+    point = points[has_water]
+    distances = features_df["water_distance"].to_numpy(dtype=float)[has_water]
+    # Each point's distances are sorted, so offsetting them by a multiple of
+    # the largest radius gives one sorted array that can be binary searched
+    # for every point and radius at once.
+    span = radii[-1] + 1
+    order = numpy.lexsort((distances, point))
+    offset_distances = (point * span + distances)[order]
+    starts = numpy.arange(len(patient_ids)) * span
+    first = numpy.searchsorted(offset_distances, starts, side="left")
+    counts = pandas.DataFrame(index=pandas.Index(patient_ids, name="patient_id"))
+    for radius in radii:
+        within = numpy.searchsorted(offset_distances, starts + radius, side="right")
+        counts[f"water_count_{radius}"] = within - first
 
-def run(in_data, in_filename):
-    num_missing = (
-        in_data["Pickup_Latitude"].isna() | in_data["Pickup_Longitude"].isna()
-    ).sum()
+    within_radius = numpy.full(len(features_df), numpy.nan)
+    within_radius[has_water] = numpy.asarray(radii)[
+        numpy.searchsorted(radii, distances, side="left")
+    ]
+    features_df["within_radius"] = pandas.array(within_radius).astype("Int64")
 
-    features = find_cache_water_points(
-        in_data, METRO_RADIUS, REGIONAL_RADIUS,
+    in_data = in_data.set_index("patient_id")
+    # Points without a lat/lng have no counts.
+    counts = counts.reindex(in_data.index).astype("Int64")
+    return (
+        in_data.join(counts)
+        .join(features_df.set_index("patient_id"))
+        .reset_index()
     )
-    features_df = pandas.DataFrame(features).transpose().set_index("patient_id")
-    water_found_points = features_df[features_df["water_count"] > 0]
 
-    print(f"Found water near {len(water_found_points)} of {len(in_data)}")
+
+def print_radii_summary(num_points, radii_found, num_missing):
+    for radius, found in radii_found.items():
+        print(f"Found water within {radius}m of {found} of {num_points}")
     print(f"Lat/lng was missing for {num_missing} rows")
 
-    in_data = in_data.set_index("patient_id", verify_integrity=True)
 
-    out_data = in_data.join(features_df)
-    out_data.to_csv(f"outputs/{in_filename}-with-water.csv")
+def count_found_radii(out_data, radii):
+    points = out_data.drop_duplicates("patient_id")
+    return collections.Counter(
+        {radius: (points[f"water_count_{radius}"] > 0).sum() for radius in radii}
+    )
+
+
+def count_missing(in_data):
+    return (in_data["Pickup_Latitude"].isna() | in_data["Pickup_Longitude"].isna()).sum()
+
+
+def count_found(out_data):
+    return (water_features.water_counts(out_data) > 0).sum()
+
+
+def print_summary(num_points, num_found, num_missing):
+    print(f"Found water near {num_found} of {num_points}")
+    print(f"Lat/lng was missing for {num_missing} rows")
+
+
+def add_water(in_data, cache=None):
+    out_data = join_water(in_data, cache=cache)
+    print_summary(len(in_data), count_found(out_data), count_missing(in_data))
+    return out_data
+
+
+def run(in_data, in_filename, wide=False):
+    water_features.write_csv(
+        add_water(in_data), f"outputs/{in_filename}-with-water.csv", wide=wide
+    )
+
+
+def run_radii(in_data, in_filename, radii):
+    out_data = join_water_radii(in_data, radii)
+    print_radii_summary(
+        len(in_data), count_found_radii(out_data, radii), count_missing(in_data)
+    )
+    water_features.write_csv(out_data, f"outputs/{in_filename}-with-water-radii.csv")
+
+
+def usable_features(chunk, max_radius=REGIONAL_RADIUS):
+    # Which of the cache rows in chunk could be used: those within max_radius
+    # and among the nearest MAX_FEATURES. Each point's nearest feature is
+    # always kept, so every point is still in the cache.
+    rank = chunk["rank"]
+    keep = (
+        rank.isna()
+        | (rank == 0)
+        | ((chunk["water_distance"] <= max_radius) & (rank < MAX_FEATURES))
+    )
+    return keep.to_numpy(dtype=bool)
+
+
+def _common_dtype(a, b):
+    # The dtype pandas.concat would give a column with these dtypes.
+    if a == b:
+        return a
+    if pandas.api.types.is_numeric_dtype(a) and pandas.api.types.is_numeric_dtype(b):
+        return numpy.result_type(a, b)
+    return object
+
+
+# The usable features in the cache (see usable_features), copied a chunk at a
+# time into an sqlite database in a temporary directory and indexed by
+# patient_id, so each chunk of the input can look up its points' rows without
+# the whole cache being in memory. Use as a context manager, which deletes the
+# copy.
+class CacheIndex:
+    def __init__(self, path, chunksize, max_radius=REGIONAL_RADIUS):
+        self.dir = tempfile.TemporaryDirectory()
+        self.db = sqlite3.connect(os.path.join(self.dir.name, "cache.sqlite"))
+        # The dtype of each column across the whole cache, as if it had been
+        # read at once, so the rows looked up match load_cached_features'.
+        self.dtypes = {}
+        # Columns with no values so far, whose dtype is only a placeholder, as
+        # pandas.concat ignores all-missing columns' dtypes.
+        missing = set()
+        # The rows' position in the cache, to give them back in that order.
+        position = 0
+        created = False
+        for chunk in water_features.read_csv_chunks(path, chunksize):
+            chunk = chunk[usable_features(chunk, max_radius)]
+            for column, values in chunk.items():
+                if values.isna().all():
+                    if column not in self.dtypes:
+                        self.dtypes[column] = values.dtype
+                        missing.add(column)
+                elif column in missing or column not in self.dtypes:
+                    self.dtypes[column] = values.dtype
+                    missing.discard(column)
+                else:
+                    self.dtypes[column] = _common_dtype(
+                        self.dtypes[column], values.dtype
+                    )
+            if not created:
+                # Untyped columns keep each value as it was written.
+                columns = ", ".join(f'"{c}"' for c in ["_row", *chunk.columns])
+                self.db.execute(f"CREATE TABLE cache ({columns})")
+                created = True
+            chunk = chunk.assign(_row=range(position, position + len(chunk)))
+            chunk.to_sql("cache", self.db, if_exists="append", index=False)
+            position += len(chunk)
+        self.db.execute("CREATE INDEX cache_patient_id ON cache (patient_id)")
+        # The patient_ids looked up so far.
+        self.db.execute("CREATE TABLE seen (patient_id PRIMARY KEY)")
+        self.db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.db.close()
+        self.dir.cleanup()
+
+    def lookup(self, patient_ids):
+        # The cache rows for patient_ids, indexed by patient_id as for
+        # load_cached_features. Raises ValueError if a patient_id appears
+        # twice, here or in an earlier lookup.
+        ids = [(patient_id,) for patient_id in pandas.Series(patient_ids).tolist()]
+        try:
+            with self.db:
+                self.db.executemany("INSERT INTO seen VALUES (?)", ids)
+        except sqlite3.IntegrityError:
+            raise ValueError("The same patient_id is in the input more than once")
+        self.db.execute("CREATE TEMP TABLE lookup (patient_id)")
+        try:
+            self.db.executemany("INSERT INTO lookup VALUES (?)", ids)
+            rows = pandas.read_sql_query(
+                "SELECT * FROM cache WHERE patient_id IN"
+                " (SELECT patient_id FROM lookup) ORDER BY _row",
+                self.db,
+            )
+        finally:
+            self.db.execute("DROP TABLE lookup")
+        rows = rows.drop(columns="_row").astype(self.dtypes)
+        return rows.set_index("patient_id")
+
+
+# Adds the water to the input chunksize rows at a time, appending each chunk's
+# rows to the output as it goes. The cache is looked up through a CacheIndex, so
+# neither the input nor the cache has to fit in memory. With radii, adds the
+# water for each radius as join_water_radii does.
+def run_chunked(filename, in_filename, chunksize, limit_points=None, radii=None):
+    out_path = f"outputs/{in_filename}-with-water.csv"
+    max_radius = REGIONAL_RADIUS
+    if radii:
+        out_path = f"outputs/{in_filename}-with-water-radii.csv"
+        max_radius = radii[-1]
+        radii_found = collections.Counter()
+    cache_index = CacheIndex(cache_water_points.CACHE_PATH, chunksize, max_radius)
+
+    num_points = num_found = num_missing = 0
+    with cache_index, open(out_path, "w", newline="") as f:
+        for in_data in pandas.read_csv(filename, chunksize=chunksize):
+            if limit_points:
+                in_data = in_data.head(limit_points - num_points)
+                if len(in_data) == 0:
+                    break
+            cache = cache_index.lookup(in_data["patient_id"])
+            if radii:
+                out_data = join_water_radii(in_data, radii, cache=cache)
+                radii_found += count_found_radii(out_data, radii)
+            else:
+                out_data = join_water(in_data, cache=cache)
+            water_features.write_csv(out_data, f, header=num_points == 0)
+
+            num_points += len(in_data)
+            num_found += count_found(out_data)
+            num_missing += count_missing(in_data)
+            print(f"Added water to {num_points} points")
+
+    if radii:
+        print_radii_summary(num_points, radii_found, num_missing)
+    else:
+        print_summary(num_points, num_found, num_missing)
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("filename")
     parser.add_argument("--limit_points", type=int, required=False)
+    parser.add_argument("--wide", action="store_true")
+    parser.add_argument("--chunksize", type=int, required=False)
+    parser.add_argument("--radii", type=int, nargs="+", required=False)
+    metrics.add_arguments(parser)
+    diagnostics.add_arguments(parser)
     args = parser.parse_args()
+    metrics.configure(args)
+    diagnostics.configure(args)
+    if args.chunksize and args.wide:
+        parser.error("--wide needs all the points at once, so can't be used with --chunksize")
+    if args.radii and args.wide:
+        parser.error("--radii output is only available in the long format")
+    if args.radii:
+        args.radii = sorted(set(args.radii))
 
     print(f"Adding water data to {args.filename}")
 
+    in_filename = args.filename.split("/")[-1]
+    in_filename = in_filename.split(".")[-2]
+
+    if args.chunksize:
+        run_chunked(
+            args.filename, in_filename, args.chunksize, args.limit_points, args.radii
+        )
+        return
+
     in_data = pandas.read_csv(args.filename)
     if args.limit_points and args.limit_points < len(in_data):
         in_data = in_data.head(args.limit_points)
 
-    in_filename = args.filename.split("/")[-1]
-    in_filename = in_filename.split(".")[-2]
+    if args.radii:
+        run_radii(in_data, in_filename, args.radii)
+        return
 
     run(
         in_data,
         in_filename,
+        wide=args.wide,
     )
 
 
@@ -0,0 +1,393 @@
+# Times each stage on its own against synthetic points and water features at
+# several scales, entirely offline: water is found from a LocalExtractSource of
+# synthetic features, and the later stages read a synthetic cache. The results
+# are written as JSON, and can be compared with an earlier run (the baseline)
+# to flag stages that have become slower.
+#
+# The synthetic data is generated from a fixed seed, so runs are comparable.
+# Stages that still work point by point are only run up to STAGE_LIMITS points
+# by default, so that a run at a million points finishes in reasonable time.
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import geopandas
+import numpy
+import pandas
+import shapely
+import tabulate
+
+import add_water_to_data
+import cache_water_points
+import feature_sources
+import metrics
+import prioritise_location_type
+import process_locations
+
+SCALES = [1_000, 100_000, 1_000_000]
+
+# The area the synthetic points and features are spread over, around Sydney.
+BOUNDS = (151.0, -34.0, 151.3, -33.7)
+
+REMOTENESS_CODES = [0, 1, 2, 3, 4]
+
+# The tags of the synthetic features, as (tags, geometry) where geometry is
+# "point", "polygon" or "line".
+FEATURE_KINDS = [
+    ({"natural": "beach", "name": "Bondi Beach", "lifeguard": "yes"}, "polygon"),
+    ({"natural": "coastline"}, "line"),
+    ({"leisure": "swimming_pool", "access": "private"}, "polygon"),
+    ({"leisure": "swimming_pool", "name": "Aquatic Centre"}, "polygon"),
+    ({"leisure": "sports_centre", "sport": "swimming"}, "polygon"),
+    ({"natural": "water", "water": "pond"}, "polygon"),
+    ({"natural": "water", "name": "Lake Parramatta"}, "polygon"),
+    ({"waterway": "river", "name": "Parramatta River"}, "line"),
+    ({"waterway": "stream"}, "line"),
+    ({"waterway": "drain"}, "line"),
+    ({"amenity": "fountain"}, "point"),
+    ({"man_made": "storage_tank", "content": "water"}, "point"),
+    ({"man_made": "pier"}, "line"),
+    ({"sport": "swimming", "club": "surf_life_saving", "name": "Bondi SLSC"}, "point"),
+    ({"leisure": "marina"}, "polygon"),
+]
+
+# The water types and names in the synthetic cache.
+CACHE_TYPES = prioritise_location_type.WATER_TYPES + [
+    "natural:water",
+    "lifeguard",
+    "pier",
+    "coastline",
+]
+CACHE_NAMES = numpy.array(
+    [None, None, None, "Bondi Beach", "Parramatta River", "Lake Burley Griffin"],
+    dtype=object,
+)
+
+# The typical size of a synthetic feature, in degrees (about 50m).
+FEATURE_SIZE = 0.0005
+
+# The settings that make the synthetic workload, which a baseline must have been
+# run with to be compared.
+WORKLOAD_SETTINGS = ["features", "features_per_point", "seed"]
+
+# The largest number of points to run each stage with by default.
+STAGE_LIMITS = {
+    "cache_water_points.find_features": 10_000,
+    "interactive_map.run": 1_000,
+}
+
+
+def synthetic_points(num_points, rng):
+    # Points in the same shape as random_points.py makes, with 6 decimal places
+    # and 1% missing a location.
+    lngs = rng.uniform(BOUNDS[0], BOUNDS[2], num_points).round(6)
+    lats = rng.uniform(BOUNDS[1], BOUNDS[3], num_points).round(6)
+    missing = rng.random(num_points) < 0.01
+    lats[missing] = numpy.nan
+    lngs[missing] = numpy.nan
+    return pandas.DataFrame(
+        {
+            "patient_id": [f"B{i}" for i in range(num_points)],
+            "Pickup_Latitude": lats,
+            "Pickup_Longitude": lngs,
+            "incident_remoteness_code": rng.choice(REMOTENESS_CODES, num_points),
+            "age_years": rng.integers(0, 90, num_points),
+        }
+    )
+
+
+def synthetic_features(num_features, rng):
+    # A GeoDataFrame in the same shape as osmnx.features.features_from_bbox.
+    kinds = rng.integers(0, len(FEATURE_KINDS), num_features)
+    x = rng.uniform(BOUNDS[0], BOUNDS[2], num_features)
+    y = rng.uniform(BOUNDS[1], BOUNDS[3], num_features)
+    size = rng.uniform(0.2, 2, num_features) * FEATURE_SIZE
+    shapes = numpy.array([FEATURE_KINDS[k][1] for k in kinds])
+    geometries = numpy.empty(num_features, dtype=object)
+    is_point = shapes == "point"
+    is_polygon = shapes == "polygon"
+    is_line = shapes == "line"
+    geometries[is_point] = shapely.points(x[is_point], y[is_point])
+    geometries[is_polygon] = shapely.box(
+        x[is_polygon],
+        y[is_polygon],
+        x[is_polygon] + size[is_polygon],
+        y[is_polygon] + size[is_polygon],
+    )
+    steps = numpy.arange(5)[None, :, None] * numpy.array([1, 0.6])
+    coords = numpy.stack([x[is_line], y[is_line]], axis=1)[:, None, :]
+    coords = coords + steps * size[is_line, None, None]
+    geometries[is_line] = shapely.linestrings(coords)
+
+    tags = pandas.DataFrame([FEATURE_KINDS[k][0] for k in kinds])
+    tags["element"] = numpy.where(is_point, "node", "way")
+    tags["id"] = numpy.arange(num_features)
+    return geopandas.GeoDataFrame(
+        tags, geometry=geometries, crs="EPSG:4326"
+    ).set_index(["element", "id"])
+
+
+def synthetic_cache(points, features_per_point, rng):
+    # A cache in the same shape as load_cached_features makes, with a Poisson
+    # number of features for each point, up to the cache's radius away.
+    counts = numpy.minimum(
+        rng.poisson(features_per_point, len(points)), cache_water_points.OUTPUT_WIDTH
+    )
+    counts[points["Pickup_Latitude"].isna().to_numpy()] = 0
+    point = numpy.repeat(numpy.arange(len(points)), counts)
+    distances = rng.uniform(0, cache_water_points.RADIUS_METRES, len(point)).round(2)
+    order = numpy.lexsort((distances, point))
+    point = point[order]
+    distances = distances[order]
+    starts = numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    features = pandas.DataFrame(
+        {
+            "patient_id": points["patient_id"].to_numpy()[point],
+            "accuracy_metres": 0.111,
+            "rank": numpy.arange(len(point)) - starts,
+            "water_name": rng.choice(CACHE_NAMES, len(point)),
+            "water_type": rng.choice(CACHE_TYPES, len(point)),
+            "water_distance": distances,
+            "water_lifeguard": None,
+        }
+    )
+    no_water = pandas.DataFrame(
+        {
+            "patient_id": points["patient_id"].to_numpy()[counts == 0],
+            "accuracy_metres": 0.111,
+            "rank": numpy.nan,
+        }
+    )
+    cache = pandas.concat([features, no_water], ignore_index=True)
+    return cache.astype({"rank": float}).set_index("patient_id")
+
+
+class Workload:
+    def __init__(self, num_points, source, features_per_point, seed):
+        rng = numpy.random.default_rng(seed)
+        self.num_points = num_points
+        self.source = source
+        self.points = synthetic_points(num_points, rng)
+        self.cache = synthetic_cache(self.points, features_per_point, rng)
+        self._joined = None
+        self._processed = None
+
+    # The inputs of the later stages are made from the earlier ones the first
+    # time they're needed, outside the timings.
+    def joined(self):
+        if self._joined is None:
+            self._joined = add_water_to_data.join_water(self.points, cache=self.cache)
+        return self._joined
+
+    def processed(self):
+        if self._processed is None:
+            self._processed = process_locations.process(self.joined())
+        return self._processed
+
+
+# Each stage takes a Workload, and returns a function that runs the stage once.
+def find_features_stage(w):
+    return lambda: cache_water_points.find_features(w.points, source=w.source)
+
+
+def get_cached_features_stage(w):
+    return lambda: add_water_to_data.find_cache_water_points(
+        w.points,
+        add_water_to_data.METRO_RADIUS,
+        add_water_to_data.REGIONAL_RADIUS,
+        cache=w.cache,
+    )
+
+
+def process_stage(w):
+    joined = w.joined()
+    return lambda: process_locations.process(joined)
+
+
+def apply_heuristic_stage(w):
+    processed = w.processed()
+    return lambda: prioritise_location_type.apply_heuristic(processed)
+
+
+def interactive_map_stage(w):
+    # Imported here, as it needs folium, which the other stages don't.
+    import interactive_map
+
+    output_dir = tempfile.mkdtemp()
+
+    def run():
+        interactive_map.run(
+            w.points,
+            add_water_to_data.METRO_RADIUS,
+            add_water_to_data.REGIONAL_RADIUS,
+            output_dir=output_dir + os.sep,
+            source=w.source,
+        )
+
+    return run
+
+
+STAGES = {
+    "cache_water_points.find_features": find_features_stage,
+    "cache_water_points.get_cached_features_near_points": get_cached_features_stage,
+    "process_locations.process": process_stage,
+    "prioritise_location_type.apply_heuristic": apply_heuristic_stage,
+    "interactive_map.run": interactive_map_stage,
+}
+
+
+def time_stage(func, repeat):
+    # The fastest of repeat runs, with the stage's output hidden.
+    timings = []
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def run(scales, stages, num_features, features_per_point, repeat, seed, limits=True):
+    rng = numpy.random.default_rng(seed)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        features = synthetic_features(num_features, rng)
+        source = feature_sources.LocalExtractSource(features)
+
+    results = []
+    for num_points in scales:
+        w = Workload(num_points, source, features_per_point, seed)
+        for stage in stages:
+            if limits and num_points > STAGE_LIMITS.get(stage, num_points):
+                print(f"Skipping {stage} at {num_points} points")
+                continue
+            print(f"Timing {stage} at {num_points} points")
+            try:
+                with open(os.devnull, "w") as devnull:
+                    with contextlib.redirect_stdout(devnull):
+                        func = STAGES[stage](w)
+            except ImportError as e:
+                # interactive_map needs folium.
+                print(f"Skipping {stage}: {e}")
+                continue
+            seconds = time_stage(func, repeat)
+            results.append(
+                {
+                    "stage": stage,
+                    "points": num_points,
+                    "seconds": round(seconds, 4),
+                    "points_per_second": round(num_points / seconds, 1),
+                }
+            )
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # Adds the baseline's time for the same stage and number of points to each
+    # result, and whether it's more than tolerance (a fraction) slower.
+    baseline_seconds = {(r["stage"], r["points"]): r["seconds"] for r in baseline}
+    for result in results:
+        before = baseline_seconds.get((result["stage"], result["points"]))
+        if before is None:
+            continue
+        result["baseline_seconds"] = before
+        result["regressed"] = result["seconds"] > before * (1 + tolerance)
+    return [r for r in results if r.get("regressed")]
+
+
+def print_results(results, baseline=False):
+    # With a baseline, also shows its times and which stages regressed.
+    headers = ["Stage", "Points", "Seconds", "Points/s"]
+    rows = [
+        [r["stage"], r["points"], r["seconds"], r["points_per_second"]]
+        for r in results
+    ]
+    if baseline:
+        headers += ["Baseline", ""]
+        for row, r in zip(rows, results):
+            row += [
+                r.get("baseline_seconds"),
+                "REGRESSED" if r.get("regressed") else "",
+            ]
+    print(tabulate.tabulate(rows, headers=headers, floatfmt=".3f"))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scales", type=int, nargs="+", default=SCALES)
+    parser.add_argument(
+        "--stages", nargs="+", choices=list(STAGES), default=list(STAGES)
+    )
+    parser.add_argument("--features", type=int, default=20_000)
+    parser.add_argument("--features_per_point", type=float, default=8)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no_limits", action="store_true")
+    parser.add_argument("--output", default="outputs/benchmark.json")
+    parser.add_argument("--baseline", required=False)
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.configure(args)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        different = [
+            f"--{name}={baseline.get(name)}"
+            for name in WORKLOAD_SETTINGS
+            if baseline.get(name) != getattr(args, name)
+        ]
+        if different:
+            parser.error(
+                f"{args.baseline} was run on a different workload"
+                f" ({', '.join(different)})"
+            )
+
+    results = run(
+        args.scales,
+        args.stages,
+        args.features,
+        args.features_per_point,
+        args.repeat,
+        args.seed,
+        limits=not args.no_limits,
+    )
+    regressions = []
+    if baseline is not None:
+        regressions = compare(results, baseline["results"], args.tolerance)
+    print_results(results, baseline is not None)
+
+    with open(args.output, "w") as f:
+        json.dump(
+            {
+                "created": datetime.datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "features": args.features,
+                "features_per_point": args.features_per_point,
+                "seed": args.seed,
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    print(f"Wrote {args.output}")
+
+    if regressions:
+        print(
+            f"Regressions: {len(regressions)} timings are more than"
+            f" {args.tolerance:.0%} slower than {args.baseline}"
+        )
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
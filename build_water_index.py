@@ -0,0 +1,80 @@
+# Builds a water_index.WaterIndex of every water feature in a local extract or
+# feature store, e.g. for the whole state, so that later runs of
+# cache_water_points.py and pipeline.py can use --water_index instead of
+# loading and processing the features themselves.
+
+import argparse
+import sys
+import time
+
+import numpy
+
+import cache_water_points
+import diagnostics
+import feature_sources
+import feature_store
+import metrics
+import water_index
+
+
+@metrics.timed("build_water_index.build")
+def build(source, path, grid_size=water_index.GRID_SIZE_METRES):
+    # Indexes the features of a feature_sources.LocalExtractSource, which have
+    # already been filtered and projected, so the index finds the same
+    # features at the same distances.
+    gdf = source.gdf
+    # The index keeps each feature's OSM element type and ID.
+    missing = [name for name in ["element", "id"] if name not in gdf.index.names]
+    if missing:
+        raise ValueError(f"The features' index has no {' or '.join(missing)} level")
+    labels = gdf.index.to_frame(index=False)
+    strings = {
+        column: gdf[column].tolist() if column in gdf else [None] * len(gdf)
+        for column in water_index.STRING_COLUMNS
+    }
+    water_index.write(
+        path,
+        source.index.geometries,
+        cache_water_points.classify_features(gdf),
+        labels["element"],
+        labels["id"],
+        cache_water_points.feature_flags(gdf),
+        numpy.column_stack(cache_water_points.pools_inside_leisure_centres(gdf)),
+        strings,
+        grid_size,
+    )
+    return len(gdf)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path")
+    parser.add_argument("--osm_extract", required=False)
+    parser.add_argument("--feature_store", required=False)
+    parser.add_argument("--tile_size", type=int, required=False)
+    parser.add_argument("--grid_size", type=int, default=water_index.GRID_SIZE_METRES)
+    metrics.add_arguments(parser)
+    diagnostics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.configure(args)
+    diagnostics.configure(args)
+    if bool(args.osm_extract) == bool(args.feature_store):
+        parser.error("give one of --osm_extract or --feature_store")
+    if args.feature_store and not args.tile_size:
+        parser.error("--feature_store needs the --tile_size it was created with")
+
+    start = time.perf_counter()
+    if args.osm_extract:
+        source = feature_sources.LocalExtractSource.from_file(args.osm_extract)
+    else:
+        store = feature_store.FeatureStore(args.feature_store, args.tile_size)
+        source = feature_sources.LocalExtractSource(store.read_all())
+    count = build(source, args.path, args.grid_size)
+    print(
+        f"Wrote an index of {count} water features to {args.path}"
+        f" in {time.perf_counter() - start:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
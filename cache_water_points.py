@@ -1,15 +1,26 @@
 # Fetches the water features within a large radius and caches them in a csv file.
 
 import argparse
+import asyncio
 import collections
 import sys
 import logging
+import os
+import weakref
 
 import geopandas
-import osmnx
+import numpy
 import pandas
-from shapely.geometry import Point
-
+import shapely
+
+import diagnostics
+import feature_sources
+import feature_store
+import metrics
+import result_cache
+import spatial_index
+import water_features
+import water_index
 import water_tags
 
 # Effectively suppreses warnings so they don't show on the command line
@@ -19,138 +30,193 @@ logging.captureWarnings(True)
 RADIUS_METRES = 500
 OUTPUT_WIDTH = 100
 MAX_ACCURACY_METRES = 111
+CACHE_PATH = "data/cached_water_features.csv"
+
+# The number of points to find features for at once, for sources that can
+# answer many points with one query.
+BATCH_SIZE = 1000
+# How much of the end of the cache file is read at a time when looking for the
+# last complete row.
+TRUNCATE_BLOCK_BYTES = 64 * 1024
 
 _cached_features = None
 
+# Where features are fetched from unless a different source is given.
+_default_source = feature_sources.OverpassSource()
 
-def get_cached_features_near_point(patient_id, radius, max_features=None):
-    global _cached_features
-    if _cached_features is None:
-        _cached_features = pandas.read_csv("data/cached_water_features.csv")
 
-    row = _cached_features[_cached_features["patient_id"] == patient_id]
-    assert len(row) == 1
+@metrics.timed("cache_water_points.load_cached_features")
+def load_cached_features(path=CACHE_PATH):
+    # The cache, indexed by patient_id so each point's features can be looked
+    # up directly.
+    return water_features.read_csv(path).set_index("patient_id")
 
-    row = row.iloc[0]
 
-    relevant_count = 0
-    for i in range(min(row["water_count"], OUTPUT_WIDTH)):
-        relevant_count = i
-        if row[f"water_distance_{i}"] > radius:
-            break
-    
-    if max_features is not None:
-        row = row[: (max_features * 4) + 1]
-        if relevant_count < max_features:
-            # Clear out further away features
-            for i in range(relevant_count + 1, max_features):
-                row[f"water_name_{i}"] = None
-                row[f"water_type_{i}"] = None
-                row[f"water_distance_{i}"] = None
-                row[f"water_lifeguard_{i}"] = None
-    else:
-        row = row[: (relevant_count * 4) + 1]
-
-    row["water_count"] = min(relevant_count, max_features)
-    return row
+def get_cached_features():
+    global _cached_features
+    if _cached_features is None:
+        _cached_features = load_cached_features()
+    return _cached_features
 
 
-def row_to_type(row):
+def get_cached_features_near_point(patient_id, radius, max_features=None):
+    return get_cached_features_near_points([patient_id], radius, max_features)
+
+
+# Looks up the cached features for each of patient_ids, keeping those within
+# the corresponding radius (either one radius for all points, or one per point)
+# and at most the nearest max_features of them. Returns the points' rows in the
+# long format, in the same order as patient_ids. The cache file is used unless
+# another cache (as from load_cached_features) is given.
+@metrics.timed("cache_water_points.get_cached_features_near_points")
+def get_cached_features_near_points(patient_ids, radii, max_features=None, cache=None):
+    if cache is None:
+        cache = get_cached_features()
+    patient_ids = pandas.Index(patient_ids)
+    radii = numpy.broadcast_to(numpy.asarray(radii, dtype=float), (len(patient_ids),))
+    radii = pandas.Series(radii, index=patient_ids)
+
+    rows = cache.loc[patient_ids]
+    keep = rows["water_distance"].to_numpy() <= radii.loc[rows.index].to_numpy()
+    if max_features is not None:
+        keep &= (rows["rank"] < max_features).fillna(False).to_numpy(bool)
+    rows = rows.reset_index()
+    keep = pandas.Series(keep, index=rows.index)
+
+    # Points with nothing in range keep a single row, with the features blanked.
+    no_water = ~keep.groupby(rows["patient_id"]).transform("any") & ~rows[
+        "patient_id"
+    ].duplicated()
+    rows.loc[no_water, water_features.FEATURE_COLUMNS] = None
+    return rows[keep | no_water].reset_index(drop=True)
+
+
+# The rules for classifying features, applied in this order:
+#
+# TYPE_RULES are checked first, and the first whose tags all match gives the
+# type. Otherwise each tag in water_tags.TAGS is checked in turn, with later
+# tags taking precedence: tags in SKIPPED_TAGS are ignored, those in
+# ANY_VALUE_TAGS count whatever their value, and the rest only count with one of
+# the values in water_tags.TAGS. The type is the value formatted with
+# TAG_TYPE_FORMATS (by default the value itself), then any TYPE_CORRECTIONS are
+# applied. Features with none of these tags fall back to FALLBACK_RULES.
+TYPE_RULES = [
     # Special case leisure: sports_centre with sport: swimming -> swimming_pool
-    result = ""
-    if (
-        "leisure" in row
-        and row["leisure"] == "sports_centre"
-        and "sport" in row
-        and row["sport"] == "swimming"
-    ):
-        return "swimming_pool"
-
-    if "emergency" in row and row["emergency"] == "lifeguard":
-        return "lifeguard"
-
+    ({"leisure": "sports_centre", "sport": "swimming"}, "swimming_pool"),
+    ({"emergency": "lifeguard"}, "lifeguard"),
     # Prioritise the man_made tag over others.
-    if "man_made" in row and (
-        row["man_made"] == "breakwater" or row["man_made"] == "pier"
-    ):
-        return row["man_made"]
-
-    if "playground" in row and row["playground"] == "splash_pad":
-        return "splash_pad"
-
-    if "swimming_pool" in row and row["swimming_pool"] == "animal":
-        return "animal_swimming_pool"
-
+    ({"man_made": "breakwater"}, "breakwater"),
+    ({"man_made": "pier"}, "pier"),
+    ({"playground": "splash_pad"}, "splash_pad"),
+    ({"swimming_pool": "animal"}, "animal_swimming_pool"),
     # Fountain/reflecting pool - some specify both, some have only
     # reflecting_pool. Below prioritises fountain if both present.
-    if "amenity" in row:
-        if row["amenity"] == "fountain":
-            return "fountain"
-        if (
-            row["amenity"] == "public_bath"
-            and "leisure" in row
-            and row["leisure"] == "swimming_area"
-        ):
-            return "swimming_area"
-    if "water" in row and row["water"] == "reflecting_pool":
-        return "reflecting_pool"
-
-    for key in water_tags.TAGS:
-        if key not in row or pandas.isna(row[key]):
+    ({"amenity": "fountain"}, "fountain"),
+    ({"amenity": "public_bath", "leisure": "swimming_area"}, "swimming_area"),
+    ({"water": "reflecting_pool"}, "reflecting_pool"),
+]
+
+# Skip these, they will also be tagged with something else. True means any
+# value.
+SKIPPED_TAGS = {"sport": True, "natural": ["water"], "water": ["shallow"]}
+
+ANY_VALUE_TAGS = {"water", "swimming_pool", "animal"}
+
+TAG_TYPE_FORMATS = {"swimming_pool": "swimming_pool", "animal": "animal_{}"}
+
+TYPE_CORRECTIONS = {
+    # Probably a mistake; Curl Curl Lagoon is tagged thus.
+    "lagoon,_lake": "lagoon",
+}
+
+# Infer from the name of the feature if possible. This is not exhaustive,
+# and may need more additions for other data. Some things are tagged with
+# "natural:water" with no other rows.
+FALLBACK_RULES = [
+    ("name_contains", "lake", "lake"),
+    ("sport", "scuba_diving", "scuba_diving"),
+    ("natural", True, "natural:{}"),
+]
+
+
+# The tags that unknown_pool_privacy diagnostics are grouped by.
+PRIVACY_TAGS = ["leisure", "access", "ownership", "sport", "tourism", "swimming_pool"]
+
+
+def _tag_values(gdf, key):
+    if key not in gdf:
+        return pandas.Series(None, index=range(len(gdf)), dtype=object)
+    return pandas.Series(gdf[key].to_numpy(dtype=object))
+
+
+@metrics.timed("cache_water_points.classify_features")
+def classify_features(gdf):
+    # The type of each feature in gdf, as a Series aligned with it.
+    types = numpy.full(len(gdf), "", dtype=object)
+    classified = numpy.zeros(len(gdf), dtype=bool)
+    for tags, feature_type in TYPE_RULES:
+        matches = ~classified
+        for key, value in tags.items():
+            matches &= (_tag_values(gdf, key) == value).to_numpy()
+        types[matches] = feature_type
+        classified |= matches
+
+    for key, values in water_tags.TAGS.items():
+        tag = _tag_values(gdf, key)
+        skipped = SKIPPED_TAGS.get(key)
+        if skipped is True:
             continue
-        if (
-            key == "sport"
-            or (key == "natural" and row[key] == "water")
-            or (key == "water" and row[key] == "shallow")
-        ):
-            # Skip, it will also be tagged with something else.
+        matches = ~classified & tag.notna().to_numpy()
+        if skipped:
+            matches &= ~tag.isin(skipped).to_numpy()
+        if key not in ANY_VALUE_TAGS:
+            matches &= tag.isin(values).to_numpy()
+        if not matches.any():
             continue
-        if key == "swimming_pool":
-            if result != "" and result != "swimming_pool":
-                print(f"multirows detected: have {result}, key {key}")
-                print(row)
-            result = "swimming_pool"
-        elif key == "animal":
-            if result != "":
-                print(f"multirows detected: have {result}, key {key}")
-                print(row)
-            result = f"{key}_{row[key]}"
-        elif key == "water":
-            if result != "":
-                print(f"multirows detected: have {result}, key {key}")
-                print(row)
-            result = row[key]
-        elif row[key] in water_tags.TAGS[key]:
-            if result != "" and result != row[key]:
-                print(f"multirows detected: have {result}, key {key}")
-                print(row)
-            result = row[key]
-
-    # Infer from the name of the feature if possible. This is not exhaustive,
-    # and may need more additions for other data.
-    if (
-        result == ""
-        and "name" in row
-        and pandas.notna(row["name"])
-        and "lake" in row["name"].lower()
-    ):
-        return "lake"
-    if result == "" and "sport" in row and row["sport"] == "scuba_diving":
-        return "scuba_diving"
-    if result == "lagoon,_lake":
-        # Probably a mistake; Curl Curl Lagoon is tagged thus.
-        return "lagoon"
-
-    # Some things are tagged with "natural:water" with no other rows.
-    if result == "" and "natural" in row and pandas.notna(row["natural"]):
-        return f"natural:{row['natural']}"
-    return result
+        type_format = TAG_TYPE_FORMATS.get(key, "{}")
+        tag_types = numpy.array([type_format.format(v) for v in tag[matches]], dtype=object)
+        have = types[matches]
+        conflicts = (have != "") & (have != tag_types)
+        if conflicts.any():
+            labels = gdf.index[numpy.flatnonzero(matches)[conflicts]]
+            for previous in numpy.unique(have[conflicts]):
+                same = have[conflicts] == previous
+                diagnostics.event(
+                    "multirows",
+                    f"have {previous}, key {key}",
+                    labels[same],
+                    count=int(same.sum()),
+                )
+        types[matches] = tag_types
+
+    unclassified = ~classified & (types == "")
+    types[~classified] = [TYPE_CORRECTIONS.get(t, t) for t in types[~classified]]
+    for key, value, feature_type in FALLBACK_RULES:
+        if key == "name_contains":
+            tag = _tag_values(gdf, "name").str.lower()
+            matches = tag.str.contains(value, regex=False).fillna(False)
+        elif value is True:
+            tag = _tag_values(gdf, key)
+            matches = tag.notna()
+        else:
+            tag = _tag_values(gdf, key)
+            matches = tag == value
+        matches = unclassified & matches.to_numpy(dtype=bool)
+        types[matches] = [feature_type.format(v) for v in tag[matches]]
+        unclassified &= ~matches
+
+    return pandas.Series(types, index=gdf.index)
+
+
+def row_to_type(row):
+    return classify_features(row.to_frame().T).iloc[0]
 
 
-# Attempt to infer the privacy of a swimming pool.
+# Attempt to infer the privacy of a swimming pool. Pools it can't be inferred
+# for are recorded in diagnostics.
 # Notable problems include:
 #     - hotel pools without a tourism tag, which have access:customers.
-def infer_pool_privacy(row, display=False):
+def infer_pool_privacy(row):
     access = None
     if "access" in row and pandas.notna(row["access"]):
         access = row["access"]
@@ -219,9 +285,8 @@ def infer_pool_privacy(row, display=False):
     if "water" in row and row["water"] == "stream_pool":
         return "public"
 
-    if display:
-        print(f"Unable to infer pool privacy. Access: {access}; row:")
-        print(row)
+    tags = diagnostics.tag_combination(row, PRIVACY_TAGS)
+    diagnostics.event("unknown_pool_privacy", tags, [row.name])
 
     return None
 
@@ -230,23 +295,21 @@ def pool_type_from_row(row):
     return row["swimming_pool"] if "swimming_pool" in row else None
 
 
-def lifeguard_from_row(row):
+def lifeguards(gdf):
     for key in ["lifeguard", "supervised"]:
-        if key in row:
-            return row[key]
-    return None
+        if key in gdf:
+            return gdf[key].tolist()
+    return [None] * len(gdf)
 
 
 def calc_distance_to_point(gdf, lat, lng):
-    # EPSG 3308 is a NSW-specific projection that corresponds to GDA94 Lambert.
-    # https://www.spatial.nsw.gov.au/surveying/geodesy/projections
-    # Point(x, y) -> Point(lng, lat)
-    point = geopandas.GeoSeries([Point(lng, lat)], crs=gdf.crs).to_crs(epsg=3308)
-
-    def distance_to_point(geometry):
-        return geometry.distance(point).round(2)
-
-    gdf["distance"] = gdf.to_crs(epsg=3308)["geometry"].apply(distance_to_point)
+    # Distances are measured in spatial_index.DISTANCE_CRS, a NSW-specific
+    # projection in metres.
+    point = spatial_index.project_points([lat], [lng])[0]
+    geometries = spatial_index.project_geometries(gdf.geometry.to_numpy(), gdf.crs)
+    gdf[spatial_index.DISTANCE_COLUMN] = numpy.round(
+        shapely.distance(geometries, point), 2
+    )
 
 
 def latlng_accuracy(lat, lng):
@@ -261,29 +324,44 @@ def latlng_accuracy(lat, lng):
     return 111000 / pow(10, accuracy - 1)
 
 
-def dedupe_pools_inside_leisure_centre(gdf):
-    # Dedupe swimming pools and buildings inside leisure centres.
+def pools_inside_leisure_centres(gdf):
+    # Positions of the swimming pools and buildings inside sports centres, and
+    # of the sports centres they're in, as two arrays of pairs.
+    none = (numpy.array([], dtype=int), numpy.array([], dtype=int))
     # Find pools:
     if "leisure" not in gdf:
         # No leisure centre.
-        return gdf
+        return none
     mask = gdf["leisure"] == "swimming_pool"
     if "building" in gdf:
         mask = mask | (gdf["building"] == "yes")
-    pools_or_buildings = gdf[mask]
-    sports_centres = gdf[gdf["leisure"] == "sports_centre"]
-    to_delete = []
-    for i in range(len(sports_centres)):
-        sports_centre = sports_centres.iloc[i]
-        for j in range(len(pools_or_buildings)):
-            p = pools_or_buildings.iloc[j]
-            # Check the pool or building isn't the sports_centre itself.
-            if sports_centre.equals(p):
-                continue
-            if p.geometry.within(sports_centre.geometry):
-                to_delete.append(pools_or_buildings.index[j])
-    if len(to_delete) > 0:
-        return gdf.drop(index=to_delete)
+    mask = mask.to_numpy(dtype=bool)
+    is_sports_centre = (gdf["leisure"] == "sports_centre").to_numpy(dtype=bool)
+    if not mask.any() or not is_sports_centre.any():
+        return none
+
+    # Join on positions, as labels needn't be unique.
+    pools_or_buildings = geopandas.GeoDataFrame(
+        {"position": numpy.flatnonzero(mask)},
+        geometry=gdf.geometry.to_numpy()[mask],
+        crs=gdf.crs,
+    )
+    sports_centres = geopandas.GeoDataFrame(
+        {"position": numpy.flatnonzero(is_sports_centre)},
+        geometry=gdf.geometry.to_numpy()[is_sports_centre],
+        crs=gdf.crs,
+    )
+    inside = geopandas.sjoin(pools_or_buildings, sports_centres, predicate="within")
+    # Check the pool or building isn't the sports_centre itself.
+    inside = inside[inside["position_left"] != inside["position_right"]]
+    return inside["position_left"].to_numpy(), inside["position_right"].to_numpy()
+
+
+def dedupe_pools_inside_leisure_centre(gdf):
+    # Dedupe swimming pools and buildings inside leisure centres.
+    inside, _ = pools_inside_leisure_centres(gdf)
+    if len(inside) > 0:
+        return gdf.drop(index=gdf.index[numpy.unique(inside)])
     return gdf
 
 
@@ -300,34 +378,16 @@ def dedupe_beach_coastline_gdf(gdf):
     return gdf.drop(index=coastline.index)
 
 
-def find_water_near_point(lat, lng, radius):
-    accuracy = latlng_accuracy(lat, lng)
-    if accuracy > MAX_ACCURACY_METRES:
-        return None
-
-    try:
-        gdf = osmnx.features.features_from_point(
-            (lat, lng),
-            water_tags.TAGS,
-            dist=radius,
-        )
-    except osmnx.features.InsufficientResponseError:
-        return None
-
-    gdf = dedupe_pools_inside_leisure_centre(gdf)
-    gdf = dedupe_beach_coastline_gdf(gdf)
-
-    # Remove clubs except lifesaving
+# Remove clubs except lifesaving.
+def remove_clubs(gdf):
     if "club" in gdf:
         clubs = gdf[gdf["club"].notna() & (gdf["club"] != "surf_life_saving")]
         gdf = gdf.drop(index=clubs.index)
+    return gdf
 
-    # Dedupe Port Jackson / other things in and around Sydney Harbour.
-    if "name" in gdf and len(gdf) > 1:
-        port_jackson = gdf[gdf["name"] == "Port Jackson"]
-        gdf = gdf.drop(index=port_jackson.index)
 
-    # Remove covered reservoirs, pipelines, and storage tanks that do not hold water.
+# Remove covered reservoirs, pipelines, and storage tanks that do not hold water.
+def remove_dry_man_made(gdf):
     if "man_made" in gdf:
         covered_man_made = gdf[
             (gdf["man_made"] == "reservoir_covered") | (gdf["man_made"] == "pipeline")
@@ -349,79 +409,651 @@ def find_water_near_point(lat, lng, radius):
                 & ~(gdf["location"].isna() | (gdf["location"] == "underground"))
             ]
             gdf = gdf.drop(index=underground_tanks.index)
+    return gdf
+
+
+def find_water_near_point(lat, lng, radius, source=None):
+    accuracy = latlng_accuracy(lat, lng)
+    if accuracy > MAX_ACCURACY_METRES:
+        return None
+
+    if source is None:
+        source = _default_source
+    return process_features(source.features_near_point(lat, lng, radius), lat, lng)
+
+
+# Removes duplicate and irrelevant features from those found near a point, and
+# calculates their distance from it.
+@metrics.timed("cache_water_points.process_features")
+def process_features(gdf, lat, lng):
+    if gdf is None:
+        return None
+
+    gdf = dedupe_pools_inside_leisure_centre(gdf)
+    gdf = dedupe_beach_coastline_gdf(gdf)
+
+    gdf = remove_clubs(gdf)
+
+    # Dedupe Port Jackson / other things in and around Sydney Harbour.
+    if "name" in gdf and len(gdf) > 1:
+        port_jackson = gdf[gdf["name"] == "Port Jackson"]
+        gdf = gdf.drop(index=port_jackson.index)
+
+    gdf = remove_dry_man_made(gdf)
 
-    calc_distance_to_point(gdf, lat, lng)
+    # Sources that measure the distances themselves have already added them.
+    if spatial_index.DISTANCE_COLUMN not in gdf:
+        calc_distance_to_point(gdf, lat, lng)
 
     return gdf
 
 
-def find_water_near_points(in_data, radius):
-    gdfs = collections.defaultdict(list)
-    for idx in in_data.index:
+def removed_by(rule, gdf):
+    # Which features in gdf the rule (e.g. remove_clubs) removes. Every feature
+    # is judged on its own tags, so this is the same whichever features are
+    # near a point.
+    positions = gdf.reset_index(drop=True)
+    kept = rule(positions).index
+    return ~positions.index.isin(kept)
+
+
+def tag_is(gdf, key, value):
+    if key not in gdf:
+        return numpy.zeros(len(gdf), dtype=bool)
+    return (gdf[key] == value).to_numpy(dtype=bool)
+
+
+def feature_flags(gdf):
+    # An array with a column for each of water_index.FLAGS.
+    flags = {
+        "beach": tag_is(gdf, "natural", "beach"),
+        "coastline": tag_is(gdf, "natural", "coastline"),
+        "club": removed_by(remove_clubs, gdf),
+        "port_jackson": tag_is(gdf, "name", "Port Jackson"),
+        "dry_man_made": removed_by(remove_dry_man_made, gdf),
+    }
+    return numpy.column_stack([flags[flag] for flag in water_index.FLAGS])
+
+
+# The features of a feature_sources.LocalExtractSource, classified and flagged
+# for process_features' rules once, as build_water_index.py does for a
+# water_index.WaterIndex. Each batch of points then only needs its features
+# and their distances from the source's index.
+class ClassifiedExtract(water_index.ClassifiedFeatures):
+    @metrics.timed("cache_water_points.classify_extract")
+    def __init__(self, source):
+        gdf = source.gdf
+        self.source = source
+        type_names, self.types = numpy.unique(
+            numpy.asarray(classify_features(gdf), dtype=str), return_inverse=True
+        )
+        self.type_names = type_names.astype(object)
+        flags = feature_flags(gdf)
+        self.flags = {flag: flags[:, i] for i, flag in enumerate(water_index.FLAGS)}
+        inside, outside = pools_inside_leisure_centres(gdf)
+        order = numpy.argsort(inside, kind="stable")
+        self.within_inner = inside[order]
+        self.within_outer = outside[order]
+        self.strings = {
+            column: gdf[column].to_numpy() if column in gdf else [None] * len(gdf)
+            for column in water_index.STRING_COLUMNS
+        }
+        self.present = {
+            column: numpy.array([isinstance(v, str) for v in values], dtype=bool)
+            for column, values in self.strings.items()
+        }
+
+    def __len__(self):
+        return len(self.types)
+
+    def string(self, column, positions):
+        present = self.present[column][positions]
+        values = self.strings[column]
+        return [
+            values[p] if is_present else None
+            for p, is_present in zip(positions, present)
+        ]
+
+    def query_points(self, lats, lngs, radius):
+        pairs = self.source.index.query_points(lats, lngs, radius)
+        return (
+            pairs["point"].to_numpy(),
+            pairs["feature"].to_numpy(),
+            pairs["distance"].to_numpy(),
+        )
+
+
+# Each extract or tile's ClassifiedExtract, made the first time it's used and
+# dropped along with it.
+_classified = weakref.WeakKeyDictionary()
+
+
+def classified(source):
+    if source not in _classified:
+        _classified[source] = ClassifiedExtract(source)
+    return _classified[source]
+
+
+# Each point's values of water_features.WATER_COLUMNS, in order of distance,
+# from a water_index.WaterIndex or a local source's classified features.
+def find_water_fields(source, lats, lngs, radius):
+    lats = numpy.asarray(lats, dtype=float)
+    lngs = numpy.asarray(lngs, dtype=float)
+    if isinstance(source, water_index.WaterIndex):
+        return source.water_fields(lats, lngs, radius)
+    if isinstance(source, feature_sources.LocalExtractSource):
+        return classified(source).water_fields(lats, lngs, radius)
+
+    result = [{col: [] for col in water_features.WATER_COLUMNS}] * len(lats)
+    for tile, positions in source.iter_tiles(lats, lngs):
+        fields = classified(tile).water_fields(lats[positions], lngs[positions], radius)
+        for position, point_fields in zip(positions, fields):
+            result[position] = point_fields
+    return result
+
+
+# Yields (index, (patient_id, (lat, lng)), gdf) for each point in in_data as
+# its features are found. When using a TiledSource the points are visited tile
+# by tile, so they may not be in the same order as the input.
+def iter_water_near_points(in_data, radius, source=None):
+    indexes = in_data.index
+    if isinstance(source, feature_sources.TiledSource):
+        # Visit the points tile by tile so each tile is only fetched once.
+        order = source.sort_by_tile(
+            in_data["Pickup_Latitude"].fillna(0), in_data["Pickup_Longitude"].fillna(0)
+        )
+        indexes = indexes[order]
+
+    if isinstance(source, (feature_sources.LocalExtractSource, feature_sources.TiledSource)):
+        # These sources can find the features near a whole batch of points,
+        # and their distances, in one go.
+        for start in range(0, len(indexes), BATCH_SIZE):
+            batch = in_data.loc[indexes[start : start + BATCH_SIZE]]
+            yield from _iter_water_near_batch(batch, radius, source)
+        return
+
+    for idx in indexes:
         patient_id = in_data.at[idx, "patient_id"]
         lat = in_data.at[idx, "Pickup_Latitude"]
         lng = in_data.at[idx, "Pickup_Longitude"]
         if pandas.isna(lat) or pandas.isna(lng):
-            gdfs[(patient_id, (lat, lng))] = None
+            yield idx, (patient_id, (lat, lng)), None
         else:
-            print(f"Finding water for {patient_id} near {lat},{lng}")
-            gdfs[(patient_id, (lat, lng))] = find_water_near_point(lat, lng, radius)
+            if diagnostics.show_progress:
+                print(f"Finding water for {patient_id} near {lat},{lng}")
+            gdf = find_water_near_point(lat, lng, radius, source=source)
+            yield idx, (patient_id, (lat, lng)), gdf
+
+
+# Whether each point has a location accurate enough to look for water near.
+def is_queryable(lats, lngs):
+    return [
+        pandas.notna(lat)
+        and pandas.notna(lng)
+        and latlng_accuracy(lat, lng) <= MAX_ACCURACY_METRES
+        for lat, lng in zip(lats, lngs)
+    ]
+
+
+def _iter_water_near_batch(batch, radius, source):
+    lats = batch["Pickup_Latitude"]
+    lngs = batch["Pickup_Longitude"]
+    to_query = is_queryable(lats, lngs)
+    gdfs = source.features_near_points(lats[to_query], lngs[to_query], radius)
+    found = dict(zip(batch.index[to_query], gdfs))
+
+    for idx in batch.index:
+        patient_id = batch.at[idx, "patient_id"]
+        lat = batch.at[idx, "Pickup_Latitude"]
+        lng = batch.at[idx, "Pickup_Longitude"]
+        if pandas.isna(lat) or pandas.isna(lng):
+            yield idx, (patient_id, (lat, lng)), None
+        else:
+            if diagnostics.show_progress:
+                print(f"Finding water for {patient_id} near {lat},{lng}")
+            gdf = process_features(found.get(idx), lat, lng)
+            yield idx, (patient_id, (lat, lng)), gdf
+
+
+def find_water_near_points(in_data, radius, source=None):
+    results = {}
+    for idx, key, gdf in iter_water_near_points(in_data, radius, source=source):
+        results[idx] = (key, gdf)
+
+    # Return the results in the same order as the input.
+    gdfs = collections.defaultdict(list)
+    for idx in in_data.index:
+        key, gdf = results[idx]
+        gdfs[key] = gdf
     return gdfs
 
 
-def output_row(patient_id, latlng, gdf, out_data):
-    out_data["patient_id"].append(patient_id)
+# The cache rows, in the long format, for the features found near a point.
+@metrics.timed("cache_water_points.point_rows")
+def point_rows(patient_id, latlng, gdf):
+    water_fields = {col: [] for col in water_features.WATER_COLUMNS}
+    if gdf is not None:
+        gdf = gdf.sort_values(by=spatial_index.DISTANCE_COLUMN)
+        if len(gdf) > OUTPUT_WIDTH:
+            diagnostics.event("longer_than_output_width", samples=[patient_id])
+            metrics.count("points.truncated")
+            gdf = gdf.head(OUTPUT_WIDTH)
+        water_fields["water_name"] = (
+            gdf["name"].tolist() if "name" in gdf else [None] * len(gdf)
+        )
+        water_fields["water_type"] = classify_features(gdf).tolist()
+        water_fields["water_distance"] = gdf[spatial_index.DISTANCE_COLUMN].tolist()
+        water_fields["water_lifeguard"] = lifeguards(gdf)
+    return water_rows(patient_id, latlng, water_fields)
+
+
+# The cache rows for a point and lists of its features' values of
+# water_features.WATER_COLUMNS.
+def water_rows(patient_id, latlng, water_fields):
+    point = {"patient_id": patient_id}
     if pandas.isna(latlng[0]) or pandas.isna(latlng[1]):
-        out_data["accuracy_metres"].append(None)
-    else:
-        out_data["accuracy_metres"].append(latlng_accuracy(latlng[0], latlng[1]))
-    if gdf is None:
-        out_data["water_count"].append(0)
+        point["accuracy_metres"] = None
     else:
-        gdf = gdf.sort_values(by="distance")
-        if len(gdf) > OUTPUT_WIDTH:
-            print(f"gdf is longer than OUTPUT_WIDTH: {len(gdf)}")
-        out_data["water_count"].append(len(gdf))
-
-    for i in range(OUTPUT_WIDTH):
-        if gdf is not None and i < len(gdf):
-            row = gdf.iloc[i]
-            name = row["name"] if "name" in row else None
-            feature_type = row_to_type(row)
-
-            out_data[f"water_name_{i}"].append(name)
-            out_data[f"water_type_{i}"].append(feature_type)
-            out_data[f"water_distance_{i}"].append(row["distance"])
-            out_data[f"water_lifeguard_{i}"].append(lifeguard_from_row(row))
-        else:
-            out_data[f"water_name_{i}"].append(None)
-            out_data[f"water_type_{i}"].append(None)
-            out_data[f"water_distance_{i}"].append(None)
-            out_data[f"water_lifeguard_{i}"].append(None)
+        point["accuracy_metres"] = latlng_accuracy(latlng[0], latlng[1])
+    count = len(water_fields["water_type"])
+    metrics.count("points")
+    metrics.observe("features_per_point", count)
+    if count == 0:
+        metrics.count("points.no_water")
+    return water_features.feature_rows(point, water_fields)
+
+
+# Yields the cache rows for each point in latlngs, in order, from a source
+# find_water_fields can use, whose features are classified and filtered once
+# rather than for every point.
+def iter_classified_rows(latlngs, source):
+    no_water = {col: [] for col in water_features.WATER_COLUMNS}
+    for start in range(0, len(latlngs), BATCH_SIZE):
+        batch = latlngs.iloc[start : start + BATCH_SIZE]
+        lats = batch["Pickup_Latitude"]
+        lngs = batch["Pickup_Longitude"]
+        to_query = is_queryable(lats, lngs)
+        fields = find_water_fields(
+            source, lats[to_query], lngs[to_query], RADIUS_METRES
+        )
+        found = dict(zip(batch.index[to_query], fields))
+
+        points = zip(batch.index, batch["patient_id"], lats, lngs)
+        for idx, patient_id, lat, lng in points:
+            if diagnostics.show_progress and pandas.notna(lat) and pandas.notna(lng):
+                print(f"Finding water for {patient_id} near {lat},{lng}")
+            water_fields = found.get(idx, no_water)
+            count = len(water_fields["water_type"])
+            if count > OUTPUT_WIDTH:
+                diagnostics.event("longer_than_output_width", samples=[patient_id])
+                metrics.count("points.truncated")
+                water_fields = {c: v[:OUTPUT_WIDTH] for c, v in water_fields.items()}
+            yield water_rows(patient_id, (lat, lng), water_fields)
 
 
 def write_csv(path, gdfs):
-    output = collections.defaultdict(list)
-    for (patient_id, latlng) in gdfs:
-        output_row(patient_id, latlng, gdfs[(patient_id, latlng)], output)
-    pandas.DataFrame(output).set_index("patient_id").to_csv(path)
+    rows = []
+    for (patient_id, latlng), gdf in gdfs.items():
+        rows.extend(point_rows(patient_id, latlng, gdf))
+    water_features.write_csv(pandas.DataFrame(rows), path)
+
+
+# Appends points' rows to a cache file in batches, so a crash or Overpass
+# outage only loses the points in the current batch. Rows are added to the end
+# of an existing file without rewriting it.
+class CacheWriter:
+    def __init__(self, path, batch_size=1):
+        self.path = path
+        self.batch_size = batch_size
+        self.rows = []
+        self.points = 0
+        self.points_written = 0
+        truncate_partial_line(path)
+        self.write_header = not os.path.exists(path) or os.path.getsize(path) == 0
+        # The columns of the rows already in the file. Added rows are written
+        # with the same columns, e.g. when merging a cache with other columns.
+        self.columns = None
+        if not self.write_header:
+            header = pandas.read_csv(path, nrows=0)
+            if water_features.is_wide(header):
+                print(f"Converting {path} to the long format")
+                # Written alongside and swapped in, so an interrupted
+                # conversion leaves the wide file as it was.
+                tmp_path = f"{path}.tmp"
+                water_features.write_csv(water_features.read_csv(path), tmp_path)
+                os.replace(tmp_path, path)
+                header = pandas.read_csv(path, nrows=0)
+            self.columns = list(header.columns)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        # Keep whatever was completed, even if the run failed.
+        self.flush()
+
+    def add(self, rows):
+        # Adds the rows for one point.
+        self.rows.extend(rows)
+        self.points += 1
+        if self.points >= self.batch_size:
+            self.flush()
+
+    @metrics.timed("cache_water_points.flush_cache")
+    def flush(self):
+        if len(self.rows) == 0:
+            return
+        with open(self.path, "a", newline="") as f:
+            water_features.write_csv(
+                pandas.DataFrame(self.rows, columns=self.columns),
+                f,
+                header=self.write_header,
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        self.write_header = False
+        self.points_written += self.points
+        self.rows = []
+        self.points = 0
+
+
+def truncate_partial_line(path):
+    # Removes a partly written last row, e.g. if the process was killed while
+    # writing.
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return
+    with open(path, "rb+") as f:
+        end = f.seek(-1, os.SEEK_END) + 1
+        if f.read(1) == b"\n":
+            return
+        # Read back from the end, a block at a time, to the last newline.
+        while end > 0:
+            start = max(0, end - TRUNCATE_BLOCK_BYTES)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b"\n")
+            if newline >= 0:
+                f.truncate(start + newline + 1)
+                return
+            end = start
+        f.truncate(0)
+
+
+def cached_patient_ids(path):
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return set()
+    truncate_partial_line(path)
+    return set(pandas.read_csv(path, usecols=["patient_id"])["patient_id"])
+
+
+# Adds the points in another cache file that aren't already in the cache at
+# path to the end of it.
+def merge_cache(path, other_path, batch_size):
+    existing = cached_patient_ids(path)
+    other = water_features.read_csv(other_path)
+    new_rows = other[~other["patient_id"].isin(existing)]
+    with CacheWriter(path, batch_size) as writer:
+        for _, rows in new_rows.groupby("patient_id", sort=False):
+            writer.add(rows.to_dict("records"))
+    print(
+        f"Added {new_rows['patient_id'].nunique()} of "
+        f"{other['patient_id'].nunique()} points from {other_path}"
+    )
+
+
+# Like find_water_near_points, but with up to `concurrency` Overpass requests
+# in flight at once. Each point's features are post-processed and converted
+# to an output row as soon as they arrive, while later requests are still
+# waiting on the server. Returns the rows in the same order as the input, or
+# if on_point is given, calls it with each point's rows as they complete
+# instead.
+def find_water_near_points_concurrently(in_data, radius, concurrency, on_point=None):
+    # Only needed for concurrent fetching.
+    import overpass_async
+
+    async def find_water(client, idx, rows):
+        patient_id = in_data.at[idx, "patient_id"]
+        lat = in_data.at[idx, "Pickup_Latitude"]
+        lng = in_data.at[idx, "Pickup_Longitude"]
+        gdf = None
+        if pandas.notna(lat) and pandas.notna(lng):
+            if latlng_accuracy(lat, lng) <= MAX_ACCURACY_METRES:
+                gdf = await client.features_near_point(lat, lng, radius)
+            if diagnostics.show_progress:
+                print(f"Found water for {patient_id} near {lat},{lng}")
+            gdf = process_features(gdf, lat, lng)
+        point = point_rows(patient_id, (lat, lng), gdf)
+        if on_point is None:
+            rows[idx] = point
+        else:
+            on_point(point)
+
+    async def worker(client, indexes, rows):
+        for idx in indexes:
+            await find_water(client, idx, rows)
+
+    async def find_all():
+        rows = {}
+        # The workers share one iterator, so each point is only fetched once.
+        indexes = iter(in_data.index)
+        async with overpass_async.AsyncOverpassClient(concurrency) as client:
+            await asyncio.gather(
+                *[worker(client, indexes, rows) for _ in range(concurrency)]
+            )
+        print(f"Made {client.requests} requests with {client.retries} retries")
+        if on_point is None:
+            return [row for idx in in_data.index for row in rows[idx]]
+
+    return asyncio.run(find_all())
+
+
+def make_source(
+    osm_extract=None, tile_size=None, feature_store_path=None, water_index_path=None
+):
+    if water_index_path:
+        index = water_index.WaterIndex(water_index_path)
+        print(f"Opened an index of {len(index)} water features at {water_index_path}")
+        return index
+    source = _default_source
+    if osm_extract:
+        source = feature_sources.LocalExtractSource.from_file(osm_extract)
+    if tile_size:
+        store = None
+        if feature_store_path:
+            store = feature_store.FeatureStore(feature_store_path, tile_size)
+            print(f"{len(store)} tiles already in {feature_store_path}")
+        source = feature_sources.TiledSource(
+            source, tile_size, RADIUS_METRES, store=store
+        )
+    return source
+
+
+# Finds the water near each point in latlngs, passing each point's rows to
+# on_point as they are found. Points are looked up concurrently from Overpass
+# if concurrency is given, or from source otherwise.
+def find_point_rows(latlngs, on_point, source=None, concurrency=None):
+    if concurrency:
+        find_water_near_points_concurrently(
+            latlngs, RADIUS_METRES, concurrency, on_point=on_point
+        )
+        return
+
+    # These sources' features are classified once, rather than for each point.
+    # A TiledSource's tiles only cover its own radius around their points.
+    is_classified = isinstance(
+        source, (water_index.WaterIndex, feature_sources.LocalExtractSource)
+    ) or (
+        isinstance(source, feature_sources.TiledSource)
+        and source.radius >= RADIUS_METRES
+    )
+    if is_classified and isinstance(source, feature_sources.TiledSource):
+        # Visit the points tile by tile so each tile is only fetched once.
+        order = source.sort_by_tile(
+            latlngs["Pickup_Latitude"].fillna(0), latlngs["Pickup_Longitude"].fillna(0)
+        )
+        latlngs = latlngs.iloc[order]
+
+    if is_classified:
+        for rows in iter_classified_rows(latlngs, source):
+            on_point(rows)
+    else:
+        points = iter_water_near_points(latlngs, RADIUS_METRES, source=source)
+        for _, (patient_id, latlng), gdf in points:
+            on_point(point_rows(patient_id, latlng, gdf))
+    if isinstance(source, feature_sources.TiledSource):
+        print(
+            f"Fetched {source.tiles_fetched} tiles and loaded {source.tiles_loaded}"
+            f" from the feature store for {len(latlngs)} points"
+        )
+
+
+# As find_point_rows, but only looks up one point at each location that isn't
+# already in the result cache; the other points reuse its results. Points are
+# passed to on_point in the order of latlngs.
+def find_point_rows_with_cache(latlngs, on_point, results, **kwargs):
+    lats = latlngs["Pickup_Latitude"]
+    lngs = latlngs["Pickup_Longitude"]
+    patient_ids = latlngs["patient_id"].to_numpy()
+    # Points too inaccurate to look up have no water wherever they are, so
+    # they aren't cached.
+    cacheable = pandas.Series(is_queryable(lats, lngs), index=latlngs.index, dtype=bool)
+    locations = pandas.Series(
+        [
+            result_cache.location_key(lat, lng) if c else None
+            for lat, lng, c in zip(lats, lngs, cacheable)
+        ],
+        index=latlngs.index,
+    )
+    in_cache = locations.isin(list(results.results))
+    repeat = cacheable & (in_cache | locations.duplicated())
+
+    # The positions of the points that are looked up, by patient_id, as the
+    # rows found only say which patient_id they're for.
+    lookups = collections.defaultdict(collections.deque)
+    for position in numpy.flatnonzero(~repeat.to_numpy()):
+        lookups[patient_ids[position]].append(position)
+    # Rows found for points whose earlier points aren't done yet (concurrent
+    # lookups finish in any order), by position.
+    found = {}
+    next_position = 0
+
+    def pass_on_ready():
+        # Passes on the points from next_position up to the first one that
+        # hasn't been found. A repeat location's first point comes before it,
+        # so is in the result cache by then.
+        nonlocal next_position
+        while next_position < len(latlngs):
+            if repeat.iat[next_position]:
+                lat = lats.iat[next_position]
+                lng = lngs.iat[next_position]
+                point = {
+                    "patient_id": patient_ids[next_position],
+                    "accuracy_metres": latlng_accuracy(lat, lng),
+                }
+                on_point([{**point, **feature} for feature in results.get(lat, lng)])
+            elif next_position in found:
+                on_point(found.pop(next_position))
+            else:
+                return
+            next_position += 1
+
+    def on_found(rows):
+        position = lookups[rows[0]["patient_id"]].popleft()
+        if cacheable.iat[position]:
+            results.add(lats.iat[position], lngs.iat[position], rows)
+        found[position] = rows
+        pass_on_ready()
+
+    find_point_rows(latlngs[~repeat], on_found, **kwargs)
+    pass_on_ready()
+    print(f"Result cache: {results.hits} hits, {results.misses} misses")
+
+
+# Finds the water near each point in latlngs and returns the rows that would be
+# cached for them, without writing the cache file.
+@metrics.timed("cache_water_points.find_features")
+def find_features(latlngs, source=None, concurrency=None, results=None):
+    rows = []
+    if results is None:
+        find_point_rows(latlngs, rows.extend, source=source, concurrency=concurrency)
+    else:
+        find_point_rows_with_cache(
+            latlngs, rows.extend, results, source=source, concurrency=concurrency
+        )
+    features = pandas.DataFrame(rows).astype({"rank": "Int64"})
+    return features.set_index("patient_id")
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("filename")
     parser.add_argument("--limit_points", type=int, required=False)
+    parser.add_argument("--osm_extract", required=False)
+    parser.add_argument("--tile_size", type=int, required=False)
+    parser.add_argument("--feature_store", required=False)
+    parser.add_argument("--concurrency", type=int, required=False)
+    parser.add_argument("--resume", action="store_true")
+    parser.add_argument("--merge", action="store_true")
+    parser.add_argument("--checkpoint_every", type=int, default=100)
+    parser.add_argument("--result_cache", required=False)
+    parser.add_argument("--water_index", required=False)
+    metrics.add_arguments(parser)
+    diagnostics.add_arguments(parser)
     args = parser.parse_args()
+    metrics.configure(args)
+    diagnostics.configure(args)
+    if args.concurrency and (args.osm_extract or args.tile_size):
+        parser.error("--concurrency only applies to per-point Overpass queries")
+    if args.feature_store and not args.tile_size:
+        parser.error("--feature_store stores tiles, so needs --tile_size")
+    if args.water_index and (
+        args.osm_extract or args.tile_size or args.feature_store or args.concurrency
+    ):
+        parser.error("--water_index is used instead of the other source options")
+
+    if args.merge:
+        merge_cache(CACHE_PATH, args.filename, args.checkpoint_every)
+        return
 
     print("Regenerating cached water features")
-    # osmnx.settings.use_cache = False
 
     latlngs = pandas.read_csv(args.filename)
+    # A fresh run is written next to the cache and replaces it when it
+    # finishes, so the old cache is kept until then.
+    tmp_path = CACHE_PATH + ".tmp"
+    if args.resume:
+        # Continue an interrupted fresh run if there is one.
+        path = tmp_path if os.path.exists(tmp_path) else CACHE_PATH
+        cached = latlngs["patient_id"].isin(cached_patient_ids(path))
+        print(f"Skipping {cached.sum()} points already in {path}")
+        latlngs = latlngs[~cached]
+    else:
+        path = tmp_path
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
     if args.limit_points and args.limit_points < len(latlngs):
         latlngs = latlngs.head(args.limit_points)
 
-    gdfs = find_water_near_points(latlngs, RADIUS_METRES)
-    write_csv("data/cached_water_features.csv", gdfs)
+    source = None
+    if not args.concurrency:
+        source = make_source(
+            args.osm_extract, args.tile_size, args.feature_store, args.water_index
+        )
+    with CacheWriter(path, args.checkpoint_every) as writer:
+        if args.result_cache:
+            with result_cache.ResultCache(args.result_cache, RADIUS_METRES) as results:
+                find_point_rows_with_cache(
+                    latlngs,
+                    writer.add,
+                    results,
+                    source=source,
+                    concurrency=args.concurrency,
+                )
+        else:
+            find_point_rows(
+                latlngs, writer.add, source=source, concurrency=args.concurrency
+            )
+    if path == tmp_path:
+        os.replace(tmp_path, CACHE_PATH)
 
 
 if __name__ == "__main__":
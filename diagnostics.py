@@ -0,0 +1,114 @@
+# Collects the oddities noticed while processing, e.g. features whose tags give
+# them more than one type ("multirows"), swimming pools whose privacy can't be
+# inferred, or points with more water than fits in the output, instead of
+# printing each one as it happens. Events are counted by kind and key (e.g.
+# the tag combination), with a few sample osmids or patient_ids of each, and
+# summarised when the script exits.
+#
+# --diagnostics=path also writes the full report as JSON. --quiet turns off
+# the per-point progress lines ("Finding water for ..."), which callers check
+# show_progress for before formatting them.
+
+import atexit
+import collections
+import json
+import os
+import sys
+
+# The number of samples kept for each kind and key.
+MAX_SAMPLES = 10
+# The number of keys of each kind printed in the summary.
+SUMMARY_KEYS = 5
+
+# Whether to print a line for each point processed.
+show_progress = True
+
+# kind: {key: [count, samples]}
+_events = collections.defaultdict(dict)
+
+
+def event(kind, key="", samples=(), count=1):
+    # Records count occurrences of an event. samples (e.g. the osmids of the
+    # features involved, as in the gdf index, or patient_ids) are only looked
+    # at until MAX_SAMPLES distinct ones have been kept.
+    e = _events[kind].get(key)
+    if e is None:
+        e = _events[kind][key] = [0, []]
+    e[0] += count
+    kept = e[1]
+    for sample in samples:
+        if len(kept) >= MAX_SAMPLES:
+            break
+        sample = _sample(sample)
+        if sample not in kept:
+            kept.append(sample)
+
+
+def _sample(value):
+    # osmids in a gdf index are (element, id) tuples.
+    if isinstance(value, tuple) and len(value) == 2:
+        return f"{value[0]}/{value[1]}"
+    return str(value)
+
+
+def tag_combination(row, keys):
+    # e.g. "leisure=swimming_pool;access=customers", for the keys row has.
+    return ";".join(
+        f"{key}={row[key]}" for key in keys if key in row and not _isna(row[key])
+    )
+
+
+def _isna(value):
+    return value is None or value != value
+
+
+def report():
+    return {
+        "script": os.path.basename(sys.argv[0]),
+        "events": {
+            kind: [
+                {"key": key, "count": count, "samples": samples}
+                for key, (count, samples) in sorted(
+                    keys.items(), key=lambda item: -item[1][0]
+                )
+            ]
+            for kind, keys in sorted(_events.items())
+        },
+    }
+
+
+def print_summary(r):
+    for kind, keys in r["events"].items():
+        total = sum(k["count"] for k in keys)
+        print(f"{kind}: {total} events, {len(keys)} distinct")
+        for k in keys[:SUMMARY_KEYS]:
+            label = f"{k['key']}: " if k["key"] != "" else ""
+            print(f"    {label}{k['count']} (e.g. {', '.join(k['samples'][:3])})")
+        if len(keys) > SUMMARY_KEYS:
+            print(f"    ... and {len(keys) - SUMMARY_KEYS} more")
+
+
+def write(path):
+    r = report()
+    with open(path, "w") as f:
+        json.dump(r, f, indent=2)
+    print(f"Wrote diagnostics to {path}")
+
+
+def _finish(path):
+    if path:
+        write(path)
+    print_summary(report())
+
+
+def add_arguments(parser):
+    parser.add_argument("--diagnostics", required=False)
+    parser.add_argument("--quiet", action="store_true")
+
+
+def configure(args):
+    # Arranges for the events to be summarised (and written to the
+    # --diagnostics report) when the script exits.
+    global show_progress
+    show_progress = not args.quiet
+    atexit.register(_finish, args.diagnostics)
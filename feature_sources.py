@@ -0,0 +1,304 @@
+# Sources of OSM water features. Each source answers the same question,
+# "which water features are near this point?", and returns a GeoDataFrame in
+# the same shape as osmnx.features (multi-indexed by element type and OSM ID,
+# with one column per tag), or None if nothing was found. Sources that hold
+# their features in memory also fill in their distances, in metres, in
+# spatial_index.DISTANCE_COLUMN.
+#
+# OverpassSource queries the live Overpass API for every request.
+# LocalExtractSource reads a local OSM extract (.osm.pbf, .osm or GeoPackage)
+# once, filters it with water_tags.TAGS and answers queries from memory.
+# TiledSource wraps another source and fetches a whole grid cell at a time, so
+# that nearby points share a single query. Tiles can be kept in a
+# feature_store.FeatureStore, so they are only ever fetched once.
+
+import collections
+
+import numpy
+import osmnx
+import pandas
+import pyogrio
+from shapely.geometry import box
+
+import metrics
+import spatial_index
+import water_tags
+
+
+# Layers produced by GDAL's OSM driver, and the element type of the OSM ID in
+# each.
+OSM_LAYERS = {
+    "points": "node",
+    "lines": "way",
+    "multilinestrings": "relation",
+    "multipolygons": None,  # Either a way or a relation; see _osm_layer_ids.
+    "other_relations": "relation",
+}
+
+# Fetch a little more than the radius around each tile, so the box an Overpass
+# query would fetch around a point near the edge is inside the tile. Across NSW
+# the radius itself is only just enough.
+TILE_BUFFER_MARGIN = 1.05
+
+# The number of recently used tiles to keep in memory.
+MAX_TILES_IN_MEMORY = 16
+
+
+def bbox_from_point(lat, lng, radius):
+    # The same (left, bottom, right, top) box that
+    # osmnx.features.features_from_point queries.
+    return osmnx.utils_geo.bbox_from_point((lat, lng), radius)
+
+
+class OverpassSource:
+    @metrics.timed("overpass.features_in_bbox")
+    def features_in_bbox(self, bbox):
+        metrics.count("overpass.queries")
+        try:
+            return osmnx.features.features_from_bbox(bbox, water_tags.TAGS)
+        except osmnx.features.InsufficientResponseError:
+            metrics.count("overpass.insufficient_response_errors")
+            return None
+
+    def features_near_point(self, lat, lng, radius):
+        return self.features_in_bbox(bbox_from_point(lat, lng, radius))
+
+
+class LocalExtractSource:
+    def __init__(self, gdf):
+        self.gdf = filter_by_tags(gdf)
+        # Both bounding box and distance queries use the unprojected index, so
+        # they find the same features as Overpass would.
+        self.gdf.sindex
+        self.index = spatial_index.FeatureIndex(self.gdf)
+
+    @classmethod
+    @metrics.timed("feature_sources.load_extract")
+    def from_file(cls, path):
+        print(f"Loading water features from {path}")
+        if path.endswith(".gpkg"):
+            gdf = read_geopackage(path)
+        elif path.endswith(".osm"):
+            # osmnx can build features from OSM XML itself, which gives exactly
+            # the same geometries as an Overpass query.
+            gdf = osmnx.features.features_from_xml(path, tags=water_tags.TAGS)
+        else:
+            gdf = read_osm_extract(path)
+        print(f"Loaded {len(gdf)} water features")
+        return cls(gdf)
+
+    def features_in_bbox(self, bbox):
+        positions = self.gdf.sindex.query(box(*bbox), predicate="intersects")
+        if len(positions) == 0:
+            return None
+        positions.sort()
+        # Match osmnx, which drops tags that none of the returned features use.
+        return self.gdf.iloc[positions].dropna(axis="columns", how="all")
+
+    def features_near_point(self, lat, lng, radius):
+        return self.index.features_near_point(lat, lng, radius)
+
+    def features_near_points(self, lats, lngs, radius):
+        return self.index.features_near_points(lats, lngs, radius)
+
+
+class TiledSource:
+    def __init__(self, source, tile_size, radius, store=None):
+        self.source = source
+        self.tile_size = tile_size
+        self.radius = radius
+        self.buffer = radius * TILE_BUFFER_MARGIN
+        self.store = store
+        self.tiles = collections.OrderedDict()
+        self.tiles_fetched = 0
+        self.tiles_loaded = 0
+
+    # Tiles are laid out on a grid in spatial_index.DISTANCE_CRS, in metres.
+    def tile_keys(self, lats, lngs):
+        x, y = spatial_index.to_distance_crs.transform(
+            numpy.asarray(lngs), numpy.asarray(lats)
+        )
+        return (
+            numpy.floor(numpy.asarray(x) / self.tile_size).astype("int64"),
+            numpy.floor(numpy.asarray(y) / self.tile_size).astype("int64"),
+        )
+
+    def tile_key(self, lat, lng):
+        x, y = self.tile_keys([lat], [lng])
+        return (int(x[0]), int(y[0]))
+
+    def tile_bbox(self, key):
+        # (left, bottom, right, top) in lat/lng degrees, including the buffer.
+        left = key[0] * self.tile_size - self.buffer
+        bottom = key[1] * self.tile_size - self.buffer
+        right = (key[0] + 1) * self.tile_size + self.buffer
+        top = (key[1] + 1) * self.tile_size + self.buffer
+        return spatial_index.to_distance_crs.transform_bounds(
+            left, bottom, right, top, direction="INVERSE"
+        )
+
+    def sort_by_tile(self, lats, lngs):
+        # Positions of the given points ordered so that points in the same tile
+        # are adjacent, so each tile only needs fetching once.
+        x, y = self.tile_keys(lats, lngs)
+        return numpy.lexsort((x, y))
+
+    def tile(self, key):
+        if key in self.tiles:
+            self.tiles.move_to_end(key)
+            return self.tiles[key]
+
+        if self.store is not None and self.store.has_tile(key, self.buffer):
+            gdf = self.store.read_tile(key)
+            self.tiles_loaded += 1
+            metrics.count("tiles.loaded")
+        else:
+            bbox = self.tile_bbox(key)
+            gdf = self.source.features_in_bbox(bbox)
+            self.tiles_fetched += 1
+            metrics.count("tiles.fetched")
+            if self.store is not None:
+                self.store.write_tile(key, self.buffer, bbox, gdf)
+        tile = None if gdf is None else LocalExtractSource(gdf)
+        self.tiles[key] = tile
+        if len(self.tiles) > MAX_TILES_IN_MEMORY:
+            self.tiles.popitem(last=False)
+        return tile
+
+    def features_in_bbox(self, bbox):
+        return self.source.features_in_bbox(bbox)
+
+    def features_near_point(self, lat, lng, radius):
+        if radius > self.radius:
+            # The tile buffer isn't large enough to answer this query.
+            return self.source.features_near_point(lat, lng, radius)
+        tile = self.tile(self.tile_key(lat, lng))
+        if tile is None:
+            return None
+        return tile.features_near_point(lat, lng, radius)
+
+    def features_near_points(self, lats, lngs, radius):
+        # Answers all the points in each tile with a single query of the tile.
+        lats = numpy.asarray(lats, dtype=float)
+        lngs = numpy.asarray(lngs, dtype=float)
+        if radius > self.radius:
+            return [self.features_near_point(*p, radius) for p in zip(lats, lngs)]
+
+        result = [None] * len(lats)
+        for tile, positions in self.iter_tiles(lats, lngs):
+            gdfs = tile.features_near_points(lats[positions], lngs[positions], radius)
+            for position, gdf in zip(positions, gdfs):
+                result[position] = gdf
+        return result
+
+    def iter_tiles(self, lats, lngs):
+        # Yields each tile with features that the points are in, as a
+        # LocalExtractSource, and the positions of the points in it.
+        x, y = self.tile_keys(lats, lngs)
+        keys = pandas.DataFrame({"x": x, "y": y})
+        for key, positions in keys.groupby(["x", "y"], sort=False).indices.items():
+            tile = self.tile((int(key[0]), int(key[1])))
+            if tile is not None:
+                yield tile, positions
+
+
+def filter_by_tags(gdf):
+    # Keep features matching any of water_tags.TAGS, as osmnx does for
+    # Overpass results.
+    gdf = gdf[~(gdf.geometry.isna() | gdf.geometry.is_empty)]
+    mask = pandas.Series(False, index=gdf.index)
+    for key, value in water_tags.TAGS.items():
+        if key not in gdf:
+            continue
+        if value is True:
+            mask |= gdf[key].notna()
+        else:
+            mask |= gdf[key].isin(value)
+    gdf = gdf[mask].copy()
+    gdf["geometry"] = gdf.geometry.make_valid()
+    return gdf
+
+
+def parse_other_tags(other_tags):
+    # GDAL stores tags that don't have their own column as an hstore string:
+    # "key"=>"value","key2"=>"value2"
+    if pandas.isna(other_tags):
+        return {}
+    tags = {}
+    for item in other_tags[1:-1].split('","'):
+        if '"=>"' not in item:
+            continue
+        key, value = item.split('"=>"', 1)
+        tags[key] = value.replace('\\"', '"')
+    return tags
+
+
+def expand_other_tags(gdf):
+    if "other_tags" not in gdf:
+        return gdf
+    tags = pandas.DataFrame(
+        [parse_other_tags(t) for t in gdf["other_tags"]], index=gdf.index
+    )
+    # Prefer the dedicated columns where GDAL has already split a tag out.
+    tags = tags.drop(columns=[c for c in tags.columns if c in gdf.columns])
+    return gdf.drop(columns=["other_tags"]).join(tags)
+
+
+def _tags_where(fields):
+    # An OGR SQL filter that only loads features that might match
+    # water_tags.TAGS, so the whole extract never has to be held in memory.
+    clauses = []
+    for key, value in water_tags.TAGS.items():
+        if key in fields:
+            if value is True:
+                clauses.append(f'"{key}" IS NOT NULL')
+            else:
+                values = ", ".join(f"'{v}'" for v in value)
+                clauses.append(f'"{key}" IN ({values})')
+        elif "other_tags" in fields:
+            clauses.append(f"\"other_tags\" LIKE '%\"{key}\"=>%'")
+    return " OR ".join(clauses)
+
+
+def _osm_layer_ids(gdf, layer):
+    element = OSM_LAYERS[layer]
+    if element is not None:
+        return pandas.Series(element, index=gdf.index), gdf["osm_id"]
+    # Closed ways become multipolygons with osm_way_id set instead of osm_id.
+    is_way = gdf["osm_id"].isna()
+    elements = pandas.Series("relation", index=gdf.index).where(~is_way, "way")
+    return elements, gdf["osm_id"].where(~is_way, gdf["osm_way_id"])
+
+
+def read_osm_extract(path):
+    gdfs = []
+    for layer in OSM_LAYERS:
+        fields = pyogrio.read_info(path, layer=layer)["fields"]
+        gdf = pyogrio.read_dataframe(path, layer=layer, where=_tags_where(fields))
+        if len(gdf) == 0:
+            continue
+        gdf["element"], gdf["id"] = _osm_layer_ids(gdf, layer)
+        gdf = gdf.drop(columns=["osm_id", "osm_way_id"], errors="ignore")
+        gdfs.append(expand_other_tags(gdf))
+    gdf = pandas.concat(gdfs)
+    gdf["id"] = gdf["id"].astype("int64")
+    return gdf.set_index(["element", "id"]).sort_index()
+
+
+def read_geopackage(path):
+    # Accepts either a GeoPackage written from osmnx features (with element
+    # and id columns) or one converted from a .osm.pbf by ogr2ogr.
+    gdfs = []
+    for layer in pyogrio.list_layers(path)[:, 0]:
+        gdf = pyogrio.read_dataframe(path, layer=layer)
+        if len(gdf) == 0:
+            continue
+        if "element" not in gdf and layer in OSM_LAYERS:
+            gdf["element"], gdf["id"] = _osm_layer_ids(gdf, layer)
+            gdf = gdf.drop(columns=["osm_id", "osm_way_id"], errors="ignore")
+        gdfs.append(expand_other_tags(gdf))
+    gdf = pandas.concat(gdfs)
+    if "element" in gdf:
+        gdf["id"] = gdf["id"].astype("int64")
+        gdf = gdf.set_index(["element", "id"]).sort_index()
+    return gdf
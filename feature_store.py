@@ -0,0 +1,140 @@
+# An on-disk store of the raw water features fetched for each tile, so that
+# changes to the radius, dedupe rules or classification can be re-run from disk
+# instead of refetching everything from Overpass.
+#
+# The store is a GeoPackage with two layers:
+#   features: one row per feature per tile, with the tile's key (tile_x,
+#     tile_y), the OSM element type and id, all of its tags as a JSON object,
+#     and its geometry.
+#   tiles: one row per tile that has been fetched, including tiles with no
+#     features, with the buffer it was fetched with and its bounding box as
+#     the geometry.
+# Tiles are keyed as in feature_sources.TiledSource, so a store can only be
+# used with the tile size it was created with.
+
+import json
+import os
+import sqlite3
+
+import geopandas
+import pandas
+import pyogrio
+from shapely.geometry import box
+
+import metrics
+
+FEATURES_LAYER = "features"
+TILES_LAYER = "tiles"
+CRS = "EPSG:4326"
+
+
+class FeatureStore:
+    def __init__(self, path, tile_size):
+        self.path = path
+        self.tile_size = tile_size
+        # The buffer each stored tile was fetched with.
+        self.tiles = {}
+        if os.path.exists(path) and TILES_LAYER in pyogrio.list_layers(path)[:, 0]:
+            tiles = pyogrio.read_dataframe(path, layer=TILES_LAYER, read_geometry=False)
+            sizes = set(tiles["tile_size"])
+            if sizes and sizes != {tile_size}:
+                raise ValueError(
+                    f"{path} has tiles of size {sizes.pop()}, not {tile_size}"
+                )
+            for x, y, buffer in zip(tiles["tile_x"], tiles["tile_y"], tiles["buffer"]):
+                self.tiles[(int(x), int(y))] = buffer
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def has_tile(self, key, buffer):
+        # Tiles fetched with a larger buffer have all the features of a smaller
+        # one, and more.
+        return key in self.tiles and self.tiles[key] >= buffer
+
+    @metrics.timed("feature_store.read_tile")
+    def read_tile(self, key):
+        gdf = pyogrio.read_dataframe(
+            self.path,
+            layer=FEATURES_LAYER,
+            where=f"tile_x = {key[0]} AND tile_y = {key[1]}",
+        )
+        if len(gdf) == 0:
+            return None
+        return _expand_tags(gdf)
+
+    @metrics.timed("feature_store.read_all")
+    def read_all(self):
+        # Every stored feature, once, however many tiles it is in.
+        return _expand_tags(pyogrio.read_dataframe(self.path, layer=FEATURES_LAYER))
+
+    @metrics.timed("feature_store.write_tile")
+    def write_tile(self, key, buffer, bbox, gdf):
+        # Features are written before the tile is recorded, so a tile is only
+        # treated as stored once all its features are.
+        if gdf is not None and len(gdf) > 0:
+            gdf = gdf.reset_index()
+            tag_columns = [
+                c for c in gdf.columns if c not in ("element", "id", "geometry")
+            ]
+            tags = [
+                json.dumps(
+                    {k: v for k, v in zip(tag_columns, values) if pandas.notna(v)},
+                    default=str,
+                )
+                for values in gdf[tag_columns].itertuples(index=False)
+            ]
+            features = geopandas.GeoDataFrame(
+                {
+                    "tile_x": key[0],
+                    "tile_y": key[1],
+                    "element": gdf["element"],
+                    "id": gdf["id"],
+                    "tags": tags,
+                },
+                geometry=gdf.geometry.to_numpy(),
+                crs=CRS,
+            )
+            self._write(features, FEATURES_LAYER)
+
+        tile = geopandas.GeoDataFrame(
+            {
+                "tile_x": [key[0]],
+                "tile_y": [key[1]],
+                "tile_size": [self.tile_size],
+                "buffer": [buffer],
+                "feature_count": [0 if gdf is None else len(gdf)],
+            },
+            geometry=[box(*bbox)],
+            crs=CRS,
+        )
+        self._write(tile, TILES_LAYER)
+        self.tiles[key] = buffer
+
+    def _write(self, gdf, layer):
+        exists = os.path.exists(self.path) and layer in pyogrio.list_layers(self.path)[:, 0]
+        pyogrio.write_dataframe(
+            gdf,
+            self.path,
+            layer=layer,
+            append=exists,
+            # Features of all geometry types share the one layer.
+            geometry_type="Unknown",
+            promote_to_multi=False,
+        )
+        if not exists and layer == FEATURES_LAYER:
+            # Tiles are read by key, so index them.
+            with sqlite3.connect(self.path) as db:
+                db.execute(
+                    f"CREATE INDEX IF NOT EXISTS {layer}_tile ON {layer} (tile_x, tile_y)"
+                )
+
+
+def _expand_tags(gdf):
+    # Features are stored once per tile they're in, and a tile's features may
+    # have been written twice if a run stopped before the tile was recorded.
+    gdf = gdf.drop_duplicates(["element", "id"])
+    tags = pandas.DataFrame([json.loads(t) for t in gdf["tags"]], index=gdf.index)
+    gdf = gdf[["element", "id", "geometry"]].join(tags)
+    gdf["id"] = gdf["id"].astype("int64")
+    return gdf.set_index(["element", "id"]).sort_index()
@@ -1,52 +1,81 @@
 import argparse
 import collections
 import datetime
+import html
 import os
 import sys
 import urllib.parse
 import webbrowser
 
 import folium
-import geopandas
-import osmnx
+import folium.plugins
 import pandas
 
 import cache_water_points
+import diagnostics
+import feature_sources
+import metrics
 import water_tags
 
+# Above this many points, they are shown as a cluster rather than a marker each.
+MAX_MARKERS = 1000
+# The water features' geometries are simplified to within this many metres, to
+# keep the map small.
+SIMPLIFY_METRES = 1
+# Roughly, for converting SIMPLIFY_METRES to degrees.
+METRES_PER_DEGREE = 111_320
+# The columns of the water features shown in their tooltips.
+FEATURE_COLUMNS = [
+    "geometry",
+    "type",
+    "name",
+    "leisure",
+    "natural",
+    "waterway",
+    "access",
+    "man_made",
+    "swimming_pool",
+    "sport",
+    "tourism",
+]
 
-def retrieve_value_from_gdf_row(row, tag, result_dict):
-    if tag in row and not pandas.isna(row[tag]):
-        result_dict[tag] = row[tag]
+
+# The tags shown for each feature in a point's popup. club finds
+# surf_life_saving.
+POPUP_TAGS = list(
+    dict.fromkeys(
+        [*water_tags.TAGS, "name", "access", "ownership", "depth", "lifeguard", "club"]
+    )
+)
 
 
 def non_null_tags_from_gdf(gdf):
     if gdf is None:
         return []
+    return unique_tags(feature_tags(gdf))
+
 
+# The non-null POPUP_TAGS of each feature in gdf, and its inferred privacy if
+# it's a pool.
+def feature_tags(gdf):
+    keys = [tag for tag in POPUP_TAGS if tag in gdf]
     items_retrieved = []
-    for i in range(len(gdf)):
-        row = gdf.iloc[i]
-        result = {}
-        for tag in water_tags.TAGS:
-            retrieve_value_from_gdf_row(row, tag, result)
-        retrieve_value_from_gdf_row(row, "name", result)
-        retrieve_value_from_gdf_row(row, "access", result)
-        retrieve_value_from_gdf_row(row, "ownership", result)
-        retrieve_value_from_gdf_row(row, "depth", result)
-        retrieve_value_from_gdf_row(row, "lifeguard", result)
-        # Finds surf_life_saving
-        retrieve_value_from_gdf_row(row, "club", result)
+    for i, row in enumerate(gdf[keys].to_dict("records")):
+        result = {tag: value for tag, value in row.items() if not pandas.isna(value)}
 
         # pool privacy
         if (
-            "leisure" in result and result["leisure"] == "swimming_pool"
-            or "swimming" in result and result["swimming_pool"] == "swimming"
+            result.get("leisure") == "swimming_pool"
+            or result.get("swimming_pool") == "swimming"
         ):
             result["inferred_pool_privacy"] = cache_water_points.infer_pool_privacy(
-                row)
+                gdf.iloc[i])
 
         items_retrieved.append(result)
+    return items_retrieved
+
+
+def unique_tags(items_retrieved):
     # Remove identical items
     return [dict(t) for t in {tuple(d.items()) for d in items_retrieved}]
 
@@ -62,10 +91,73 @@ def plot_points(in_data, m, color="", tags=None):
         folium.Marker(latlng, icon=folium.Icon(color=color), popup=popup).add_to(m)
 
 
-def find_water_near_points(in_data, radius, regional_radius):
+# Like plot_points for each (latlngs, color, tags) in layers, but as one
+# cluster of circle markers, which are only created in the browser as they come
+# into view, so the map stays usable with tens of thousands of points.
+def cluster_points(layers, m):
+    data = []
+    for latlngs, color, tags in layers:
+        for i, latlng in enumerate(latlngs):
+            popup = f"{latlng}"
+            if tags is not None:
+                popup += f"\n{tags[i]}"
+            data.append([latlng[0], latlng[1], html.escape(popup), color])
+    callback = """
+        function (row) {
+            var marker = L.circleMarker(new L.LatLng(row[0], row[1]), {color: row[3]});
+            marker.bindPopup(row[2]);
+            return marker;
+        };
+    """
+    folium.plugins.FastMarkerCluster(data, callback=callback).add_to(m)
+
+
+def heat_points(latlngs, m):
+    folium.plugins.HeatMap([list(latlng) for latlng in latlngs]).add_to(m)
+
+
+# The water features found near any of the points, once each (by osmid), or
+# None if there are none. Nearby points share most of their features, so this
+# is much smaller than all of gdfs.
+def unique_features(gdfs):
+    seen = set()
+    frames = []
+    for gdf in gdfs:
+        if gdf is None:
+            continue
+        new = [i for i, osmid in enumerate(gdf.index) if osmid not in seen]
+        if len(new) == 0:
+            continue
+        seen.update(gdf.index[new])
+        frames.append(gdf.iloc[new])
+    if len(frames) == 0:
+        return None
+    return pandas.concat(frames)
+
+
+# unique_features with only FEATURE_COLUMNS and an osmid, and their geometries
+# simplified to within simplify_metres.
+def water_features_layer(features, simplify_metres=SIMPLIFY_METRES):
+    if features is None:
+        return None
+    gdf = features[[c for c in FEATURE_COLUMNS if c in features]]
+    if simplify_metres:
+        tolerance = simplify_metres / METRES_PER_DEGREE
+        gdf = gdf.assign(geometry=gdf.geometry.simplify(tolerance))
+    # osmids, e.g. way/123, to show in the tooltips.
+    osmids = [f"{element}/{id}" for element, id in gdf.index]
+    return gdf.assign(osmid=osmids).reset_index(drop=True)
+
+
+def find_water_near_points(in_data, radius, regional_radius, source=None):
+    if isinstance(
+        source, (feature_sources.LocalExtractSource, feature_sources.TiledSource)
+    ):
+        return find_water_near_points_batched(in_data, radius, regional_radius, source)
+
     gdfs = collections.defaultdict(list)
     for i in range(len(in_data)):
-        if i > 0 and i % 10 == 0:
+        if diagnostics.show_progress and i > 0 and i % 10 == 0:
             print(f"Checked {i} points")
         row = in_data.iloc[i]
         point_id = row["patient_id"]
@@ -76,33 +168,83 @@ def find_water_near_points(in_data, radius, regional_radius):
         latlng = (row["Pickup_Latitude"], row["Pickup_Longitude"])
         if remoteness >= 2:  # Corresponds to outer regional, remote, very remote
             gdfs[point_id] = cache_water_points.find_water_near_point(
-                row["Pickup_Latitude"], row["Pickup_Longitude"], regional_radius
+                row["Pickup_Latitude"],
+                row["Pickup_Longitude"],
+                regional_radius,
+                source=source,
             )
         else:
             gdfs[point_id] = cache_water_points.find_water_near_point(
-                row["Pickup_Latitude"], row["Pickup_Longitude"], radius
+                row["Pickup_Latitude"], row["Pickup_Longitude"], radius, source=source
             )
     return gdfs
 
 
-def run(in_data, radius, regional_radius, output_dir=None, open_in_browser=False):
+# As find_water_near_points, but looks up all the points with each radius
+# together, so a feature store's tiles are each read once (and only the tiles
+# not already in it are fetched).
+def find_water_near_points_batched(in_data, radius, regional_radius, source):
+    # Outer regional, remote and very remote.
+    regional = (in_data["incident_remoteness_code"] >= 2).to_numpy()
+    found = {}
+    for points, point_radius in [
+        (in_data[~regional], radius),
+        (in_data[regional], regional_radius),
+    ]:
+        gdfs = cache_water_points.find_water_near_points(
+            points, point_radius, source=source
+        )
+        for (point_id, _), gdf in gdfs.items():
+            found[point_id] = gdf
+    if isinstance(source, feature_sources.TiledSource):
+        print(
+            f"Fetched {source.tiles_fetched} tiles and loaded {source.tiles_loaded}"
+            f" from the feature store for {len(in_data)} points"
+        )
+    # In the same order as in_data.
+    return {point_id: found[point_id] for point_id in in_data["patient_id"]}
+
+
+# Water is found from source (as for cache_water_points.find_water_near_point),
+# by default the Overpass API, or e.g. a feature store made by
+# cache_water_points.py. The points are shown as points_layer: "markers",
+# "cluster" or "heatmap", by default markers for up to MAX_MARKERS points and a
+# cluster for more.
+@metrics.timed("interactive_map.run")
+def run(
+    in_data,
+    radius,
+    regional_radius,
+    output_dir=None,
+    open_in_browser=False,
+    source=None,
+    points_layer=None,
+    simplify_metres=SIMPLIFY_METRES,
+):
     print(f"Finding water near {len(in_data)} points")
-    gdfs = find_water_near_points(in_data, radius, regional_radius)
+    gdfs = find_water_near_points(in_data, radius, regional_radius, source=source)
     print(f"Found water. Plotting...")
-    num_missing = (
-        in_data["Pickup_Latitude"].isna() | in_data["Pickup_Longitude"].isna()
-    ).sum()
+
+    assert in_data["patient_id"].is_unique
+    latlngs = dict(
+        zip(
+            in_data["patient_id"],
+            zip(in_data["Pickup_Latitude"], in_data["Pickup_Longitude"]),
+        )
+    )
+    draw = open_in_browser or output_dir
+    features = unique_features(gdfs.values()) if draw else None
+    if features is not None:
+        tags_by_osmid = dict(zip(features.index, feature_tags(features)))
 
     water_found_points = []
     water_not_found_points = []
-    geodataframe = None
     tags_arr = []
     for point_id in gdfs:
-        print(f"Plotting {point_id}")
+        if diagnostics.show_progress:
+            print(f"Plotting {point_id}")
         gdf = gdfs[point_id]
-        row = in_data[in_data["patient_id"] == point_id]
-        assert len(row) == 1
-        latlng = (row.iloc[0]["Pickup_Latitude"], row.iloc[0]["Pickup_Longitude"])
+        latlng = latlngs[point_id]
         if pandas.isna(latlng[0]) or pandas.isna(latlng[1]):
             # Can't plot.
             continue
@@ -110,27 +252,18 @@ def run(in_data, radius, regional_radius, output_dir=None, open_in_browser=False
             water_not_found_points.append(latlng)
             continue
 
-        tags = non_null_tags_from_gdf(gdf)
         water_found_points.append(latlng)
+        if draw:
+            tags_arr.append(unique_tags([tags_by_osmid[osmid] for osmid in gdf.index]))
 
-        # Generate visualisation.
-        if open_in_browser or output_dir:
-            cols = ["geometry", "type", "name", "leisure", "natural", "waterway", "access", "man_made", "swimming_pool", "sport", "tourism"]
-            used_cols = []
-            for col in cols:
-                if col in gdf.columns:
-                    used_cols.append(col)
-            gdf = gdf[used_cols]
-            if geodataframe is None:
-                geodataframe = gdf
-            else:
-                geodataframe = pandas.concat([geodataframe, gdf])
-            tags_arr.append(tags)
-
-    if open_in_browser or output_dir:
-        m = geodataframe.explore(color="red", tooltip=True)
-        plot_points(water_found_points, m, "red", tags_arr)
-        plot_points(water_not_found_points, m, "blue")
+    if draw:
+        m = make_map(
+            water_found_points,
+            water_not_found_points,
+            tags_arr,
+            water_features_layer(features, simplify_metres),
+            points_layer,
+        )
         if output_dir is None:
             # Showing in the browser happens later if output_dir is not None.
             m.show_in_browser()
@@ -150,6 +283,46 @@ def run(in_data, radius, regional_radius, output_dir=None, open_in_browser=False
     return gdfs
 
 
+def make_map(
+    water_found_points, water_not_found_points, tags_arr, features, points_layer=None
+):
+    if points_layer is None:
+        num_points = len(water_found_points) + len(water_not_found_points)
+        points_layer = "markers" if num_points <= MAX_MARKERS else "cluster"
+
+    m = folium.Map(tiles="OpenStreetMap")
+    if features is not None:
+        fields = [c for c in features.columns if c != "geometry"]
+        folium.GeoJson(
+            features.to_json(na="null"),
+            style_function=lambda feature: {"color": "red", "fillColor": "red"},
+            tooltip=folium.GeoJsonTooltip(fields=fields),
+        ).add_to(m)
+
+    if points_layer == "markers":
+        plot_points(water_found_points, m, "red", tags_arr)
+        plot_points(water_not_found_points, m, "blue")
+    elif points_layer == "cluster":
+        cluster_points(
+            [
+                (water_found_points, "red", tags_arr),
+                (water_not_found_points, "blue", None),
+            ],
+            m,
+        )
+    else:
+        heat_points(water_found_points + water_not_found_points, m)
+
+    bounds = water_found_points + water_not_found_points
+    if features is not None:
+        min_lng, min_lat, max_lng, max_lat = features.total_bounds
+        bounds += [(min_lat, min_lng), (max_lat, max_lng)]
+    if len(bounds) > 0:
+        lats, lngs = zip(*bounds)
+        m.fit_bounds([(min(lats), min(lngs)), (max(lats), max(lngs))])
+    return m
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="gets water features from a specified radius around points,"
@@ -163,7 +336,20 @@ def main():
     parser.add_argument(
         "--open", required=False, action=argparse.BooleanOptionalAction, default=True
     )
+    parser.add_argument(
+        "--points", choices=["markers", "cluster", "heatmap"], required=False
+    )
+    parser.add_argument("--simplify", type=float, default=SIMPLIFY_METRES)
+    parser.add_argument("--osm_extract", required=False)
+    parser.add_argument("--tile_size", type=int, required=False)
+    parser.add_argument("--feature_store", required=False)
+    metrics.add_arguments(parser)
+    diagnostics.add_arguments(parser)
     args = parser.parse_args()
+    metrics.configure(args)
+    diagnostics.configure(args)
+    if args.feature_store and not args.tile_size:
+        parser.error("--feature_store stores tiles, so needs --tile_size")
 
     print(f"Generating visualisation for points in {args.filename}")
 
@@ -174,6 +360,9 @@ def main():
     regional_radius = (
         args.radius if args.regional_radius is None else args.regional_radius
     )
+    source = cache_water_points.make_source(
+        args.osm_extract, args.tile_size, args.feature_store
+    )
 
     run(
         in_data,
@@ -181,6 +370,9 @@ def main():
         regional_radius,
         output_dir=args.output_dir,
         open_in_browser=args.open,
+        points_layer=args.points,
+        simplify_metres=args.simplify,
+        source=source,
     )
 
 
@@ -0,0 +1,243 @@
+# Lightweight instrumentation shared by all the scripts: timers around the hot
+# functions, counters (e.g. Overpass queries, cache hits, empty results) and
+# observations (e.g. features per point), kept in memory and written out as a
+# summary when the script exits.
+#
+# Nothing is written unless a script is run with --metrics=path. The summary is
+# JSON, or a Prometheus textfile (for the node exporter's textfile collector)
+# if the path ends in .prom. --profile=path profiles the whole run, or just the
+# timer given by --profile_stage, with cProfile, or with pyinstrument if the
+# path ends in .html.
+#
+# Timers nest, so e.g. the time in cache_water_points.classify_features is also
+# counted in cache_water_points.point_rows. A timer's total is the sum of its
+# calls, so calls that overlap (e.g. concurrent Overpass requests) can add up to
+# more than the run took.
+
+import atexit
+import collections
+import cProfile
+import contextlib
+import datetime
+import functools
+import json
+import os
+import sys
+import time
+
+# The prefix of the Prometheus metric names.
+PROMETHEUS_PREFIX = "water"
+
+# name: [calls, total seconds, longest call in seconds]
+_timers = collections.defaultdict(lambda: [0, 0.0, 0.0])
+# name: count
+_counters = collections.Counter()
+# name: [count, sum, min, max]
+_observations = {}
+
+_started = time.perf_counter()
+_started_at = datetime.datetime.now()
+
+# The profiler, if any, and the timer it is limited to (None for the whole run).
+_profiler = None
+_profile_stage = None
+_profile_depth = 0
+
+
+@contextlib.contextmanager
+def timer(name):
+    start = time.perf_counter()
+    profiling = _profiler is not None and name == _profile_stage
+    if profiling:
+        _start_profiling()
+    try:
+        yield
+    finally:
+        if profiling:
+            _stop_profiling()
+        seconds = time.perf_counter() - start
+        t = _timers[name]
+        t[0] += 1
+        t[1] += seconds
+        t[2] = max(t[2], seconds)
+
+
+def timed(name):
+    # Decorates a function to time every call with timer(name).
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+def count(name, n=1):
+    _counters[name] += n
+
+
+def observe(name, value):
+    o = _observations.get(name)
+    if o is None:
+        _observations[name] = [1, value, value, value]
+    else:
+        o[0] += 1
+        o[1] += value
+        o[2] = min(o[2], value)
+        o[3] = max(o[3], value)
+
+
+def summary():
+    return {
+        "script": os.path.basename(sys.argv[0]),
+        "started": _started_at.isoformat(timespec="seconds"),
+        "wall_seconds": round(time.perf_counter() - _started, 4),
+        "timers": {
+            name: {
+                "calls": calls,
+                "seconds": round(total, 4),
+                "max_seconds": round(longest, 4),
+            }
+            for name, (calls, total, longest) in sorted(_timers.items())
+        },
+        "counters": dict(sorted(_counters.items())),
+        "observations": {
+            name: {
+                "count": n,
+                "sum": total,
+                "min": low,
+                "max": high,
+                "mean": total / n,
+            }
+            for name, (n, total, low, high) in sorted(_observations.items())
+        },
+    }
+
+
+def prometheus(s):
+    # The summary in the Prometheus text format.
+    script = s["script"]
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        full_name = f"{PROMETHEUS_PREFIX}_{name}"
+        lines.append(f"# HELP {full_name} {help_text}")
+        lines.append(f"# TYPE {full_name} {kind}")
+        for labels, value in samples:
+            labels = {"script": script, **labels}
+            label_text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+            lines.append(f"{full_name}{{{label_text}}} {value}")
+
+    metric(
+        "wall_seconds", "gauge", "Wall time of the run.", [({}, s["wall_seconds"])]
+    )
+    timers = s["timers"].items()
+    metric(
+        "timer_calls_total",
+        "counter",
+        "Calls of each timed function.",
+        [({"name": n}, t["calls"]) for n, t in timers],
+    )
+    metric(
+        "timer_seconds_total",
+        "counter",
+        "Seconds spent in each timed function.",
+        [({"name": n}, t["seconds"]) for n, t in timers],
+    )
+    metric(
+        "timer_max_seconds",
+        "gauge",
+        "Longest call of each timed function.",
+        [({"name": n}, t["max_seconds"]) for n, t in timers],
+    )
+    metric(
+        "events_total",
+        "counter",
+        "Counts of events such as queries, cache hits and empty results.",
+        [({"name": n}, c) for n, c in s["counters"].items()],
+    )
+    observations = s["observations"].items()
+    for stat in ["count", "sum", "min", "max"]:
+        metric(
+            f"observation_{stat}",
+            "gauge",
+            f"The {stat} of each observed value, such as features per point.",
+            [({"name": n}, o[stat]) for n, o in observations],
+        )
+    return "\n".join(lines) + "\n"
+
+
+def write(path):
+    s = summary()
+    # Write then rename, so the textfile collector never reads half a file.
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        if path.endswith(".prom"):
+            f.write(prometheus(s))
+        else:
+            json.dump(s, f, indent=2)
+    os.replace(tmp_path, path)
+    print(f"Wrote metrics to {path}")
+
+
+def _start_profiling():
+    global _profile_depth
+    if _profile_depth == 0:
+        if isinstance(_profiler, cProfile.Profile):
+            _profiler.enable()
+        else:
+            _profiler.start()
+    _profile_depth += 1
+
+
+def _stop_profiling():
+    global _profile_depth
+    _profile_depth -= 1
+    if _profile_depth == 0:
+        if isinstance(_profiler, cProfile.Profile):
+            _profiler.disable()
+        else:
+            _profiler.stop()
+
+
+def _write_profile(path):
+    if _profile_depth > 0:
+        # Still running, when profiling the whole run.
+        _stop_profiling()
+    if isinstance(_profiler, cProfile.Profile):
+        _profiler.dump_stats(path)
+    else:
+        with open(path, "w") as f:
+            f.write(_profiler.output_html())
+    print(f"Wrote profile to {path}")
+
+
+def add_arguments(parser):
+    parser.add_argument("--metrics", required=False)
+    parser.add_argument("--profile", required=False)
+    parser.add_argument("--profile_stage", required=False)
+
+
+def configure(args):
+    # Arranges for the metrics and profile asked for by the add_arguments
+    # options to be written when the script exits.
+    global _profiler, _profile_stage
+    if args.profile_stage and not args.profile:
+        sys.exit("--profile_stage needs --profile")
+    if args.metrics:
+        atexit.register(write, args.metrics)
+    if args.profile:
+        if args.profile.endswith(".html"):
+            # Only needed for HTML profiles.
+            import pyinstrument
+
+            _profiler = pyinstrument.Profiler()
+        else:
+            _profiler = cProfile.Profile()
+        _profile_stage = args.profile_stage
+        atexit.register(_write_profile, args.profile)
+        if _profile_stage is None:
+            _start_profiling()
@@ -0,0 +1,222 @@
+# Finds the k nearest water features of each type (as classified by
+# cache_water_points) to each point, e.g. the nearest beach, pool and river for
+# each dispatch. This uses nearest neighbour searches over the raw features,
+# from a local OSM extract or a feature store, rather than the 100 features
+# within a fixed radius that are cached for each point.
+#
+# The features are filtered as they are for the cache, except for the rules
+# that depend on what else is near a point (coastline next to a beach, and
+# Port Jackson), which aren't needed when each type is looked up separately.
+
+import argparse
+import sys
+
+import numpy
+import pandas
+import shapely
+
+import cache_water_points
+import diagnostics
+import feature_sources
+import feature_store
+import metrics
+import spatial_index
+
+DEFAULT_MAX_DISTANCE = cache_water_points.RADIUS_METRES
+# The smallest search around a point, for points on top of their nearest
+# feature.
+MIN_SEARCH_METRES = 1
+# How far beyond the k-th nearest feature to look for features whose distance
+# rounds to the same cm.
+TIE_METRES = 0.01
+
+
+class NearestWater:
+    def __init__(self, gdf):
+        # Features are reported by their OSM element type and ID, which osmnx
+        # and feature_sources give as the index.
+        missing = [name for name in ["element", "id"] if name not in gdf.index.names]
+        if missing:
+            raise ValueError(f"The features' index has no {' or '.join(missing)} level")
+        gdf = cache_water_points.dedupe_pools_inside_leisure_centre(gdf)
+        gdf = cache_water_points.remove_clubs(gdf)
+        gdf = cache_water_points.remove_dry_man_made(gdf)
+        self.gdf = gdf
+        self.types = cache_water_points.classify_features(gdf).to_numpy()
+        self.geometries = spatial_index.project_geometries(
+            gdf.geometry.to_numpy(), gdf.crs
+        )
+        # One tree per type, with the positions (in self.gdf) of its features.
+        self.trees = {}
+        for water_type in numpy.unique(self.types):
+            if water_type == "":
+                continue
+            positions = numpy.flatnonzero(self.types == water_type)
+            self.trees[water_type] = (
+                positions,
+                shapely.STRtree(self.geometries[positions]),
+            )
+
+    @metrics.timed("nearest_water.nearest")
+    def nearest(self, lats, lngs, water_type, k=1, max_distance=DEFAULT_MAX_DISTANCE):
+        # A table of the (point, feature) pairs for the k nearest features of
+        # the type to each point, within max_distance metres if it isn't None,
+        # as positions in lats/lngs and self.gdf, with their distances rounded
+        # to cm and ranks (from 0) among the point's features. Points with no
+        # location have no features.
+        #
+        # The search around each point starts at the distance to its nearest
+        # feature and doubles until it holds k features (or every feature of
+        # the type, or reaches max_distance), so there is no fixed radius.
+        lats = numpy.asarray(lats, dtype=float)
+        lngs = numpy.asarray(lngs, dtype=float)
+        located = numpy.flatnonzero(numpy.isfinite(lats) & numpy.isfinite(lngs))
+        points = spatial_index.project_points(lats[located], lngs[located])
+        positions, tree = self.trees[water_type]
+
+        (near_points, _), near_distances = tree.query_nearest(
+            points, max_distance=max_distance, return_distance=True
+        )
+        radius = numpy.full(len(points), numpy.nan)
+        radius[near_points] = numpy.maximum(near_distances, MIN_SEARCH_METRES)
+        pending = numpy.flatnonzero(~numpy.isnan(radius))
+        tables = []
+        while len(pending) > 0:
+            limit = radius[pending]
+            # Features just outside the limit are found too, as their rounded
+            # distances can tie with the k-th's.
+            search = limit + TIE_METRES
+            if max_distance is not None:
+                limit = numpy.minimum(limit, max_distance)
+                search = numpy.minimum(search, max_distance)
+            point_idx, feature_idx = tree.query(
+                points[pending], predicate="dwithin", distance=search
+            )
+            distances = shapely.distance(
+                points[pending][point_idx], tree.geometries[feature_idx]
+            )
+            within = numpy.bincount(
+                point_idx[distances <= limit[point_idx]], minlength=len(pending)
+            )
+            done = (within >= k) | (within == len(tree.geometries))
+            if max_distance is not None:
+                done |= limit >= max_distance
+            found = done[point_idx]
+            tables.append(
+                pandas.DataFrame(
+                    {
+                        "point": located[pending[point_idx[found]]],
+                        "feature": positions[feature_idx[found]],
+                        "distance": numpy.round(distances[found], 2),
+                    }
+                )
+            )
+            pending = pending[~done]
+            radius[pending] *= 2
+
+        pairs = pandas.DataFrame(
+            {
+                "point": numpy.array([], dtype=int),
+                "feature": numpy.array([], dtype=int),
+                "distance": numpy.array([], dtype=float),
+            }
+        )
+        pairs = pandas.concat([pairs, *tables], ignore_index=True)
+        # Ties go to the feature that comes first in self.gdf.
+        pairs = pairs.sort_values(["point", "distance", "feature"])
+        pairs["rank"] = pairs.groupby("point").cumcount()
+        return pairs[pairs["rank"] < k].reset_index(drop=True)
+
+    def nearest_by_type(
+        self, lats, lngs, water_types=None, k=1, max_distance=DEFAULT_MAX_DISTANCE
+    ):
+        # nearest() for each of water_types (by default every type), with a
+        # water_type column.
+        if water_types is None:
+            water_types = sorted(self.trees)
+        tables = [
+            self.nearest(lats, lngs, t, k, max_distance).assign(water_type=t)
+            for t in water_types
+            if t in self.trees
+        ]
+        if len(tables) == 0:
+            return pandas.DataFrame(
+                columns=["point", "feature", "distance", "rank", "water_type"]
+            )
+        return pandas.concat(tables, ignore_index=True)
+
+
+def nearest_water(in_data, nearest, water_types=None, k=1, max_distance=DEFAULT_MAX_DISTANCE):
+    # The k nearest water features of each type to each point in in_data, one
+    # row per (point, type, feature), sorted by point, type and rank.
+    has_latlng = in_data["Pickup_Latitude"].notna() & in_data["Pickup_Longitude"].notna()
+    points = in_data[has_latlng]
+    # The points' positions in in_data, to keep its order.
+    point_positions = numpy.flatnonzero(has_latlng.to_numpy())
+    pairs = nearest.nearest_by_type(
+        points["Pickup_Latitude"],
+        points["Pickup_Longitude"],
+        water_types,
+        k,
+        max_distance,
+    )
+    features = nearest.gdf.iloc[pairs["feature"].to_numpy()].reset_index()
+    result = pandas.DataFrame(
+        {
+            "position": point_positions[pairs["point"]],
+            "patient_id": points["patient_id"].to_numpy()[pairs["point"]],
+            "water_type": pairs["water_type"],
+            "rank": pairs["rank"],
+            "water_name": features["name"] if "name" in features else None,
+            "water_distance": pairs["distance"],
+            "osm_element": features["element"],
+            "osm_id": features["id"],
+        }
+    )
+    result = result.sort_values(["position", "water_type", "rank"])
+    return result.drop(columns="position").reset_index(drop=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("filename")
+    parser.add_argument("--limit_points", type=int, required=False)
+    parser.add_argument("--osm_extract", required=False)
+    parser.add_argument("--feature_store", required=False)
+    parser.add_argument("--tile_size", type=int, required=False)
+    parser.add_argument("--types", nargs="+", required=False)
+    parser.add_argument("--k", type=int, default=1)
+    parser.add_argument("--max_distance", type=float, default=DEFAULT_MAX_DISTANCE)
+    metrics.add_arguments(parser)
+    diagnostics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.configure(args)
+    diagnostics.configure(args)
+    if bool(args.osm_extract) == bool(args.feature_store):
+        parser.error("give one of --osm_extract or --feature_store")
+    if args.feature_store and not args.tile_size:
+        parser.error("--feature_store needs the --tile_size it was created with")
+
+    if args.osm_extract:
+        gdf = feature_sources.LocalExtractSource.from_file(args.osm_extract).gdf
+    else:
+        gdf = feature_store.FeatureStore(args.feature_store, args.tile_size).read_all()
+    nearest = NearestWater(gdf)
+
+    in_data = pandas.read_csv(args.filename)
+    if args.limit_points and args.limit_points < len(in_data):
+        in_data = in_data.head(args.limit_points)
+
+    max_distance = args.max_distance or None
+    result = nearest_water(in_data, nearest, args.types, args.k, max_distance)
+    print(f"Found {len(result)} features for {result['patient_id'].nunique()} points")
+
+    in_filename = args.filename.split("/")[-1]
+    in_filename = in_filename.split(".")[-2]
+    out_path = f"outputs/{in_filename}-nearest-water.csv"
+    result.to_csv(out_path, index=False)
+    print(f"Wrote {out_path}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
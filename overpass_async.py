@@ -0,0 +1,167 @@
+# Fetches water features from the Overpass API with several requests in flight
+# at once. All requests share one pooled keep-alive HTTP session, and the
+# client backs off for everyone when the server says we are being rate
+# limited.
+#
+# The queries and the processing of the responses use the same osmnx helpers
+# as osmnx.features.features_from_bbox, so the features returned are the same
+# as OverpassSource's. These helpers are internal to osmnx, so requirements.txt
+# pins the osmnx versions they're known to work with; with an osmnx that doesn't
+# have them, each bbox is fetched with osmnx's public API in a thread instead,
+# without the shared session or backoff.
+
+import asyncio
+import re
+
+import aiohttp
+import osmnx
+
+import feature_sources
+import metrics
+import water_tags
+
+try:
+    from osmnx._overpass import (
+        _create_overpass_features_query,
+        _make_overpass_polygon_coord_strs,
+    )
+    from osmnx.features import _create_gdf
+except ImportError:
+    _create_gdf = None
+
+# Responses that mean the server wants us to slow down.
+RETRY_STATUSES = {429, 504}
+
+# Backoff between retries when the status endpoint doesn't say how long to
+# wait: BACKOFF_BASE_SECONDS, doubling on each retry up to BACKOFF_MAX_SECONDS.
+BACKOFF_BASE_SECONDS = 1
+BACKOFF_MAX_SECONDS = 60
+MAX_RETRIES = 10
+
+
+def parse_status(text):
+    # Parses the /status page, returning the rate limit (the number of slots we
+    # have, 0 for unlimited, or None if unknown) and how many seconds until the
+    # next slot is free.
+    # https://dev.overpass-api.de/overpass-doc/en/preface/commons.html
+    rate_limit = None
+    match = re.search(r"^Rate limit: (\d+)", text, re.MULTILINE)
+    if match:
+        rate_limit = int(match.group(1))
+
+    if re.search(r"^\d+ slots? available now", text, re.MULTILINE):
+        return rate_limit, 0
+
+    waits = re.findall(r"Slot available after: .*, in (-?\d+) seconds", text)
+    if waits:
+        return rate_limit, max(min(int(s) for s in waits), 0)
+    return rate_limit, None
+
+
+class AsyncOverpassClient:
+    def __init__(self, concurrency, endpoint=None):
+        self.concurrency = concurrency
+        self.endpoint = (endpoint or osmnx.settings.overpass_url).rstrip("/")
+        # No requests are started before this time (in loop time), so that a
+        # rate limit response pauses all workers and not only the one that got
+        # it.
+        self.pause_until = 0
+        self.requests = 0
+        self.retries = 0
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+            timeout=aiohttp.ClientTimeout(total=osmnx.settings.requests_timeout),
+            headers={"User-Agent": osmnx.settings.http_user_agent},
+        )
+        rate_limit, _ = await self.status()
+        if rate_limit:
+            # Don't hold more requests open than we have slots.
+            self.concurrency = min(self.concurrency, rate_limit)
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        return self
+
+    async def __aexit__(self, *args):
+        await self.session.close()
+
+    async def status(self):
+        try:
+            async with self.session.get(self.endpoint + "/status") as response:
+                return parse_status(await response.text())
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            # Not all servers have a status endpoint.
+            return None, None
+
+    async def wait_for_slot(self):
+        loop = asyncio.get_running_loop()
+        while loop.time() < self.pause_until:
+            await asyncio.sleep(self.pause_until - loop.time())
+
+    async def back_off(self, attempt):
+        _, pause = await self.status()
+        if pause is None:
+            pause = min(BACKOFF_BASE_SECONDS * 2**attempt, BACKOFF_MAX_SECONDS)
+        loop = asyncio.get_running_loop()
+        self.pause_until = max(self.pause_until, loop.time() + pause)
+
+    async def post(self, query):
+        # Rate limiting, dropped connections and timeouts are retried; other
+        # error statuses are raised.
+        error = None
+        for attempt in range(MAX_RETRIES + 1):
+            async with self.semaphore:
+                await self.wait_for_slot()
+                self.requests += 1
+                metrics.count("overpass.queries")
+                try:
+                    # Per request, so the total is summed over the requests
+                    # in flight at once.
+                    with metrics.timer("overpass.request"):
+                        async with self.session.post(
+                            self.endpoint + "/interpreter", data={"data": query}
+                        ) as response:
+                            if response.status not in RETRY_STATUSES:
+                                response.raise_for_status()
+                                return await response.json(content_type=None)
+                    error = None
+                except aiohttp.ClientResponseError:
+                    raise
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    metrics.count("overpass.connection_errors")
+                    error = e
+            self.retries += 1
+            metrics.count("overpass.retries")
+            await self.back_off(attempt)
+        if error is not None:
+            raise RuntimeError(
+                f"Overpass request still failing after {MAX_RETRIES} retries"
+            ) from error
+        raise RuntimeError(f"Overpass still rate limiting after {MAX_RETRIES} retries")
+
+    async def features_in_bbox(self, bbox):
+        loop = asyncio.get_running_loop()
+        if _create_gdf is None:
+            async with self.semaphore:
+                return await loop.run_in_executor(
+                    None, feature_sources.OverpassSource().features_in_bbox, bbox
+                )
+        polygon = osmnx.utils_geo.bbox_to_poly(bbox)
+        response_jsons = []
+        for coord_str in _make_overpass_polygon_coord_strs(polygon):
+            query = _create_overpass_features_query(coord_str, water_tags.TAGS)
+            response_jsons.append(await self.post(query))
+        try:
+            # Building the gdf takes a while for big responses, so it's done in
+            # a thread to keep the other requests going.
+            return await loop.run_in_executor(
+                None, _create_gdf, response_jsons, polygon, water_tags.TAGS
+            )
+        except osmnx.features.InsufficientResponseError:
+            metrics.count("overpass.insufficient_response_errors")
+            return None
+
+    async def features_near_point(self, lat, lng, radius):
+        return await self.features_in_bbox(
+            feature_sources.bbox_from_point(lat, lng, radius)
+        )
@@ -0,0 +1,159 @@
+# Runs all the stages on a file of points in one go: finds the water near each
+# point (cache_water_points.py), adds it to the data (add_water_to_data.py),
+# processes it (process_locations.py) and applies the prioritisation heuristic
+# (prioritise_location_type.py). The stages pass DataFrames to each other in
+# memory, so only the final output is written unless the intermediate files
+# are asked for.
+
+import argparse
+import sys
+import time
+
+import pandas
+import tabulate
+
+import add_water_to_data
+import cache_water_points
+import diagnostics
+import metrics
+import prioritise_location_type
+import process_locations
+import result_cache
+import water_features
+
+
+class StageTimer:
+    def __init__(self):
+        self.timings = []
+
+    def run(self, stage, func, *args, **kwargs):
+        start = time.perf_counter()
+        with metrics.timer(f"pipeline.{stage}"):
+            result = func(*args, **kwargs)
+        self.timings.append((stage, time.perf_counter() - start))
+        return result
+
+    def print(self):
+        rows = self.timings + [("total", sum(t for _, t in self.timings))]
+        print(
+            tabulate.tabulate(rows, headers=["Stage", "Seconds"], floatfmt=".2f")
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("filename")
+    parser.add_argument("--limit_points", type=int, required=False)
+    parser.add_argument("--use_cache", action="store_true")
+    parser.add_argument("--osm_extract", required=False)
+    parser.add_argument("--tile_size", type=int, required=False)
+    parser.add_argument("--feature_store", required=False)
+    parser.add_argument("--concurrency", type=int, required=False)
+    parser.add_argument("--result_cache", required=False)
+    parser.add_argument("--water_index", required=False)
+    parser.add_argument("--write_intermediates", action="store_true")
+    parser.add_argument("--wide", action="store_true")
+    metrics.add_arguments(parser)
+    diagnostics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.configure(args)
+    diagnostics.configure(args)
+    if args.concurrency and (args.osm_extract or args.tile_size):
+        parser.error("--concurrency only applies to per-point Overpass queries")
+    if args.feature_store and not args.tile_size:
+        parser.error("--feature_store stores tiles, so needs --tile_size")
+    if args.water_index and (
+        args.osm_extract or args.tile_size or args.feature_store or args.concurrency
+    ):
+        parser.error("--water_index is used instead of the other source options")
+    if args.use_cache and (
+        args.osm_extract
+        or args.tile_size
+        or args.concurrency
+        or args.result_cache
+        or args.water_index
+    ):
+        parser.error("--use_cache doesn't find any water, so takes no source options")
+
+    timer = StageTimer()
+    in_data = timer.run("read input", pandas.read_csv, args.filename)
+    if args.limit_points and args.limit_points < len(in_data):
+        in_data = in_data.head(args.limit_points)
+
+    in_filename = args.filename.split("/")[-1]
+    in_filename = in_filename.split(".")[-2]
+    out_path = f"outputs/{in_filename}-with-water"
+
+    if args.use_cache:
+        cache = timer.run("load cache", cache_water_points.load_cached_features)
+    else:
+        source = cache_water_points.make_source(
+            args.osm_extract, args.tile_size, args.feature_store, args.water_index
+        )
+        results = None
+        if args.result_cache:
+            results = result_cache.ResultCache(
+                args.result_cache, cache_water_points.RADIUS_METRES
+            )
+        try:
+            cache = timer.run(
+                "cache_water_points",
+                cache_water_points.find_features,
+                in_data,
+                source=source,
+                concurrency=args.concurrency,
+                results=results,
+            )
+        finally:
+            # Keep whatever was found, even if the run failed.
+            if results is not None:
+                results.flush()
+        if args.write_intermediates:
+            timer.run(
+                "write cache",
+                water_features.write_csv,
+                cache.reset_index(),
+                cache_water_points.CACHE_PATH,
+            )
+
+    with_water = timer.run(
+        "add_water_to_data", add_water_to_data.add_water, in_data, cache=cache
+    )
+    if args.write_intermediates:
+        timer.run(
+            "write with water",
+            water_features.write_csv,
+            with_water,
+            f"{out_path}.csv",
+            wide=args.wide,
+        )
+
+    processed = timer.run("process_locations", process_locations.process, with_water)
+    out_path += "-processed"
+    if args.write_intermediates:
+        timer.run(
+            "write processed",
+            water_features.write_csv,
+            processed,
+            f"{out_path}.csv",
+            wide=args.wide,
+        )
+
+    prioritised = timer.run(
+        "prioritise_location_type", prioritise_location_type.prioritise, processed
+    )
+    out_path += "-heuristic-applied"
+    timer.run(
+        "write output",
+        water_features.write_csv,
+        prioritised,
+        f"{out_path}.csv",
+        wide=args.wide,
+    )
+    print(f"Wrote {out_path}.csv")
+
+    timer.print()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
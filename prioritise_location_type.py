@@ -5,360 +5,441 @@
 # https://www.royallifesaving.com.au/research-and-policy/drowning-research/analysis-of-unintentional-drowning-in-australia-2002-2022
 
 import argparse
+import numpy
 import pandas
 import sys
 
+import diagnostics
+import metrics
+import water_features
 
-water_columns = [
-    "water_distance",
-    "water_lifeguard",
-    "water_name",
-    "water_type",
+
+# Water types in order of priority (most likely first) for each age band, then
+# for when the age is unknown.
+RANKINGS = [
+    # Under 5
+    [
+        # Pool 51%
+        "swimming_pool",
+        # Bathtub 16%
+        # Lake/dam 11%
+        "lake",
+        "dam",
+        "pond",
+        "natural:water",
+        "reservoir",
+        # Other 11%
+        "drain",
+        "storage_tank",
+        "ditch",
+        "wetland",
+        # Beach 1%
+        # Beach should take priority over others where present
+        "beach",
+        # River/creek 9%
+        "river",
+        "creek",
+        "stream",
+        "stream_pool",
+        "canal",
+        "weir",
+        # Ocean/harbour 1%
+        "ocean",
+        "harbour",
+        "bay",
+        "lagoon",
+        "inlet",
+        "swimming_area",
+        "breakwater",
+        "marina",
+        "scuba_diving",
+        # Misc odd ones
+        "fountain",
+        "reflecting_pool",
+        "splash_pad",
+        "water_park",
+        "wastewater",
+    ],
+    # 5 to 14
+    [
+        # Pool 24%
+        "swimming_pool",
+        # Beach 10%
+        # Beach should take priority over others where present
+        "beach",
+        # Lake/dam 16%
+        "lake",
+        "dam",
+        "pond",
+        "natural:water",
+        "reservoir",
+        # Bath 8%
+        # Ocean/harbour 6%
+        "ocean",
+        "harbour",
+        "bay",
+        "lagoon",
+        "inlet",
+        "swimming_area",
+        "breakwater",
+        "marina",
+        "scuba_diving",
+        # River/creek 2%
+        "river",
+        "creek",
+        "stream",
+        "stream_pool",
+        "waterfall",
+        "canal",
+        "weir",
+        # Rocks 3%
+        "coastline",
+        "cape",
+        # Other 31%
+        "drain",
+        "storage_tank",
+        "ditch",
+        "wetland",
+        # Misc odd ones
+        "fountain",
+        "reflecting_pool",
+        "splash_pad",
+        "water_park",
+        "wastewater",
+    ],
+    # 15 to 24
+    [
+        # Beach 21%
+        # Beach should take priority over others where present
+        "beach",
+        # River/creek 33%
+        "river",
+        "creek",
+        "stream",
+        "stream_pool",
+        "waterfall",
+        "canal",
+        "weir",
+        # Ocean/harbour 11%
+        "ocean",
+        "harbour",
+        "bay",
+        "lagoon",
+        "inlet",
+        "swimming_area",
+        "breakwater",
+        "marina",
+        "scuba_diving",
+        # Rocks 11%
+        "coastline",
+        "cape",
+        # Lake/dam 9%
+        "lake",
+        "dam",
+        "pond",
+        "natural:water",
+        "reservoir",
+        # Pool 8%
+        "swimming_pool",
+        # Bath 4%
+        # Other 3%
+        "drain",
+        "storage_tank",
+        "ditch",
+        "wetland",
+        # Misc odd ones
+        "fountain",
+        "reflecting_pool",
+        "splash_pad",
+        "water_park",
+        "wastewater",
+    ],
+    # 25 to 64
+    [
+        # Beach 21%
+        # Beach should take priority over others where present
+        "beach",
+        # River/creek 28%
+        "river",
+        "creek",
+        "stream",
+        "stream_pool",
+        "waterfall",
+        "canal",
+        "weir",
+        # Ocean/harbour 20%
+        "ocean",
+        "harbour",
+        "bay",
+        "lagoon",
+        "inlet",
+        "swimming_area",
+        "breakwater",
+        "marina",
+        "scuba_diving",
+        # Rocks 9%
+        "coastline",
+        "cape",
+        # Lake/dam 8%
+        "lake",
+        "dam",
+        "pond",
+        "natural:water",
+        "reservoir",
+        # Pool 7%
+        "swimming_pool",
+        # Bath 5%
+        # Other 2%
+        "drain",
+        "storage_tank",
+        "ditch",
+        "wetland",
+        # Misc odd ones
+        "fountain",
+        "reflecting_pool",
+        "splash_pad",
+        "water_park",
+        "wastewater",
+    ],
+    # 65 and over
+    [
+        # Beach 21%
+        # Beach should take priority over others where present
+        "beach",
+        # River/creek 26%
+        "river",
+        "creek",
+        "stream",
+        "stream_pool",
+        "waterfall",
+        "canal",
+        "weir",
+        # Ocean/harbour 17%
+        "ocean",
+        "harbour",
+        "bay",
+        "lagoon",
+        "inlet",
+        "swimming_area",
+        "breakwater",
+        "marina",
+        "scuba_diving",
+        # Pool 15%
+        "swimming_pool",
+        # Lake/dam 9%
+        "lake",
+        "dam",
+        "pond",
+        "natural:water",
+        "reservoir",
+        # Bath 6%
+        # Rocks 3%
+        "coastline",
+        "cape",
+        # Other 5%
+        "drain",
+        "storage_tank",
+        "ditch",
+        "wetland",
+        # Misc odd ones
+        "fountain",
+        "reflecting_pool",
+        "splash_pad",
+        "water_park",
+        "wastewater",
+    ],
+    # Generic all-age risks, for unknown ages
+    [
+        # Beach 1019
+        "beach",
+        # River/creek 1499
+        "river",
+        "creek",
+        "stream",
+        "stream_pool",
+        "waterfall",
+        "canal",
+        "weir",
+        # Ocean/harbour 906
+        "ocean",
+        "harbour",
+        "bay",
+        "lagoon",
+        "inlet",
+        "swimming_area",
+        "breakwater",
+        "marina",
+        "scuba_diving",
+        # Pool 783
+        "swimming_pool",
+        # Lake/dam 522
+        "lake",
+        "dam",
+        "pond",
+        "natural:water",
+        "reservoir",
+        # Rocks 378
+        "coastline",
+        "cape",
+        # Bath 359
+        # Other 217 + Unknown9
+        "drain",
+        "storage_tank",
+        "ditch",
+        "wetland",
+        # Misc odd ones
+        "fountain",
+        "reflecting_pool",
+        "splash_pad",
+        "water_park",
+        "wastewater",
+    ],
 ]
 
+# The ages each band in RANKINGS ends before; the last band is 65 and over.
+AGE_BAND_LIMITS = [5, 15, 25, 65]
+
+WATER_TYPES = sorted(set().union(*RANKINGS))
+
+# The rank of each type (by its position in WATER_TYPES) for each band. Types
+# a band doesn't list, and unknown types, rank after all the others.
+RANK_TABLE = numpy.full((len(RANKINGS), len(WATER_TYPES) + 1), len(WATER_TYPES))
+for band, rankings in enumerate(RANKINGS):
+    RANK_TABLE[band, [WATER_TYPES.index(t) for t in rankings]] = range(len(rankings))
+
+# Features further than this beyond the nearest are unlikely to be the one
+# involved, for metropolitan (remoteness code 0 or 1) and regional points.
+METRO_WINDOW_METRES = 20
+REGIONAL_WINDOW_METRES = 50
+
+
+def age_bands(ages):
+    ages = numpy.asarray(ages, dtype=float)
+    bands = numpy.searchsorted(AGE_BAND_LIMITS, ages, side="right")
+    bands[numpy.isnan(ages)] = len(RANKINGS) - 1
+    return bands
+
+
+def type_codes(water_types):
+    codes = pandas.Categorical(water_types, categories=WATER_TYPES).codes
+    return numpy.where(codes == -1, len(WATER_TYPES), codes)
+
 
 def map_ranking(age, water_type):
-    if age < 5:
-        rankings = [
-            # Pool 51%
-            "swimming_pool",
-            # Bathtub 16%
-            # Lake/dam 11%
-            "lake",
-            "dam",
-            "pond",
-            "natural:water",
-            "reservoir",
-            # Other 11%
-            "drain",
-            "storage_tank",
-            "ditch",
-            "wetland",
-            # Beach 1%
-            # Beach should take priority over others where present
-            "beach",
-            # River/creek 9%
-            "river",
-            "creek",
-            "stream",
-            "stream_pool",
-            "canal",
-            "weir",
-            # Ocean/harbour 1%
-            "ocean",
-            "harbour",
-            "bay",
-            "lagoon",
-            "inlet",
-            "swimming_area",
-            "breakwater",
-            "marina",
-            "scuba_diving",
-            # Misc odd ones
-            "fountain",
-            "reflecting_pool",
-            "splash_pad",
-            "water_park",
-            "wastewater",
-        ]
-    elif age < 15:
-        rankings = [
-            # Pool 24%
-            "swimming_pool",
-            # Beach 10%
-            # Beach should take priority over others where present
-            "beach",
-            # Lake/dam 16%
-            "lake",
-            "dam",
-            "pond",
-            "natural:water",
-            "reservoir",
-            # Bath 8%
-            # Ocean/harbour 6%
-            "ocean",
-            "harbour",
-            "bay",
-            "lagoon",
-            "inlet",
-            "swimming_area",
-            "breakwater",
-            "marina",
-            "scuba_diving",
-            # River/creek 2%
-            "river",
-            "creek",
-            "stream",
-            "stream_pool",
-            "waterfall",
-            "canal",
-            "weir",
-            # Rocks 3%
-            "coastline",
-            "cape",
-            # Other 31%
-            "drain",
-            "storage_tank",
-            "ditch",
-            "wetland",
-            # Misc odd ones
-            "fountain",
-            "reflecting_pool",
-            "splash_pad",
-            "water_park",
-            "wastewater",
-        ]
-    elif age < 25:
-        rankings = [
-            # Beach 21%
-            # Beach should take priority over others where present
-            "beach",
-            # River/creek 33%
-            "river",
-            "creek",
-            "stream",
-            "stream_pool",
-            "waterfall",
-            "canal",
-            "weir",
-            # Ocean/harbour 11%
-            "ocean",
-            "harbour",
-            "bay",
-            "lagoon",
-            "inlet",
-            "swimming_area",
-            "breakwater",
-            "marina",
-            "scuba_diving",
-            # Rocks 11%
-            "coastline",
-            "cape",
-            # Lake/dam 9%
-            "lake",
-            "dam",
-            "pond",
-            "natural:water",
-            "reservoir",
-            # Pool 8%
-            "swimming_pool",
-            # Bath 4%
-            # Other 3%
-            "drain",
-            "storage_tank",
-            "ditch",
-            "wetland",
-            # Misc odd ones
-            "fountain",
-            "reflecting_pool",
-            "splash_pad",
-            "water_park",
-            "wastewater",
-        ]
-    elif age < 65:
-        rankings = [
-            # Beach 21%
-            # Beach should take priority over others where present
-            "beach",
-            # River/creek 28%
-            "river",
-            "creek",
-            "stream",
-            "stream_pool",
-            "waterfall",
-            "canal",
-            "weir",
-            # Ocean/harbour 20%
-            "ocean",
-            "harbour",
-            "bay",
-            "lagoon",
-            "inlet",
-            "swimming_area",
-            "breakwater",
-            "marina",
-            "scuba_diving",
-            # Rocks 9%
-            "coastline",
-            "cape",
-            # Lake/dam 8%
-            "lake",
-            "dam",
-            "pond",
-            "natural:water",
-            "reservoir",
-            # Pool 7%
-            "swimming_pool",
-            # Bath 5%
-            # Other 2%
-            "drain",
-            "storage_tank",
-            "ditch",
-            "wetland",
-            # Misc odd ones
-            "fountain",
-            "reflecting_pool",
-            "splash_pad",
-            "water_park",
-            "wastewater",
-        ]
-    elif age >= 65:
-        rankings = [
-            # Beach 21%
-            # Beach should take priority over others where present
-            "beach",
-            # River/creek 26%
-            "river",
-            "creek",
-            "stream",
-            "stream_pool",
-            "waterfall",
-            "canal",
-            "weir",
-            # Ocean/harbour 17%
-            "ocean",
-            "harbour",
-            "bay",
-            "lagoon",
-            "inlet",
-            "swimming_area",
-            "breakwater",
-            "marina",
-            "scuba_diving",
-            # Pool 15%
-            "swimming_pool",
-            # Lake/dam 9%
-            "lake",
-            "dam",
-            "pond",
-            "natural:water",
-            "reservoir",
-            # Bath 6%
-            # Rocks 3%
-            "coastline",
-            "cape",
-            # Other 5%
-            "drain",
-            "storage_tank",
-            "ditch",
-            "wetland",
-            # Misc odd ones
-            "fountain",
-            "reflecting_pool",
-            "splash_pad",
-            "water_park",
-            "wastewater",
-        ]
-    else:
-        # Generic all-age risks
-        rankings = [
-            # Beach 1019
-            "beach",
-            # River/creek 1499
-            "river",
-            "creek",
-            "stream",
-            "stream_pool",
-            "waterfall",
-            "canal",
-            "weir",
-            # Ocean/harbour 906
-            "ocean",
-            "harbour",
-            "bay",
-            "lagoon",
-            "inlet",
-            "swimming_area",
-            "breakwater",
-            "marina",
-            "scuba_diving",
-            # Pool 783
-            "swimming_pool",
-            # Lake/dam 522
-            "lake",
-            "dam",
-            "pond",
-            "natural:water",
-            "reservoir",
-            # Rocks 378
-            "coastline",
-            "cape",
-            # Bath 359
-            # Other 217 + Unknown9
-            "drain",
-            "storage_tank",
-            "ditch",
-            "wetland",
-            # Misc odd ones
-            "fountain",
-            "reflecting_pool",
-            "splash_pad",
-            "water_park",
-            "wastewater",
-        ]
-    ranking = rankings.index(water_type)
-    return ranking
+    return RANK_TABLE[age_bands([age])[0], type_codes([water_type])[0]]
 
 
-def apply_heuristic(idx, age, remoteness, water_types, water_distances):
-    if len(water_types) == 1:
-        return 0
+def heuristic_windows(
+    remoteness, metro_window=METRO_WINDOW_METRES, regional_window=REGIONAL_WINDOW_METRES
+):
+    # The window for each point. Points with no remoteness code have no limit.
+    remoteness = numpy.asarray(remoteness, dtype=float)
+    return numpy.where(
+        remoteness <= 1,
+        metro_window,
+        numpy.where(remoteness > 1, regional_window, numpy.inf),
+    )
 
-    if len(water_types) > 1:
-        result = 0
-        result_rank = map_ranking(age, water_types[0])
-        for i in range(1, len(water_types)):
-            if (remoteness <= 1 and water_distances[i] - water_distances[0] > 20) or (
-                remoteness > 1 and water_distances[i] - water_distances[0] > 50
-            ):
-                # Stop, unlikely to be that much further away
-                break
-            rank = map_ranking(age, water_types[i])
-            if rank < result_rank:
-                result = i
-                result_rank = rank
-        if water_types[result] != water_types[0]:
-            print(f"{idx}; {age}; {remoteness}:\n{water_types}\n{water_distances}")
-            print(f"Result: {water_types[result]}, {water_distances[result]}")
-        return result
 
+@metrics.timed("prioritise_location_type.apply_heuristic")
+def apply_heuristic(
+    data, metro_window=METRO_WINDOW_METRES, regional_window=REGIONAL_WINDOW_METRES
+):
+    # The position (in rank order) of the feature most likely to be involved
+    # for each point in data, indexed by patient_id. That is the highest
+    # priority type within the distance window of the nearest feature, or the
+    # nearest of those if there are several. Points without water get NaN.
+    data = data.assign(_point=pandas.factorize(data["patient_id"])[0])
+    points = data.drop_duplicates("_point").set_index("_point")
+    features = data[data["rank"].notna()].sort_values(["_point", "rank"])
+    features = features.reset_index(drop=True)
+    point_ids = features["_point"]
+    by_point = features.groupby("_point", sort=False)
 
-def get_water_fields(data, idx, col_name):
-    num_water = data.at[idx, "water_count"]
-    if pandas.isna(num_water):
-        return []
-    result = []
-    for i in range(int(num_water)):
-        result.append(data.at[idx, f"{col_name}_{i}"])
-    return result
+    window = heuristic_windows(
+        points["incident_remoteness_code"], metro_window, regional_window
+    )
+    beyond = (
+        features["water_distance"] - by_point["water_distance"].transform("first")
+    ) > window[point_ids]
+    # Stop at the first feature outside the window.
+    outside = beyond.groupby(point_ids).cummax()
+
+    ranks = pandas.Series(
+        RANK_TABLE[
+            age_bands(points["age_years"].to_numpy(dtype=float))[point_ids],
+            type_codes(features["water_type"]),
+        ],
+        dtype=float,
+    ).mask(outside)
+    # idxmin gives the first of equally ranked features, i.e. the nearest.
+    best = ranks.groupby(point_ids).idxmin()
+    first = by_point.head(1).set_index("_point")
+    first["index"] = by_point.head(1).index
+    first["best"] = best
+    first["best_type"] = features["water_type"].to_numpy()[first["best"].astype(int)]
+    first["count"] = by_point.size()
+
+    changed = (first["count"] > 1) & ~first["best_type"].eq(first["water_type"])
+    patient_ids = points["patient_id"].to_numpy()
+    ages = points["age_years"].to_numpy()
+    remoteness_codes = points["incident_remoteness_code"].to_numpy()
+    types = features["water_type"].to_numpy()
+    distances = features["water_distance"].to_numpy()
+    if diagnostics.show_progress:
+        for point, start, feature, count in zip(
+            first.index[changed],
+            first.loc[changed, "index"],
+            first.loc[changed, "best"],
+            first.loc[changed, "count"],
+        ):
+            print(
+                f"{patient_ids[point]}; {ages[point]}; {remoteness_codes[point]}:\n"
+                f"{types[start : start + count].tolist()}\n"
+                f"{distances[start : start + count].tolist()}"
+            )
+            print(f"Result: {types[feature]}, {distances[feature]}")
+    # Features with no type are counted too, rather than dropped by groupby.
+    changes = first[changed].groupby(["water_type", "best_type"], dropna=False)
+    for (nearest, best), group in changes:
+        diagnostics.event(
+            "heuristic_changed_type",
+            f"{nearest} -> {best}",
+            patient_ids[group.index],
+            count=len(group),
+        )
+
+    positions = (first["best"] - first["index"]).reindex(points.index)
+    return pandas.Series(
+        positions.to_numpy(dtype=float), index=points["patient_id"].to_numpy()
+    )
+
+
+def prioritise(
+    data, metro_window=METRO_WINDOW_METRES, regional_window=REGIONAL_WINDOW_METRES
+):
+    prioritised = apply_heuristic(data, metro_window, regional_window)
+    return data.assign(prioritised_feature_index=data["patient_id"].map(prioritised))
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("filename")
     parser.add_argument("--limit_points", type=int, required=False)
+    parser.add_argument("--wide", action="store_true")
+    metrics.add_arguments(parser)
+    diagnostics.add_arguments(parser)
     args = parser.parse_args()
+    metrics.configure(args)
+    diagnostics.configure(args)
 
-    data = pandas.read_csv(args.filename)
-    if args.limit_points and args.limit_points < len(data):
-        data = data.head(args.limit_points)
-
-    for idx in data.index:
-        water_fields = {}
-        for colname in water_columns:
-            water_fields[colname] = get_water_fields(data, idx, colname)
-
-        result_idx = apply_heuristic(
-            data.at[idx, "patient_id"],
-            data.at[idx, "age_years"],
-            data.at[idx, "incident_remoteness_code"],
-            water_fields["water_type"],
-            water_fields["water_distance"],
-        )
-        data.at[idx, "prioritised_feature_index"] = result_idx
+    data = water_features.read_csv(args.filename)
+    if args.limit_points:
+        data = water_features.head_points(data, args.limit_points)
 
-    data.set_index("patient_id", inplace=True)
-    data.to_csv(f"{args.filename[:-4]}-heuristic-applied.csv")
+    water_features.write_csv(
+        prioritise(data), f"{args.filename[:-4]}-heuristic-applied.csv", wide=args.wide
+    )
 
 
 if __name__ == "__main__":
@@ -1,17 +1,11 @@
 import argparse
-import collections
 import pandas
 import sys
 
+import diagnostics
+import metrics
 import surf_clubs
-
-
-water_columns = [
-    "water_distance",
-    "water_lifeguard",
-    "water_name",
-    "water_type",
-]
+import water_features
 
 
 def print_stats(l):
@@ -23,172 +17,120 @@ def print_stats(l):
     print(f"IQR: {s.quantile(0.25)} - {s.quantile(0.75)}")
 
 
-def get_water_fields(data, idx, col_name):
-    num_water = data.at[idx, "water_count"]
-    if pandas.isna(num_water):
-        return []
-    result = []
-    for i in range(int(num_water)):
-        result.append(data.at[idx, f"{col_name}_{i}"])
-    return result
-
-
-def remove_indexes(l, indexes_to_remove):
-    indexes_to_remove = sorted(indexes_to_remove)
-    for i in range(len(indexes_to_remove)):
-        r = indexes_to_remove[i] - i
-        l = l[:r] + l[r + 1 :]
-    return l
-
+# Water that is only typed natural:water, but whose name tells us what it is.
+UNTYPED_WATER_TYPES = {
+    "Berrara Creek": "creek",
+    "Kooloonbung Creek": "creek",
+    "Mooball Creek": "creek",
+    "Tallow Creek": "creek",
+    "Muddy Creek": "creek",
+    "Middle Basin": "pond",
+    "Seals for the Wild": "pond",
+    "Northern Water Feature": "pond",
+    "Mill Pond": "pond",
+    "Wagonga Inlet": "harbour",
+    "Boomerang Bay": "swimming_pool",
+    "Olympic Pool": "swimming_pool",
+    "Rapid River": "swimming_pool",
+    "Terranora Broadwater": "lake",
+    "Green Pool": "lake",
+    "Sussex Inlet": "inlet",
+    "Darling Harbour Woodward Water Feature": "fountain",
+    "Engadine Avenue Wetland": "wetland",
+    "Port Hunter / Yohaaba": "river",
+    "Toddlers": "swimming_pool",
+}
+
+# And those that are better known by another name.
+UNTYPED_WATER_NAMES = {
+    "Port Hunter / Yohaaba": "Hunter River",
+    "Toddlers": "Cootamundra Pool",
+}
+
+
+@metrics.timed("process_locations.process")
+def process(data):
+    # Cleans up the water features of each point in data (in the long format),
+    # returning them in the same format with their ranks renumbered.
+    point_columns = water_features.point_columns(data)
+    data = data.assign(_point=pandas.factorize(data["patient_id"])[0])
+    points = data.drop_duplicates("_point")
+    features = data[data["rank"].notna()].sort_values(["_point", "rank"])
+
+    # Disregard piers and bridges (doesn't add anything)
+    features = features[~features["water_type"].isin(["pier", "bridge"])]
+
+    # Convert all lifeguard only to corresponding beach name.
+    # Remove any lifeguards with no name.
+    lifeguards = features["water_type"] == "lifeguard"
+    features = features[~(lifeguards & features["water_name"].isna())].copy()
+    lifeguards = features["water_type"] == "lifeguard"
+    features.loc[lifeguards, "water_name"] = features.loc[
+        lifeguards, "water_name"
+    ].map(surf_clubs.convert_lifeguard_name)
+    features.loc[lifeguards, "water_type"] = "beach"
+
+    # Correct untyped water points.
+    untyped = (features["water_type"] == "natural:water") & features[
+        "water_name"
+    ].notna()
+    known = untyped & features["water_name"].isin(UNTYPED_WATER_TYPES)
+    unnamed_water_series = features.loc[untyped & ~known, "water_name"].tolist()
+    names = features.loc[known, "water_name"]
+    features.loc[known, "water_type"] = names.map(UNTYPED_WATER_TYPES)
+    features.loc[known, "water_name"] = names.replace(UNTYPED_WATER_NAMES)
+
+    # Disregard more distant instances of the same water type, keeping the
+    # first of any that are equally near.
+    features = (
+        features.sort_values("water_distance", kind="stable")
+        .drop_duplicates(["_point", "water_type"])
+        .sort_values(["_point", "rank"])
+    )
+    features["rank"] = features.groupby("_point").cumcount()
 
-def remove_all_indexes(water_fields, indexes_to_remove):
-    for colname in water_columns:
-        water_fields[colname] = remove_indexes(water_fields[colname], indexes_to_remove)
+    # Points left without any water keep a single row.
+    no_water = points[~points["_point"].isin(features["_point"])].assign(
+        rank=None, **{col: None for col in water_features.WATER_COLUMNS}
+    )
+    processed = pandas.concat([features, no_water]).sort_values(["_point", "rank"])
+    processed = processed[point_columns + water_features.FEATURE_COLUMNS]
 
+    print(f"Total number of points: {len(points)}")
+    print(
+        "Point with most water points nearby (pre-processing): "
+        f"{water_features.water_counts(data).max()}"
+    )
+    print(
+        "Point with most water points nearby (post-processing): "
+        f"{water_features.water_counts(processed).max()}"
+    )
 
-def remove_fields(water_fields, colname, to_remove):
-    indexes_to_remove = []
-    for i in range(len(water_fields[colname])):
-        for r in to_remove:
-            if water_fields[colname][i] == r:
-                indexes_to_remove.append(i)
-                break
-    remove_all_indexes(water_fields, indexes_to_remove)
+    print("unnamed water:")
+    print(unnamed_water_series)
+    return processed.reset_index(drop=True)
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("filename")
     parser.add_argument("--limit_points", type=int, required=False)
+    parser.add_argument("--wide", action="store_true")
+    metrics.add_arguments(parser)
+    diagnostics.add_arguments(parser)
     args = parser.parse_args()
+    metrics.configure(args)
+    diagnostics.configure(args)
 
-    data = pandas.read_csv(args.filename)
-    data.set_index("patient_id", inplace=True)
-    if args.limit_points and args.limit_points < len(data):
-        data = data.head(args.limit_points)
-
-    # Create the base for a new output
-    data_no_water = data.copy()
-    cols_to_drop = []
-    for colname in water_columns:
-        for i in range(50):
-            cols_to_drop.append(f"{colname}_{i}")
-    data_no_water = data_no_water.drop(columns=cols_to_drop)
-    for colname in water_columns:
-        for i in range(8):
-            data_no_water.insert(len(data_no_water.columns), f"{colname}_{i}", None)
-
-    # pre counts
-    pre_max_water_count = 0
-    # post counts
-    max_water_count = 0
-    unnamed_water_series = []
-    for idx in data.index:
-        water_fields = {}
-        for colname in water_columns:
-            water_fields[colname] = get_water_fields(data, idx, colname)
-
-        if len(water_fields["water_distance"]) > pre_max_water_count:
-            pre_max_water_count = len(water_fields["water_distance"])
-
-        # Disregard piers and bridges (doesn't add anything)
-        remove_fields(water_fields, "water_type", ["pier", "bridge"])
-
-        # Convert all lifeguard only to corresponding beach name.
-        # Remove any lifeguards with no name.
-        to_remove = []
-        for i in range(len(water_fields["water_type"])):
-            if water_fields["water_type"][i] == "lifeguard":
-                if pandas.notna(water_fields["water_name"][i]):
-                    water_fields["water_name"][i] = surf_clubs.convert_lifeguard_name(
-                        water_fields["water_name"][i]
-                    )
-                    water_fields["water_type"][i] = "beach"
-                else:
-                    to_remove.append(i)
-        remove_all_indexes(water_fields, to_remove)
-
-        # Correct untyped water points.
-        for i in range(len(water_fields["water_type"])):
-            water_type = water_fields["water_type"][i]
-            name = water_fields["water_name"][i]
-            if water_type == "natural:water" and pandas.notna(name):
-                if (
-                    name == "Berrara Creek"
-                    or name == "Kooloonbung Creek"
-                    or name == "Mooball Creek"
-                    or name == "Tallow Creek"
-                    or name == "Muddy Creek"
-                ):
-                    water_fields["water_type"][i] = "creek"
-                elif (
-                    name == "Middle Basin"
-                    or name == "Seals for the Wild"
-                    or name == "Northern Water Feature"
-                    or name == "Mill Pond"
-                ):
-                    water_fields["water_type"][i] = "pond"
-                elif name == "Wagonga Inlet":
-                    water_fields["water_type"][i] = "harbour"
-                elif (
-                    name == "Boomerang Bay"
-                    or name == "Olympic Pool"
-                    or name == "Rapid River"
-                ):
-                    water_fields["water_type"][i] = "swimming_pool"
-                elif name == "Terranora Broadwater" or name == "Green Pool":
-                    water_fields["water_type"][i] = "lake"
-                elif name == "Sussex Inlet":
-                    water_fields["water_type"][i] = "inlet"
-                elif name == "Darling Harbour Woodward Water Feature":
-                    water_fields["water_type"][i] = "fountain"
-                elif name == "Engadine Avenue Wetland":
-                    water_fields["water_type"][i] = "wetland"
-                elif name == "Port Hunter / Yohaaba":
-                    water_fields["water_name"][i] = "Hunter River"
-                    water_fields["water_type"][i] = "river"
-                elif name == "Toddlers":
-                    water_fields["water_type"][i] = "swimming_pool"
-                    water_fields["water_name"][i] = "Cootamundra Pool"
-                else:
-                    unnamed_water_series.append(name)
-
-        # Disregard more distant instances of the same water type
-        to_remove = []
-        types_found = {}
-        for i in range(len(water_fields["water_type"])):
-            water_type = water_fields["water_type"][i]
-            water_distance = water_fields["water_distance"][i]
-            if water_type in types_found and water_distance >= types_found[water_type][0]:
-                to_remove.append(i)
-            elif water_type in types_found and water_distance < types_found[water_type][0]:
-                to_remove.append(types_found[water_type][1])
-                types_found[water_type] = (water_distance, i)
-            else:
-                types_found[water_type] = (water_distance, i)
-        remove_all_indexes(water_fields, to_remove)
-
-        # Save to the new dataset.
-        data_no_water.at[idx, "water_count"] = len(water_fields["water_distance"])
-        for colname in ["water_distance", "water_type", "water_name", "water_lifeguard"]:
-            for i in range(len(water_fields["water_type"])):
-                data_no_water.at[idx, f"{colname}_{i}"] = water_fields[colname][i]
-
-        water_count = len(water_fields["water_distance"])
-        if water_count > max_water_count:
-            max_water_count = water_count
-
-
-    print(f"Total number of points: {len(data)}")
-    print(f"Point with most water points nearby (pre-processing): {pre_max_water_count}")
-    print(f"Point with most water points nearby (post-processing): {max_water_count}")
-
-    print("unnamed water:")
-    print(unnamed_water_series)
+    data = water_features.read_csv(args.filename)
+    if args.limit_points:
+        data = water_features.head_points(data, args.limit_points)
 
     # Output the new dataset to csv.
-    data_no_water.to_csv(
-        f"{args.filename[:-4]}-processed.csv"
+    water_features.write_csv(
+        process(data),
+        f"{args.filename[:-4]}-processed.csv",
+        wide=args.wide,
     )
 
 
@@ -0,0 +1,114 @@
+# A cache of the water found near each location, shared across runs, so that
+# points dispatched to the same place (the same address or beach car park)
+# only have their features found once.
+#
+# Results are keyed on the location rounded to QUANTIZE_DECIMALS decimal
+# places, the search radius, and a hash of water_tags.TAGS, so editing the
+# tags invalidates everything found with the old ones. A repeat location reuses
+# the features, and their distances, found for the first point at it.
+#
+# The cache is a csv file with one row per (location, feature), in the same
+# long format as the feature cache, with a single row with an empty rank for
+# locations with no water.
+
+import hashlib
+import json
+import os
+
+import pandas
+
+import metrics
+import water_features
+import water_tags
+
+# 5 decimal places is about 1m.
+QUANTIZE_DECIMALS = 5
+
+# Read as strings, so that e.g. a name of "1.50" isn't turned into 1.5.
+STRING_COLUMNS = ["water_name", "water_type", "water_lifeguard"]
+
+
+def tags_hash(tags=None):
+    tags = water_tags.TAGS if tags is None else tags
+    return hashlib.sha1(json.dumps(tags, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def location_key(lat, lng):
+    return f"{lat:.{QUANTIZE_DECIMALS}f},{lng:.{QUANTIZE_DECIMALS}f}"
+
+
+class ResultCache:
+    def __init__(self, path, radius, batch_size=100):
+        self.path = path
+        self.radius = radius
+        self.batch_size = batch_size
+        self.tags_hash = tags_hash()
+        self.results = {}
+        self.new_rows = []
+        self.new_locations = 0
+        self.hits = 0
+        self.misses = 0
+        self.write_header = not os.path.exists(path) or os.path.getsize(path) == 0
+        if not self.write_header:
+            self.load()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
+    def __len__(self):
+        return len(self.results)
+
+    @metrics.timed("result_cache.load")
+    def load(self):
+        # Only empty fields are missing values; names like "NA" are kept.
+        rows = pandas.read_csv(
+            self.path,
+            keep_default_na=False,
+            na_values=[""],
+            dtype={c: str for c in ["location", "tags_hash"] + STRING_COLUMNS},
+        )
+        rows = rows[
+            (rows["radius"] == self.radius) & (rows["tags_hash"] == self.tags_hash)
+        ]
+        for location, features in rows.groupby("location", sort=False):
+            self.results[location] = features[
+                water_features.FEATURE_COLUMNS
+            ].to_dict("records")
+
+    def get(self, lat, lng):
+        # The feature rows (rank and WATER_COLUMNS) for the location, or None
+        # if it hasn't been seen before. Locations that had to be looked up and
+        # added are counted as misses.
+        features = self.results.get(location_key(lat, lng))
+        if features is not None:
+            self.hits += 1
+            metrics.count("result_cache.hits")
+        return features
+
+    def add(self, lat, lng, rows):
+        # Records the rows found for a location, taking just the feature
+        # columns.
+        location = location_key(lat, lng)
+        features = [{c: row[c] for c in water_features.FEATURE_COLUMNS} for row in rows]
+        self.results[location] = features
+        self.misses += 1
+        metrics.count("result_cache.misses")
+        key = {"location": location, "radius": self.radius, "tags_hash": self.tags_hash}
+        self.new_rows.extend({**key, **f} for f in features)
+        self.new_locations += 1
+        if self.new_locations >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.new_rows) == 0:
+            return
+        with open(self.path, "a", newline="") as f:
+            water_features.write_csv(
+                pandas.DataFrame(self.new_rows), f, header=self.write_header
+            )
+        self.write_header = False
+        self.new_rows = []
+        self.new_locations = 0
@@ -0,0 +1,127 @@
+# A spatial index over water features, for finding the features near points
+# and how far away they are. "Near" means the same as for an Overpass query:
+# intersecting the box osmnx queries around the point. Geometries are projected
+# to EPSG:3308 once when the index is built, so a query only needs to project
+# the points and measure distances to the features in their boxes. Many points
+# can be queried at once, giving a sparse table of (point, feature, distance)
+# for the pairs that are near each other.
+
+import functools
+
+import numpy
+import pandas
+import pyproj
+import shapely
+
+import metrics
+
+# EPSG 3308 is a NSW-specific projection that corresponds to GDA94 Lambert.
+# https://www.spatial.nsw.gov.au/surveying/geodesy/projections
+DISTANCE_CRS = "EPSG:3308"
+
+# The column features' distances from a point are added in, in metres. It isn't
+# a tag name, as OSM features can have a "distance" tag.
+DISTANCE_COLUMN = "_distance"
+
+# The radius of the Earth osmnx.utils_geo.bbox_from_point uses, in metres.
+EARTH_RADIUS_METRES = 6_371_009
+
+
+# Building a transformer is much slower than using one, so they are reused.
+@functools.lru_cache(maxsize=None)
+def get_transformer(from_crs, to_crs=DISTANCE_CRS):
+    return pyproj.Transformer.from_crs(from_crs, to_crs, always_xy=True)
+
+
+to_distance_crs = get_transformer("EPSG:4326")
+
+
+@metrics.timed("spatial_index.project_points")
+def project_points(lats, lngs):
+    x, y = to_distance_crs.transform(
+        numpy.asarray(lngs, dtype=float), numpy.asarray(lats, dtype=float)
+    )
+    return shapely.points(x, y)
+
+
+@metrics.timed("spatial_index.project_geometries")
+def project_geometries(geometries, crs):
+    transformer = get_transformer(crs)
+
+    def transform(coords):
+        return numpy.column_stack(transformer.transform(coords[:, 0], coords[:, 1]))
+
+    return shapely.transform(numpy.asarray(geometries), transform)
+
+
+# The same (left, bottom, right, top) boxes, in lat/lng degrees, as
+# osmnx.utils_geo.bbox_from_point makes around each point, which is what an
+# Overpass query for the features near a point fetches. They reach past radius
+# metres from the point, out to about 1.4 times it in the corners.
+def bboxes_from_points(lats, lngs, radius):
+    lats = numpy.asarray(lats, dtype=float)
+    lngs = numpy.asarray(lngs, dtype=float)
+    delta_lat = numpy.rad2deg(radius / EARTH_RADIUS_METRES)
+    delta_lng = numpy.rad2deg(radius / EARTH_RADIUS_METRES) / numpy.cos(
+        numpy.deg2rad(lats)
+    )
+    return shapely.box(
+        lngs - delta_lng, lats - delta_lat, lngs + delta_lng, lats + delta_lat
+    )
+
+
+class FeatureIndex:
+    def __init__(self, gdf):
+        self.gdf = gdf
+        self.geometries = project_geometries(gdf.geometry.to_numpy(), gdf.crs)
+
+    def __len__(self):
+        return len(self.geometries)
+
+    @metrics.timed("spatial_index.query_points")
+    def query_points(self, lats, lngs, radius):
+        # A table of the (point, feature) pairs where the feature intersects
+        # the point's bboxes_from_points box, as positions in lats/lngs and
+        # self.gdf, and their distances rounded to cm. Sorted by point, then
+        # feature.
+        boxes = bboxes_from_points(lats, lngs, radius)
+        point_idx, feature_idx = self.gdf.sindex.query(boxes, predicate="intersects")
+        points = project_points(lats, lngs)
+        order = numpy.lexsort((feature_idx, point_idx))
+        point_idx = point_idx[order]
+        feature_idx = feature_idx[order]
+        distances = shapely.distance(points[point_idx], self.geometries[feature_idx])
+        return pandas.DataFrame(
+            {
+                "point": point_idx,
+                "feature": feature_idx,
+                "distance": numpy.round(distances, 2),
+            }
+        )
+
+    def query(self, lat, lng, radius):
+        # Positions (in self.gdf) of the features near the point, and their
+        # distances from it.
+        pairs = self.query_points([lat], [lng], radius)
+        return pairs["feature"].to_numpy(), pairs["distance"].to_numpy()
+
+    @metrics.timed("spatial_index.features_near_points")
+    def features_near_points(self, lats, lngs, radius):
+        # For each point, the features near it with a DISTANCE_COLUMN, or None
+        # if there aren't any.
+        result = [None] * len(lats)
+        pairs = self.query_points(lats, lngs, radius)
+        starts = numpy.flatnonzero(numpy.diff(pairs["point"].to_numpy(), prepend=-1))
+        ends = numpy.append(starts[1:], len(pairs))
+        for start, end in zip(starts, ends):
+            point = pairs.at[start, "point"]
+            # Match osmnx, which drops tags that none of the returned features
+            # use.
+            gdf = self.gdf.iloc[pairs["feature"].to_numpy()[start:end]]
+            gdf = gdf.dropna(axis="columns", how="all")
+            gdf[DISTANCE_COLUMN] = pairs["distance"].to_numpy()[start:end]
+            result[point] = gdf
+        return result
+
+    def features_near_point(self, lat, lng, radius):
+        return self.features_near_points([lat], [lng], radius)[0]
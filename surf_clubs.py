@@ -1,3 +1,5 @@
+import diagnostics
+
 SURF_CLUBS = {
     "Austinmer Surf Life Saving Club": "Austinmer Beach",
     "Avalon Beach Surf Life Saving Club": "Avalon Beach",
@@ -68,4 +70,4 @@ SURF_CLUBS = {
 def convert_lifeguard_name(name):
     if name in SURF_CLUBS:
         return SURF_CLUBS[name]
-    print(f"Could not convert lifeguard name {name}")
+    diagnostics.event("unknown_lifeguard_name", str(name))
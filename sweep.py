@@ -0,0 +1,164 @@
+# Shows how sensitive the results are to the radii used by add_water_to_data.py
+# and the distance windows used by prioritise_location_type.py, by evaluating a
+# grid of them at once.
+#
+# The cached water features are read, added to the points and processed once,
+# using the largest radius. This gives the same result as processing at any
+# smaller radius and then dropping the features beyond it, because the
+# features within a radius are always the nearest ones, and processing only
+# ever keeps or drops a feature based on it and the nearer features. Each
+# combination of parameters is then just a mask over the processed features.
+
+import argparse
+import itertools
+import sys
+import time
+
+import numpy
+import pandas
+
+import add_water_to_data
+import cache_water_points
+import diagnostics
+import metrics
+import prioritise_location_type
+import process_locations
+
+# The value of prioritised_type for points with no water within the radius.
+NO_WATER = "none"
+
+
+class Sweep:
+    def __init__(self, in_data, max_radius, cache=None):
+        with_water = add_water_to_data.join_water(
+            in_data, cache=cache, radius=max_radius, regional_radius=max_radius
+        )
+        data = process_locations.process(with_water)
+
+        data = data.assign(_point=pandas.factorize(data["patient_id"])[0])
+        points = data.drop_duplicates("_point")
+        features = data[data["rank"].notna()].sort_values(["_point", "rank"])
+        self.num_points = len(points)
+        self.remoteness = points["incident_remoteness_code"].to_numpy(dtype=float)
+
+        self.point = features["_point"].to_numpy()
+        self.distances = features["water_distance"].to_numpy(dtype=float)
+        self.types = features["water_type"].fillna("").to_numpy()
+        # Distances beyond each point's nearest feature, for the windows.
+        nearest = features.groupby("_point")["water_distance"].transform("first")
+        self.beyond_nearest = self.distances - nearest.to_numpy(dtype=float)
+
+        ranks = prioritise_location_type.RANK_TABLE[
+            prioritise_location_type.age_bands(points["age_years"])[self.point],
+            prioritise_location_type.type_codes(features["water_type"]),
+        ]
+        # The features by point, then priority, then distance, so the first of
+        # each point's features left by a mask is the one prioritised.
+        positions = numpy.arange(len(features))
+        self.priority_order = numpy.lexsort((positions, ranks, self.point))
+
+    @metrics.timed("sweep.evaluate")
+    def evaluate(self, metro_radius, regional_radius, metro_window, regional_window):
+        # The number of points whose prioritised feature is of each type, and
+        # with no water at all.
+        radii = add_water_to_data.point_radii(
+            self.remoteness, metro_radius, regional_radius
+        )
+        windows = prioritise_location_type.heuristic_windows(
+            self.remoteness, metro_window, regional_window
+        )
+        candidates = (self.distances <= radii[self.point]) & (
+            self.beyond_nearest <= windows[self.point]
+        )
+        order = self.priority_order[candidates[self.priority_order]]
+        _, first = numpy.unique(self.point[order], return_index=True)
+        prioritised = self.types[order[first]]
+
+        counts = pandas.Series(prioritised).value_counts()
+        counts[NO_WATER] = self.num_points - len(prioritised)
+        return counts
+
+
+def sweep(in_data, metro_radii, regional_radii, metro_windows, regional_windows):
+    cache = cache_water_points.get_cached_features()
+    s = Sweep(in_data, max(metro_radii + regional_radii), cache=cache)
+
+    results = []
+    grid = itertools.product(metro_radii, regional_radii, metro_windows, regional_windows)
+    for metro_radius, regional_radius, metro_window, regional_window in grid:
+        counts = s.evaluate(metro_radius, regional_radius, metro_window, regional_window)
+        results.append(
+            pandas.DataFrame(
+                {
+                    "metro_radius": metro_radius,
+                    "regional_radius": regional_radius,
+                    "metro_window": metro_window,
+                    "regional_window": regional_window,
+                    "prioritised_type": counts.index,
+                    "points": counts.to_numpy(),
+                    "proportion": counts.to_numpy() / s.num_points,
+                }
+            )
+        )
+    return pandas.concat(results, ignore_index=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("filename")
+    parser.add_argument("--limit_points", type=int, required=False)
+    parser.add_argument(
+        "--metro_radii", type=int, nargs="+", default=[add_water_to_data.METRO_RADIUS]
+    )
+    parser.add_argument(
+        "--regional_radii",
+        type=int,
+        nargs="+",
+        default=[add_water_to_data.REGIONAL_RADIUS],
+    )
+    parser.add_argument(
+        "--metro_windows",
+        type=float,
+        nargs="+",
+        default=[prioritise_location_type.METRO_WINDOW_METRES],
+    )
+    parser.add_argument(
+        "--regional_windows",
+        type=float,
+        nargs="+",
+        default=[prioritise_location_type.REGIONAL_WINDOW_METRES],
+    )
+    metrics.add_arguments(parser)
+    diagnostics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.configure(args)
+    diagnostics.configure(args)
+    if max(args.metro_radii + args.regional_radii) > cache_water_points.RADIUS_METRES:
+        parser.error(
+            f"the cache only has water within {cache_water_points.RADIUS_METRES}m"
+        )
+
+    in_data = pandas.read_csv(args.filename)
+    if args.limit_points and args.limit_points < len(in_data):
+        in_data = in_data.head(args.limit_points)
+
+    start = time.perf_counter()
+    results = sweep(
+        in_data,
+        args.metro_radii,
+        args.regional_radii,
+        args.metro_windows,
+        args.regional_windows,
+    )
+    combinations = len(results.drop_duplicates(results.columns[:4].tolist()))
+    print(f"Evaluated {combinations} combinations in {time.perf_counter() - start:.1f}s")
+
+    in_filename = args.filename.split("/")[-1]
+    in_filename = in_filename.split(".")[-2]
+    out_path = f"outputs/{in_filename}-sweep.csv"
+    results.to_csv(out_path, index=False)
+    print(f"Wrote {out_path}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+import pandas
+import pytest
+
+import add_water_to_data
+import cache_water_points
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # A cache and input file, with the outputs directory the scripts write to.
+    rows = []
+    for i in range(20):
+        if i % 5 == 0:
+            # No water nearby.
+            rows.append([f"P{i}", 1.1, None, None, None, None, None])
+            continue
+        for rank in range(i % 4 + 1):
+            rows.append(
+                [
+                    f"P{i}",
+                    1.1,
+                    rank,
+                    f"Water {rank}" if rank % 2 else None,
+                    "beach" if rank == 0 else "swimming_pool",
+                    50.0 + 150 * rank + i,
+                    "yes" if i == 7 else None,
+                ]
+            )
+    cache = pandas.DataFrame(
+        rows,
+        columns=["patient_id", "accuracy_metres", "rank", "water_name", "water_type"]
+        + ["water_distance", "water_lifeguard"],
+    )
+    (tmp_path / "data").mkdir()
+    cache.to_csv(tmp_path / cache_water_points.CACHE_PATH, index=False)
+    points = pandas.DataFrame(
+        {
+            "patient_id": [f"P{i}" for i in range(20)],
+            "Pickup_Latitude": [None if i == 3 else -33.8 for i in range(20)],
+            "Pickup_Longitude": [151.2] * 20,
+            "incident_remoteness_code": [i % 5 for i in range(20)],
+            "age_years": [30] * 20,
+        }
+    )
+    points.to_csv(tmp_path / "points.csv", index=False)
+    (tmp_path / "outputs").mkdir()
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(cache_water_points, "_cached_features", None)
+    return tmp_path
+
+
+@pytest.mark.parametrize("radii", [None, [100, 300, 500]])
+def test_chunked_matches_whole_file(workdir, radii):
+    in_data = pandas.read_csv("points.csv")
+    if radii:
+        add_water_to_data.run_radii(in_data, "points", radii)
+        path = "outputs/points-with-water-radii.csv"
+    else:
+        add_water_to_data.run(in_data, "points")
+        path = "outputs/points-with-water.csv"
+    whole = open(path).read()
+
+    add_water_to_data.run_chunked("points.csv", "points", 3, radii=radii)
+    assert open(path).read() == whole
+
+
+def test_chunked_limit_points(workdir):
+    add_water_to_data.run(pandas.read_csv("points.csv").head(8), "points")
+    whole = open("outputs/points-with-water.csv").read()
+
+    add_water_to_data.run_chunked("points.csv", "points", 3, limit_points=8)
+    assert open("outputs/points-with-water.csv").read() == whole
+
+
+def test_chunked_rejects_duplicates_across_chunks(workdir):
+    points = pandas.read_csv("points.csv")
+    points.loc[10, "patient_id"] = "P1"
+    points.to_csv("points.csv", index=False)
+    with pytest.raises(ValueError):
+        add_water_to_data.run_chunked("points.csv", "points", 3)
+
+
+@pytest.mark.parametrize("radii", [None, [100, 300, 500]])
+def test_rejects_duplicates(workdir, radii):
+    points = pandas.read_csv("points.csv")
+    points.loc[10, "patient_id"] = "P1"
+    with pytest.raises(ValueError, match="more than once"):
+        if radii:
+            add_water_to_data.join_water_radii(points, radii)
+        else:
+            add_water_to_data.join_water(points)
+
+
+def test_cache_index_keeps_cache_order_and_dtypes(workdir):
+    cache = cache_water_points.load_cached_features()
+    with add_water_to_data.CacheIndex(cache_water_points.CACHE_PATH, 4) as index:
+        rows = index.lookup(["P7", "P2"])
+    expected = cache.loc[["P2", "P7"]]
+    expected = expected[add_water_to_data.usable_features(expected)]
+    pandas.testing.assert_frame_equal(rows, expected)
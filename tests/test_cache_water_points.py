@@ -0,0 +1,185 @@
+import geopandas
+import osmnx
+import pandas
+import pandas.testing
+import pytest
+import shapely
+
+import build_water_index
+import cache_water_points
+import feature_sources
+import water_features
+import water_index
+
+
+@pytest.mark.parametrize("block_bytes", [4, 1024])
+@pytest.mark.parametrize(
+    "content, expected",
+    [
+        (b"a,b\n1,2\n3,", b"a,b\n1,2\n"),
+        (b"a,b\n1,2\n", b"a,b\n1,2\n"),
+        (b"a,b\n1,2\n" + b"3" * 50, b"a,b\n1,2\n"),
+        (b"a,b", b""),
+    ],
+)
+def test_truncate_partial_line(tmp_path, monkeypatch, block_bytes, content, expected):
+    monkeypatch.setattr(cache_water_points, "TRUNCATE_BLOCK_BYTES", block_bytes)
+    path = tmp_path / "cache.csv"
+    path.write_bytes(content)
+    cache_water_points.truncate_partial_line(path)
+    assert path.read_bytes() == expected
+
+
+def test_merge_cache_uses_existing_columns(tmp_path):
+    path = tmp_path / "cache.csv"
+    other_path = tmp_path / "other.csv"
+    pandas.DataFrame(
+        {
+            "patient_id": ["A", "B"],
+            "accuracy_metres": [1.1, 1.1],
+            "rank": [0, 0],
+            "water_type": ["beach", "river"],
+            "water_distance": [10.0, 20.0],
+        }
+    ).to_csv(path, index=False)
+    # Another order, an extra column, and no accuracy_metres.
+    pandas.DataFrame(
+        {
+            "water_distance": [30.0, 40.0, 50.0],
+            "water_type": ["lake", "swimming_pool", "stream"],
+            "rank": [0, 1, 0],
+            "patient_id": ["B", "C", "C"],
+            "water_lifeguard": ["yes", None, None],
+        }
+    ).to_csv(other_path, index=False)
+    cache_water_points.merge_cache(str(path), str(other_path), 1)
+
+    merged = pandas.read_csv(path)
+    assert list(merged.columns) == [
+        "patient_id",
+        "accuracy_metres",
+        "rank",
+        "water_type",
+        "water_distance",
+    ]
+    assert list(merged["patient_id"]) == ["A", "B", "C", "C"]
+    assert list(merged["water_type"]) == ["beach", "river", "swimming_pool", "stream"]
+    assert list(merged["water_distance"]) == [10.0, 20.0, 40.0, 50.0]
+
+
+@pytest.mark.parametrize("local", [False, True])
+def test_distance_tag_is_not_the_distance(local):
+    # OSM features can have a distance tag, e.g. a route's length.
+    gdf = geopandas.GeoDataFrame(
+        {"natural": ["beach"], "name": ["Test Beach"], "distance": ["5 km"]},
+        geometry=geopandas.points_from_xy([151.201], [-33.8]),
+        crs="EPSG:4326",
+        index=pandas.MultiIndex.from_tuples([("node", 1)], names=["element", "id"]),
+    )
+    if local:
+        gdf = feature_sources.LocalExtractSource(gdf).features_near_point(
+            -33.8, 151.2, 500
+        )
+    gdf = cache_water_points.process_features(gdf, -33.8, 151.2)
+    rows = cache_water_points.point_rows("P0", (-33.8, 151.2), gdf)
+    assert [row["water_distance"] for row in rows] == [pytest.approx(92.6, abs=1)]
+
+
+def test_wide_cache_converted_in_place(tmp_path, monkeypatch):
+    path = str(tmp_path / "cache.csv")
+    long = pandas.DataFrame(
+        {
+            "patient_id": ["A", "A", "B"],
+            "accuracy_metres": [1.1, 1.1, 1.1],
+            "rank": [0, 1, None],
+            "water_name": ["Test Beach", None, None],
+            "water_type": ["beach", "river", None],
+            "water_distance": [10.0, 20.0, None],
+            "water_lifeguard": [None, None, None],
+        }
+    )
+    water_features.write_csv(long, path, wide=True)
+    with open(path, "rb") as f:
+        wide = f.read()
+
+    # Interrupted part way through writing the long file.
+    def write_partly(df, path_or_buf, **kwargs):
+        with open(path_or_buf, "w") as f:
+            f.write("patient_id,")
+        raise KeyboardInterrupt
+
+    with monkeypatch.context() as m:
+        m.setattr(water_features, "write_csv", write_partly)
+        with pytest.raises(KeyboardInterrupt):
+            cache_water_points.CacheWriter(path)
+    with open(path, "rb") as f:
+        assert f.read() == wide
+
+    with cache_water_points.CacheWriter(path) as writer:
+        assert writer.columns == list(long.columns)
+    assert not water_features.is_wide(pandas.read_csv(path, nrows=0))
+    assert list(water_features.read_csv(path)["water_type"].fillna("")) == [
+        "beach",
+        "river",
+        "",
+    ]
+
+
+def test_local_sources_find_the_same_features_as_overpass(tmp_path, monkeypatch):
+    # Around (-33.8, 151.2), osmnx queries the box 0.0045 degrees of latitude
+    # and 0.0054 of longitude either side. A pool and a beach are in its
+    # corners, further away than the radius, and a river is just outside it.
+    # Near the point are some coastline and Port Jackson, which are only kept
+    # if the beach isn't found and if nothing else is.
+    gdf = geopandas.GeoDataFrame(
+        {
+            "leisure": ["swimming_pool", None, None, None, None],
+            "access": ["yes", None, None, None, None],
+            "natural": [None, "beach", "coastline", "water", None],
+            "waterway": [None, None, None, None, "river"],
+            "name": ["Corner Pool", "Corner Beach", None, "Port Jackson", "River"],
+        },
+        geometry=[
+            shapely.Point(151.2052, -33.7957),
+            shapely.Point(151.1948, -33.8043),
+            shapely.LineString([(151.199, -33.8005), (151.201, -33.8005)]),
+            shapely.box(151.2003, -33.7998, 151.21, -33.79),
+            shapely.LineString([(151.19, -33.7953), (151.21, -33.7953)]),
+        ],
+        crs="EPSG:4326",
+        index=pandas.MultiIndex.from_tuples(
+            [("way", i) for i in range(5)], names=["element", "id"]
+        ),
+    )
+
+    def features_from_bbox(bbox, tags):
+        # Overpass returns the features in the box, which osmnx then filters.
+        polygon = osmnx.utils_geo.bbox_to_poly(bbox)
+        return osmnx.features._filter_features(gdf.copy(), polygon, tags)
+
+    monkeypatch.setattr(osmnx.features, "features_from_bbox", features_from_bbox)
+    latlngs = pandas.DataFrame(
+        {
+            "patient_id": ["A", "B"],
+            "Pickup_Latitude": [-33.80001, -33.70001],
+            "Pickup_Longitude": [151.20001, 151.20001],
+        }
+    )
+    radius = cache_water_points.RADIUS_METRES
+    expected = cache_water_points.find_features(
+        latlngs, source=feature_sources.OverpassSource()
+    )
+    corner = expected.loc["A"]
+    assert corner["water_name"].tolist() == ["Corner Beach", "Corner Pool"]
+    assert (corner["water_distance"] > radius).all()
+
+    local = feature_sources.LocalExtractSource(gdf)
+    build_water_index.build(local, str(tmp_path / "index"))
+    sources = [
+        local,
+        feature_sources.TiledSource(local, 1000, radius),
+        water_index.WaterIndex(str(tmp_path / "index")),
+    ]
+    for source in sources:
+        features = cache_water_points.find_features(latlngs, source=source)
+        pandas.testing.assert_frame_equal(features, expected, check_dtype=False)
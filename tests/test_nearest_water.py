@@ -0,0 +1,92 @@
+import geopandas
+import numpy
+import pandas
+import pytest
+import shapely
+
+import nearest_water
+import spatial_index
+
+
+@pytest.fixture
+def nearest():
+    # Beaches and pools scattered over a few km, some of them the same distance
+    # from the points.
+    rng = numpy.random.default_rng(1)
+    n = 60
+    lats = -33.8 + rng.uniform(-0.03, 0.03, n)
+    lngs = 151.2 + rng.uniform(-0.03, 0.03, n)
+    lats[:4] = -33.801
+    lngs[:4] = 151.2
+    gdf = geopandas.GeoDataFrame(
+        {
+            "natural": ["beach" if i % 2 else None for i in range(n)],
+            "leisure": [None if i % 2 else "swimming_pool" for i in range(n)],
+            "access": [None if i % 2 else "yes" for i in range(n)],
+            "name": [f"Water {i}" for i in range(n)],
+        },
+        geometry=geopandas.points_from_xy(lngs, lats),
+        crs="EPSG:4326",
+        index=pandas.MultiIndex.from_tuples(
+            [("node", i) for i in range(n)], names=["element", "id"]
+        ),
+    )
+    return nearest_water.NearestWater(gdf)
+
+
+def brute_force(nearest, lats, lngs, water_type, k, max_distance):
+    points = spatial_index.project_points(lats, lngs)
+    positions, _ = nearest.trees[water_type]
+    rows = []
+    for point in range(len(points)):
+        distances = numpy.round(
+            shapely.distance(points[point], nearest.geometries[positions]), 2
+        )
+        order = numpy.lexsort((positions, distances))
+        if max_distance is not None:
+            order = order[distances[order] <= max_distance]
+        for rank, i in enumerate(order[:k]):
+            rows.append([point, positions[i], distances[i], rank])
+    return pandas.DataFrame(rows, columns=["point", "feature", "distance", "rank"])
+
+
+@pytest.mark.parametrize("k", [1, 3, 10])
+@pytest.mark.parametrize("max_distance", [None, 500, 1500])
+def test_nearest_matches_brute_force(nearest, k, max_distance):
+    rng = numpy.random.default_rng(2)
+    lats = numpy.append(-33.8 + rng.uniform(-0.05, 0.05, 30), -33.8)
+    lngs = numpy.append(151.2 + rng.uniform(-0.05, 0.05, 30), 151.2)
+    for water_type in nearest.trees:
+        pairs = nearest.nearest(lats, lngs, water_type, k, max_distance)
+        expected = brute_force(nearest, lats, lngs, water_type, k, max_distance)
+        pandas.testing.assert_frame_equal(pairs, expected, check_dtype=False)
+
+
+def test_nearest_without_max_distance_finds_k(nearest):
+    # Far from every feature, so no fixed radius would find them.
+    pairs = nearest.nearest([-34.5, numpy.nan], [150.0, 151.2], "beach", 5, None)
+    assert list(pairs["point"]) == [0] * 5
+    assert list(pairs["rank"]) == list(range(5))
+    assert pairs["distance"].is_monotonic_increasing
+    assert (pairs["distance"] > 50_000).all()
+
+
+def test_nearest_water_keeps_input_order(nearest):
+    in_data = pandas.DataFrame(
+        {
+            "patient_id": ["B", "A", "B", "C"],
+            "Pickup_Latitude": [-33.81, -33.79, numpy.nan, -33.8],
+            "Pickup_Longitude": [151.21, 151.19, 151.2, 151.2],
+        }
+    )
+    result = nearest_water.nearest_water(in_data, nearest, k=2, max_distance=None)
+    assert list(result["patient_id"]) == ["B"] * 4 + ["A"] * 4 + ["C"] * 4
+    assert list(result["water_type"][:4]) == ["beach", "beach"] + ["swimming_pool"] * 2
+    assert list(result["rank"][:4]) == [0, 1, 0, 1]
+
+
+def test_needs_osm_ids(nearest):
+    with pytest.raises(ValueError, match="no element or id level"):
+        nearest_water.NearestWater(nearest.gdf.reset_index(drop=True))
+    with pytest.raises(ValueError, match="no id level"):
+        nearest_water.NearestWater(nearest.gdf.droplevel("id"))
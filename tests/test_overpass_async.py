@@ -0,0 +1,107 @@
+import asyncio
+
+import aiohttp
+import osmnx
+import pytest
+from aiohttp import test_utils, web
+
+import overpass_async
+
+BBOX = (151.19, -33.81, 151.21, -33.79)
+
+RESPONSE = {
+    "version": 0.6,
+    "elements": [
+        {
+            "type": "node",
+            "id": 1,
+            "lat": -33.8,
+            "lon": 151.2,
+            "tags": {"natural": "beach", "name": "Test Beach"},
+        }
+    ],
+}
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(overpass_async, "BACKOFF_BASE_SECONDS", 0)
+
+
+def serve(responses):
+    # Runs fetch(client) against a local Overpass server that answers each
+    # query with the next of responses: a status code, or "slow" to not answer
+    # before the client times out. Returns the result and the number of
+    # queries the server got.
+    async def run(fetch):
+        queries = []
+
+        async def interpreter(request):
+            queries.append((await request.post())["data"])
+            response = responses[min(len(queries), len(responses)) - 1]
+            if response == "slow":
+                await asyncio.sleep(5)
+            if response != 200:
+                return web.Response(status=429 if response == "slow" else response)
+            return web.json_response(RESPONSE)
+
+        async def status(request):
+            return web.Response(text="Rate limit: 0\n2 slots available now.\n")
+
+        app = web.Application()
+        app.router.add_post("/interpreter", interpreter)
+        app.router.add_get("/status", status)
+        async with test_utils.TestServer(app) as server:
+            endpoint = str(server.make_url("/"))
+            async with overpass_async.AsyncOverpassClient(2, endpoint) as client:
+                result = await fetch(client)
+        return result, len(queries), client
+
+    return run
+
+
+def test_retries_rate_limiting():
+    run = serve([429, 200])
+    gdf, queries, client = asyncio.run(run(lambda c: c.features_in_bbox(BBOX)))
+    assert queries == 2
+    assert client.retries == 1
+    assert list(gdf["name"]) == ["Test Beach"]
+    assert list(gdf.index) == [("node", 1)]
+
+
+def test_retries_timeouts(monkeypatch):
+    monkeypatch.setattr(osmnx.settings, "requests_timeout", 0.5)
+    run = serve(["slow", 200])
+    gdf, queries, client = asyncio.run(run(lambda c: c.features_in_bbox(BBOX)))
+    assert queries == 2
+    assert client.retries == 1
+    assert list(gdf["name"]) == ["Test Beach"]
+
+
+def test_other_errors_are_raised():
+    run = serve([400, 200])
+    with pytest.raises(aiohttp.ClientResponseError) as e:
+        asyncio.run(run(lambda c: c.features_in_bbox(BBOX)))
+    assert e.value.status == 400
+
+
+def test_gives_up_after_max_retries(monkeypatch):
+    monkeypatch.setattr(overpass_async, "MAX_RETRIES", 2)
+    run = serve([429])
+    with pytest.raises(RuntimeError, match="rate limiting"):
+        asyncio.run(run(lambda c: c.post("query")))
+
+
+def test_without_osmnx_internals(monkeypatch):
+    # Falls back on osmnx's public API, which uses osmnx.settings.overpass_url.
+    monkeypatch.setattr(overpass_async, "_create_gdf", None)
+    monkeypatch.setattr(osmnx.settings, "use_cache", False)
+    monkeypatch.setattr(osmnx.settings, "overpass_rate_limit", False)
+
+    async def fetch(client):
+        monkeypatch.setattr(osmnx.settings, "overpass_url", client.endpoint)
+        return await client.features_in_bbox(BBOX)
+
+    gdf, queries, _ = asyncio.run(serve([200])(fetch))
+    assert queries == 1
+    assert list(gdf["name"]) == ["Test Beach"]
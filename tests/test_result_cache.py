@@ -0,0 +1,80 @@
+import geopandas
+import pandas
+import pandas.testing
+import pytest
+
+import cache_water_points
+import feature_sources
+import result_cache
+import water_tags
+
+
+@pytest.fixture
+def source():
+    # A beach and a pool near the points.
+    gdf = geopandas.GeoDataFrame(
+        {
+            "natural": ["beach", None],
+            "leisure": [None, "swimming_pool"],
+            "access": [None, "yes"],
+            "name": ["Test Beach", "Test Pool"],
+        },
+        geometry=geopandas.points_from_xy([151.2, 151.202], [-33.8, -33.801]),
+        crs="EPSG:4326",
+        index=pandas.MultiIndex.from_tuples(
+            [("node", 1), ("node", 2)], names=["element", "id"]
+        ),
+    )
+    return feature_sources.LocalExtractSource(gdf)
+
+
+@pytest.fixture
+def latlngs():
+    # Repeated locations, including one only repeated after a point elsewhere,
+    # and points with no or an inaccurate location.
+    lats = [-33.8001, -33.8011, -33.8001, None, -33.8, -33.8011, -33.8001, -34.0]
+    lngs = [151.2001, 151.2011, 151.2001, 151.2, 151.2, 151.2011, 151.2001, 151.0]
+    return pandas.DataFrame(
+        {
+            "patient_id": [f"P{i}" for i in range(len(lats))],
+            "Pickup_Latitude": lats,
+            "Pickup_Longitude": lngs,
+        }
+    )
+
+
+def test_same_rows_as_without_cache(tmp_path, source, latlngs):
+    expected = cache_water_points.find_features(latlngs, source=source)
+    path = tmp_path / "results.csv"
+    with result_cache.ResultCache(path, cache_water_points.RADIUS_METRES) as results:
+        features = cache_water_points.find_features(latlngs, source, results=results)
+    pandas.testing.assert_frame_equal(features, expected)
+    assert (results.hits, results.misses) == (3, 2)
+
+    # From the file.
+    with result_cache.ResultCache(path, cache_water_points.RADIUS_METRES) as results:
+        features = cache_water_points.find_features(latlngs, source, results=results)
+    # As written to the cache; missing values are read back as NaN, not None.
+    assert features.to_csv() == expected.to_csv()
+    assert (results.hits, results.misses) == (5, 0)
+
+
+def test_invalidated_by_radius_and_tags(tmp_path, monkeypatch):
+    path = tmp_path / "results.csv"
+    row = {
+        "rank": 0,
+        "water_name": "Test Beach",
+        "water_type": "beach",
+        "water_distance": 10.0,
+        "water_lifeguard": None,
+    }
+    with result_cache.ResultCache(path, 500) as results:
+        results.add(-33.8, 151.2, [row])
+
+    assert len(result_cache.ResultCache(path, 500)) == 1
+    assert result_cache.ResultCache(path, 500).get(-33.800001, 151.2) is not None
+    assert result_cache.ResultCache(path, 1000).get(-33.8, 151.2) is None
+
+    tags = {**water_tags.TAGS, "natural": ["beach"]}
+    monkeypatch.setattr(water_tags, "TAGS", tags)
+    assert len(result_cache.ResultCache(path, 500)) == 0
@@ -0,0 +1,85 @@
+import geopandas
+import numpy
+import pandas
+import pandas.testing
+import pytest
+import shapely
+
+import benchmark
+import build_water_index
+import cache_water_points
+import feature_sources
+import water_index
+import water_tags
+
+
+@pytest.fixture
+def source():
+    # The benchmark's synthetic features, and some that depend on each other:
+    # a pool inside a sports centre, a beach with its coastline, Port Jackson
+    # and a name that isn't ASCII.
+    features = benchmark.synthetic_features(2000, numpy.random.default_rng(0))
+    extra = geopandas.GeoDataFrame(
+        {
+            "leisure": ["sports_centre", "swimming_pool", None, None, None],
+            "natural": [None, None, "beach", "coastline", "water"],
+            "name": ["Leisure Centre", None, "Plage de l'Été", None, "Port Jackson"],
+        },
+        geometry=[
+            shapely.box(151.1, -33.9, 151.101, -33.899),
+            shapely.box(151.1002, -33.8998, 151.1004, -33.8996),
+            shapely.box(151.15, -33.85, 151.151, -33.849),
+            shapely.linestrings([(151.149, -33.85), (151.152, -33.85)]),
+            shapely.box(151.101, -33.91, 151.11, -33.9),
+        ],
+        crs="EPSG:4326",
+        index=pandas.MultiIndex.from_tuples(
+            [("way", 10_000 + i) for i in range(5)], names=["element", "id"]
+        ),
+    )
+    return feature_sources.LocalExtractSource(pandas.concat([features, extra]))
+
+
+def test_round_trip(tmp_path, source):
+    path = str(tmp_path / "index")
+    assert build_water_index.build(source, path, grid_size=1000) == len(source.gdf)
+    index = water_index.WaterIndex(path)
+    assert len(index) == len(source.gdf)
+
+    positions = numpy.arange(len(index))
+    assert shapely.equals_exact(
+        index.geometry(positions), source.index.geometries, tolerance=0
+    ).all()
+    assert index.string("name", positions) == [
+        None if pandas.isna(name) else name for name in source.gdf["name"]
+    ]
+    assert list(index.ids) == list(source.gdf.index.get_level_values("id"))
+
+
+def test_same_features_as_source(tmp_path, source):
+    path = str(tmp_path / "index")
+    build_water_index.build(source, path, grid_size=1000)
+    index = water_index.WaterIndex(path)
+
+    rng = numpy.random.default_rng(1)
+    points = benchmark.synthetic_points(300, rng)
+    # Next to the features that depend on each other, and in Port Jackson.
+    points.loc[:3, "Pickup_Latitude"] = [-33.8997, -33.8499, -33.9081, -33.8501]
+    points.loc[:3, "Pickup_Longitude"] = [151.1003, 151.1505, 151.1082, 151.1497]
+    expected = cache_water_points.find_features(points, source=source)
+    features = cache_water_points.find_features(points, source=index)
+    pandas.testing.assert_frame_equal(features, expected, check_dtype=False)
+
+
+def test_needs_osm_ids(tmp_path, source):
+    source = feature_sources.LocalExtractSource(source.gdf.reset_index(drop=True))
+    with pytest.raises(ValueError, match="no element or id level"):
+        build_water_index.build(source, str(tmp_path / "index"))
+
+
+def test_rejects_other_tags(tmp_path, source, monkeypatch):
+    path = str(tmp_path / "index")
+    build_water_index.build(source, path)
+    monkeypatch.setattr(water_tags, "TAGS", {**water_tags.TAGS, "natural": ["beach"]})
+    with pytest.raises(ValueError, match="rebuild"):
+        water_index.WaterIndex(path)
@@ -0,0 +1,125 @@
+# Helpers for the long (tidy) format that water features are stored in, both
+# in the cache and between stages. There is one row per (patient_id, feature),
+# ranked from 0 in order of distance from the point. Points with no water
+# features have a single row with an empty rank, so they are still recorded.
+# Any other columns (e.g. age_years) belong to the point and are repeated on
+# each of its rows.
+#
+# The older wide layout, with water_name_0, water_type_0, ... columns and a
+# water_count, can still be read, and written as a final export.
+
+import re
+
+import pandas
+
+import metrics
+
+WATER_COLUMNS = ["water_name", "water_type", "water_distance", "water_lifeguard"]
+FEATURE_COLUMNS = ["rank"] + WATER_COLUMNS
+
+_WIDE_COLUMN = re.compile(f"^({'|'.join(WATER_COLUMNS)})_(\\d+)$")
+
+
+def is_wide(df):
+    return "water_count" in df and "water_type_0" in df
+
+
+def point_columns(df):
+    return [c for c in df.columns if c not in FEATURE_COLUMNS]
+
+
+@metrics.timed("water_features.read_csv")
+def read_csv(path, **kwargs):
+    df = pandas.read_csv(path, **kwargs)
+    if is_wide(df):
+        df = wide_to_long(df)
+    return df
+
+
+def read_csv_chunks(path, chunksize, **kwargs):
+    # Reads the file chunksize rows at a time. A point's rows may be split
+    # across chunks in the long format.
+    for chunk in pandas.read_csv(path, chunksize=chunksize, **kwargs):
+        if is_wide(chunk):
+            chunk = wide_to_long(chunk)
+        yield chunk
+
+
+@metrics.timed("water_features.write_csv")
+def write_csv(df, path_or_buf, wide=False, header=True):
+    if wide:
+        df = long_to_wide(df)
+    else:
+        df = df.astype({"rank": "Int64"})
+    df.to_csv(path_or_buf, header=header, index=False)
+
+
+def head_points(df, n):
+    # The rows for the first n points.
+    patient_ids = df["patient_id"].drop_duplicates().head(n)
+    return df[df["patient_id"].isin(patient_ids)]
+
+
+def water_counts(df):
+    # The number of water features for each point, indexed by patient_id.
+    return df.groupby("patient_id", sort=False)["rank"].count()
+
+
+def feature_rows(point, water_fields):
+    # Long format rows for a point (a dict of its columns) and lists of its
+    # features' values for each of WATER_COLUMNS.
+    count = len(water_fields["water_type"])
+    if count == 0:
+        return [{**point, "rank": None, **{col: None for col in WATER_COLUMNS}}]
+    return [
+        {**point, "rank": i, **{col: water_fields[col][i] for col in WATER_COLUMNS}}
+        for i in range(count)
+    ]
+
+
+def wide_to_long(df):
+    wide_columns = [c for c in df.columns if _WIDE_COLUMN.match(c)]
+    width = max(int(_WIDE_COLUMN.match(c).group(2)) for c in wide_columns) + 1
+    point_cols = [c for c in df.columns if c not in wide_columns and c != "water_count"]
+
+    df = df.reset_index(drop=True)
+    water_count = df["water_count"].fillna(0)
+    parts = []
+    for i in range(width):
+        present = water_count > i
+        if not present.any():
+            break
+        part = df.loc[present, point_cols].copy()
+        part["rank"] = i
+        for col in WATER_COLUMNS:
+            part[col] = df.loc[present, f"{col}_{i}"] if f"{col}_{i}" in df else None
+        parts.append(part)
+    no_water = df.loc[water_count == 0, point_cols].copy()
+    no_water["rank"] = None
+    for col in WATER_COLUMNS:
+        no_water[col] = None
+    parts.append(no_water)
+
+    # Keep the points in their original order, each point's features by rank.
+    long = pandas.concat(parts)
+    long["rank"] = long["rank"].astype("Int64")
+    long = long.rename_axis("_order").sort_values(["_order", "rank"])
+    return long.reset_index(drop=True)
+
+
+def long_to_wide(df):
+    point_cols = point_columns(df)
+    points = df.drop_duplicates("patient_id")[point_cols].set_index("patient_id")
+    features = df[df["rank"].notna()].astype({"rank": int})
+    points["water_count"] = (
+        features.groupby("patient_id").size().reindex(points.index).fillna(0).astype(int)
+    )
+    if len(features) == 0:
+        return points.reset_index()
+
+    wide = features.pivot(index="patient_id", columns="rank", values=WATER_COLUMNS)
+    ranks = range(features["rank"].max() + 1)
+    wide = wide[[(col, rank) for rank in ranks for col in WATER_COLUMNS]]
+    wide.columns = [f"{col}_{rank}" for col, rank in wide.columns]
+    wide = wide.infer_objects()
+    return points.join(wide).reset_index()
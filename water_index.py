@@ -0,0 +1,347 @@
+# A prebuilt index of every water feature in a source (e.g. a statewide
+# extract), built once by build_water_index.py, so that each run can find the
+# water near its points without loading, filtering, classifying and projecting
+# the features again.
+#
+# The index is a directory of files that are memory-mapped when it's opened,
+# so opening it takes well under a second however many features it has:
+#   index.json: the grid, the hash of water_tags.TAGS the index was built with,
+#     and the lookup tables for the codes below.
+#   geometry.bin, geometry_offsets.npy: each feature's geometry, projected to
+#     spatial_index.DISTANCE_CRS, as WKB, one after the other.
+#   bounds.npy: each feature's projected bounding box (minx, miny, maxx, maxy).
+#   cells.npy, cell_offsets.npy: the features whose bounding boxes overlap each
+#     cell of a square grid, cell after cell.
+#   types.npy, elements.npy, ids.npy: each feature's water type and element
+#     type (as positions in the tables in index.json) and OSM ID.
+#   flags.npy: the FLAGS of each feature, which decide whether it's kept when
+#     it's near a point, as in cache_water_points.process_features.
+#   within.npy: (pool or building, sports centre) pairs of features where the
+#     first is inside the second.
+#   {column}.bin, {column}_offsets.npy, {column}_present.npy: the values of each
+#     of STRING_COLUMNS, as UTF-8 one after the other, and which are present.
+#
+# The water types are decided when the index is built, so it needs rebuilding
+# whenever water_tags.TAGS or the classification rules change.
+
+import json
+import os
+
+import numpy
+import shapely
+
+import metrics
+import result_cache
+import spatial_index
+
+FORMAT_VERSION = 1
+
+GRID_SIZE_METRES = 1000
+
+FLAGS = ["beach", "coastline", "club", "port_jackson", "dry_man_made"]
+
+ELEMENTS = ["node", "way", "relation"]
+
+STRING_COLUMNS = ["name", "lifeguard", "supervised"]
+
+# The longest edge, in degrees, of the boxes around points before they're
+# projected.
+BOX_SEGMENT_DEGREES = 0.001
+
+
+def write(
+    path,
+    geometries,
+    types,
+    elements,
+    ids,
+    flags,
+    within,
+    strings,
+    grid_size=GRID_SIZE_METRES,
+):
+    # Writes an index of features with the given projected geometries, water
+    # types, OSM element types and IDs, FLAGS (as an array with a column per
+    # flag), (inside, outside) pairs of positions and STRING_COLUMNS values.
+    os.makedirs(path, exist_ok=True)
+    type_names, type_codes = numpy.unique(
+        numpy.asarray(types, dtype=str), return_inverse=True
+    )
+    element_codes = numpy.array([ELEMENTS.index(e) for e in elements], dtype="int8")
+
+    _write_blob(path, "geometry", shapely.to_wkb(geometries))
+    bounds = shapely.bounds(geometries)
+    numpy.save(os.path.join(path, "bounds.npy"), bounds)
+    numpy.save(os.path.join(path, "types.npy"), type_codes.astype("int16"))
+    numpy.save(os.path.join(path, "elements.npy"), element_codes)
+    numpy.save(os.path.join(path, "ids.npy"), numpy.asarray(ids, dtype="int64"))
+    numpy.save(os.path.join(path, "flags.npy"), numpy.asarray(flags, dtype=bool))
+    within = numpy.asarray(within, dtype="int64").reshape(-1, 2)
+    numpy.save(os.path.join(path, "within.npy"), within)
+    for column in STRING_COLUMNS:
+        values = strings[column]
+        present = numpy.array([isinstance(v, str) for v in values], dtype=bool)
+        numpy.save(os.path.join(path, f"{column}_present.npy"), present)
+        _write_blob(
+            path, column, [v.encode() if p else b"" for v, p in zip(values, present)]
+        )
+
+    grid = _write_grid(path, bounds, grid_size)
+    with open(os.path.join(path, "index.json"), "w") as f:
+        json.dump(
+            {
+                "version": FORMAT_VERSION,
+                "tags_hash": result_cache.tags_hash(),
+                "crs": spatial_index.DISTANCE_CRS,
+                "features": len(type_codes),
+                "grid": grid,
+                "types": type_names.tolist(),
+                "flags": FLAGS,
+                "elements": ELEMENTS,
+            },
+            f,
+            indent=2,
+        )
+
+
+def _write_blob(path, name, values):
+    lengths = numpy.array([len(v) for v in values], dtype="int64")
+    offsets = numpy.concatenate([[0], numpy.cumsum(lengths)])
+    numpy.save(os.path.join(path, f"{name}_offsets.npy"), offsets)
+    with open(os.path.join(path, f"{name}.bin"), "wb") as f:
+        f.write(b"".join(values))
+
+
+def _write_grid(path, bounds, size):
+    # Lists the features overlapping each cell, cell after cell, and returns
+    # where the grid is.
+    if len(bounds) == 0:
+        x0, y0, nx, ny = 0.0, 0.0, 1, 1
+    else:
+        x0 = numpy.floor(bounds[:, 0].min() / size) * size
+        y0 = numpy.floor(bounds[:, 1].min() / size) * size
+        nx = int((bounds[:, 2].max() - x0) // size) + 1
+        ny = int((bounds[:, 3].max() - y0) // size) + 1
+    ix0 = ((bounds[:, 0] - x0) // size).astype("int64")
+    iy0 = ((bounds[:, 1] - y0) // size).astype("int64")
+    ix1 = ((bounds[:, 2] - x0) // size).astype("int64")
+    iy1 = ((bounds[:, 3] - y0) // size).astype("int64")
+    feature, cell_x, cell_y = _cells_in_ranges(ix0, ix1, iy0, iy1)
+    cell = cell_y * nx + cell_x
+    order = numpy.argsort(cell, kind="stable")
+    counts = numpy.bincount(cell, minlength=nx * ny)
+    numpy.save(os.path.join(path, "cells.npy"), feature[order])
+    offsets = numpy.concatenate([[0], numpy.cumsum(counts)])
+    numpy.save(os.path.join(path, "cell_offsets.npy"), offsets)
+    return {"size": size, "x0": float(x0), "y0": float(y0), "nx": nx, "ny": ny}
+
+
+def _cells_in_ranges(ix0, ix1, iy0, iy1):
+    # Every (item, x, y) for the cells in each item's inclusive ranges of
+    # columns and rows. Empty ranges have no cells.
+    widths = numpy.maximum(ix1 - ix0 + 1, 0)
+    heights = numpy.maximum(iy1 - iy0 + 1, 0)
+    counts = widths * heights
+    item = numpy.repeat(numpy.arange(len(counts)), counts)
+    k = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    return item, ix0[item] + k % widths[item], iy0[item] + k // widths[item]
+
+
+def _ranges(starts, ends):
+    # The concatenation of range(start, end) for each start and end, and which
+    # of them each value came from.
+    lengths = ends - starts
+    which = numpy.repeat(numpy.arange(len(lengths)), lengths)
+    starts_of_which = numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+    return starts[which] + numpy.arange(lengths.sum()) - starts_of_which, which
+
+
+class _Blob:
+    def __init__(self, path, name):
+        self.offsets = numpy.load(
+            os.path.join(path, f"{name}_offsets.npy"), mmap_mode="r"
+        )
+        # Empty files can't be memory-mapped.
+        self.data = b""
+        if self.offsets[-1] > 0:
+            self.data = numpy.memmap(os.path.join(path, f"{name}.bin"), mode="r")
+
+    def get(self, position):
+        return bytes(self.data[self.offsets[position] : self.offsets[position + 1]])
+
+
+# Features whose water types, FLAGS, (pool or building, sports centre) pairs and
+# STRING_COLUMNS have been worked out once, so the water near a batch of points
+# only needs finding and measuring. Subclasses hold the features and answer
+# query_points; they have types (positions in type_names), flags (a bool array
+# per flag), within_inner and within_outer (the pairs, sorted by the inner
+# feature), present (a bool array per string column) and string().
+class ClassifiedFeatures:
+    @metrics.timed("water_index.water_fields")
+    def water_fields(self, lats, lngs, radius):
+        # For each point, its features' values of water_features.WATER_COLUMNS,
+        # after removing the same features as
+        # cache_water_points.process_features, in order of distance.
+        point, feature, distances = self.query_points(lats, lngs, radius)
+        keep = self._keep(point, feature, len(lats))
+        any_lifeguard = numpy.zeros(len(lats), dtype=bool)
+        any_lifeguard[point[self.present["lifeguard"][feature]]] = True
+        any_supervised = numpy.zeros(len(lats), dtype=bool)
+        any_supervised[point[self.present["supervised"][feature]]] = True
+
+        point = point[keep]
+        feature = feature[keep]
+        distances = distances[keep]
+        starts = numpy.searchsorted(point, numpy.arange(len(lats)))
+        ends = numpy.searchsorted(point, numpy.arange(len(lats)), side="right")
+        result = []
+        for i, (start, end) in enumerate(zip(starts, ends)):
+            # Sorted as pandas sorts, so ties come out in the same order as
+            # from a DataFrame of the point's features.
+            order = numpy.argsort(distances[start:end], kind="quicksort")
+            positions = feature[start:end][order]
+            if any_lifeguard[i]:
+                lifeguard = self.string("lifeguard", positions)
+            elif any_supervised[i]:
+                lifeguard = self.string("supervised", positions)
+            else:
+                lifeguard = [None] * len(positions)
+            result.append(
+                {
+                    "water_name": self.string("name", positions),
+                    "water_type": self.type_names[self.types[positions]].tolist(),
+                    "water_distance": distances[start:end][order].tolist(),
+                    "water_lifeguard": lifeguard,
+                }
+            )
+        return result
+
+    def _keep(self, point, feature, num_points):
+        # Which of the (point, feature) pairs are kept by the rules in
+        # cache_water_points.process_features, applied in the same order.
+        keep = numpy.ones(len(point), dtype=bool)
+
+        # Pools and buildings inside a sports centre that's also near the point.
+        inner = numpy.searchsorted(self.within_inner, feature)
+        inner_end = numpy.searchsorted(self.within_inner, feature, side="right")
+        entries, which = _ranges(inner, inner_end)
+        if len(entries) > 0:
+            keys = point * len(self) + feature
+            outer_keys = point[which] * len(self) + self.within_outer[entries]
+            keep[numpy.unique(which[numpy.isin(outer_keys, keys)])] = False
+
+        # Coastline near a beach.
+        has_beach = numpy.zeros(num_points, dtype=bool)
+        has_beach[point[keep & self.flags["beach"][feature]]] = True
+        keep &= ~(self.flags["coastline"][feature] & has_beach[point])
+
+        keep &= ~self.flags["club"][feature]
+
+        # Port Jackson, unless it's the only thing near the point.
+        several = numpy.bincount(point[keep], minlength=num_points) > 1
+        keep &= ~(self.flags["port_jackson"][feature] & several[point])
+
+        keep &= ~self.flags["dry_man_made"][feature]
+        return keep
+
+
+class WaterIndex(ClassifiedFeatures):
+    def __init__(self, path):
+        with open(os.path.join(path, "index.json")) as f:
+            meta = json.load(f)
+        if meta["version"] != FORMAT_VERSION:
+            raise ValueError(
+                f"{path} is version {meta['version']}, not {FORMAT_VERSION}"
+            )
+        if meta["tags_hash"] != result_cache.tags_hash():
+            raise ValueError(
+                f"{path} was built with different water_tags.TAGS; rebuild it"
+            )
+        self.path = path
+        self.grid = meta["grid"]
+        self.type_names = numpy.array(meta["types"], dtype=object)
+
+        def load(name):
+            return numpy.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+
+        self.bounds = load("bounds")
+        self.types = load("types")
+        self.elements = load("elements")
+        self.ids = load("ids")
+        self.cells = load("cells")
+        self.cell_offsets = load("cell_offsets")
+        self.flags = {flag: load("flags")[:, i] for i, flag in enumerate(meta["flags"])}
+        within = load("within")
+        # Sorted by the inner feature, to look up the sports centres a pool or
+        # building is in.
+        order = numpy.argsort(within[:, 0], kind="stable")
+        self.within_inner = numpy.asarray(within[order, 0])
+        self.within_outer = numpy.asarray(within[order, 1])
+        self.wkb = _Blob(path, "geometry")
+        self.strings = {c: _Blob(path, c) for c in STRING_COLUMNS}
+        self.present = {c: load(f"{c}_present") for c in STRING_COLUMNS}
+        # Geometries are parsed from WKB the first time they're needed.
+        self.geometries = numpy.full(len(self.types), None, dtype=object)
+
+    def __len__(self):
+        return len(self.types)
+
+    def geometry(self, positions):
+        missing = positions[shapely.is_missing(self.geometries[positions])]
+        if len(missing) > 0:
+            metrics.count("water_index.geometries_parsed", len(missing))
+            wkb = [self.wkb.get(p) for p in missing]
+            self.geometries[missing] = shapely.from_wkb(wkb)
+        return self.geometries[positions]
+
+    def string(self, column, positions):
+        present = self.present[column][positions]
+        return [
+            self.strings[column].get(p).decode() if is_present else None
+            for p, is_present in zip(positions, present)
+        ]
+
+    def query_points(self, lats, lngs, radius):
+        # A table of the (point, feature) pairs where the feature intersects
+        # the point's spatial_index.bboxes_from_points box, as positions in
+        # lats/lngs and the index, and their distances rounded to cm. Sorted by
+        # point, then feature. The boxes are projected with extra vertices
+        # along their edges, so they only differ from the lat/lng boxes by
+        # millimetres.
+        boxes = spatial_index.bboxes_from_points(lats, lngs, radius)
+        boxes = spatial_index.project_geometries(
+            shapely.segmentize(boxes, BOX_SEGMENT_DEGREES), "EPSG:4326"
+        )
+        box_bounds = shapely.bounds(boxes)
+        size, x0, y0 = self.grid["size"], self.grid["x0"], self.grid["y0"]
+        nx, ny = self.grid["nx"], self.grid["ny"]
+        ix0 = numpy.maximum((box_bounds[:, 0] - x0) // size, 0).astype("int64")
+        iy0 = numpy.maximum((box_bounds[:, 1] - y0) // size, 0).astype("int64")
+        ix1 = numpy.minimum((box_bounds[:, 2] - x0) // size, nx - 1).astype("int64")
+        iy1 = numpy.minimum((box_bounds[:, 3] - y0) // size, ny - 1).astype("int64")
+        point, cell_x, cell_y = _cells_in_ranges(ix0, ix1, iy0, iy1)
+        cell = cell_y * nx + cell_x
+        entries, which = _ranges(self.cell_offsets[cell], self.cell_offsets[cell + 1])
+        point = point[which]
+        feature = self.cells[entries]
+
+        # Features can be in several cells, so there may be duplicates.
+        keys = numpy.unique(point * len(self) + feature)
+        point = keys // len(self)
+        feature = keys % len(self)
+        bounds = self.bounds[feature]
+        near = (
+            (bounds[:, 0] <= box_bounds[point, 2])
+            & (bounds[:, 2] >= box_bounds[point, 0])
+            & (bounds[:, 1] <= box_bounds[point, 3])
+            & (bounds[:, 3] >= box_bounds[point, 1])
+        )
+        point = point[near]
+        feature = feature[near]
+        geometries = self.geometry(feature)
+        intersects = shapely.intersects(boxes[point], geometries)
+        point = point[intersects]
+        feature = feature[intersects]
+        points = spatial_index.project_points(lats, lngs)
+        distances = shapely.distance(points[point], geometries[intersects])
+        return point, feature, numpy.round(distances, 2)